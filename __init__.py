@@ -1,6 +1,23 @@
 import sys
+import importlib
 
 data_dir = ''
 code_dir = ''
 
 sys.path.append(code_dir)
+
+# Submodules and collect() are imported on first access, e.g. load.era5, so
+# that `import load` does not pull in every dataset's dependencies.
+_LAZY_ATTRIBUTES = {'collect': ('load.dispatch', 'collect')}
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        module_name, attribute = _LAZY_ATTRIBUTES[name]
+        return getattr(importlib.import_module(module_name), attribute)
+    try:
+        return importlib.import_module(__name__ + '.' + name)
+    except ModuleNotFoundError as e:
+        if e.name != __name__ + '.' + name:
+            raise
+        raise AttributeError("module 'load' has no attribute " + repr(name)) from None
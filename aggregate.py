@@ -0,0 +1,193 @@
+"""
+Streaming aggregation of hourly ERA5 files into daily and monthly
+statistics.
+
+The global files written by era5.update_cds_hourly_data do not fit in
+memory. aggregate_hourly reads them in time blocks and accumulates the mean,
+maximum and number of valid values of each day and month in a single pass,
+appending the completed periods to compact (float32, zlib-compressed and
+chunked by time) appendstore files next to the source, e.g.
+
+    reanalysis-era5-pressure-levels_reanalysis_200_01-2023_daily.nc
+    reanalysis-era5-pressure-levels_reanalysis_200_01-2023_monthly.nc
+
+Each variable's time block is read once and fed to the daily and monthly
+accumulators, which add it to their running sums in place. Blocks are sized
+from a byte budget rather than a number of time steps, so only one block of
+at most MAX_BLOCK_BYTES and the running sums of the current periods are held
+in memory, whatever the grid, time step or length of the record.
+"""
+
+import os
+
+import numpy as np
+import xarray as xr
+
+import load.appendstore as appendstore
+from load.instrument import stage
+
+SUFFIXES = {'D': '_daily', 'MS': '_monthly'}
+CHUNK_TIME = {'D': 31, 'MS': 12}
+MAX_BLOCK_BYTES = 256 * 1024**2
+
+
+class PeriodAccumulator():
+    """
+    Running mean, maximum and count of consecutive time blocks over days
+    ('D') or months ('MS'). NaNs are ignored, and periods without valid
+    values have NaN means and maxima.
+    """
+
+    def __init__(self, freq: str = 'MS'):
+        self.freq = freq
+        self.period = None
+        self.sums = None
+        self.maxs = None
+        self.counts = None
+
+    def add(self, times: np.array, block: np.array) -> list:
+        """
+        Add a block of time steps, after the steps already added. Each time
+        step is added to the running sums in place.
+
+        Args:
+            times (np.array): datetime64 times of the block
+            block (np.array): values with time as the first axis
+
+        Returns:
+            list: (period start, mean, max, count) of the periods completed
+                by the block
+        """
+        completed = []
+        for label, step in zip(period_starts(times, self.freq), block):
+            if label != self.period:
+                if self.period is not None:
+                    completed.append(self._result())
+                self.period = label
+                self.sums = np.zeros(step.shape)
+                self.maxs = np.full(step.shape, np.nan)
+                self.counts = np.zeros(step.shape, dtype='int64')
+            valid = ~np.isnan(step)
+            np.add(self.sums, step, out=self.sums, where=valid)
+            np.fmax(self.maxs, step, out=self.maxs)
+            self.counts += valid
+        return completed
+
+    def flush(self) -> list:
+        """ Returns the statistics of the last period, once all blocks are added """
+        if self.period is None:
+            return []
+        completed = [self._result()]
+        self.period = None
+        return completed
+
+    def _result(self) -> tuple:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(self.counts > 0,
+                            self.sums / np.maximum(self.counts, 1), np.nan)
+        return (np.datetime64(self.period, 'ns'), mean, self.maxs, self.counts)
+
+
+def aggregate_hourly(filepath: str, variables: list = None, freqs: tuple = ('D', 'MS'), max_block_bytes: int = MAX_BLOCK_BYTES) -> dict:
+    """
+    Write the daily and/or monthly mean, maximum and count of an hourly
+    NetCDF file, reading it in time blocks.
+
+    Args:
+        filepath (str): hourly NetCDF file, e.g. from update_cds_hourly_data
+        variables (list, optional): variables to aggregate. Defaults to all
+            the variables with a time dimension.
+        freqs (tuple, optional): 'D' and/or 'MS'. Defaults to ('D', 'MS').
+        max_block_bytes (int, optional): size of the time blocks read at
+            once. Defaults to MAX_BLOCK_BYTES.
+
+    Returns:
+        dict: {freq: store filepath}. Each store has '<variable>_mean' and
+            '<variable>_max' (float32) and '<variable>_count' (int16)
+            variables.
+    """
+    out_filepaths = {freq: os.path.splitext(filepath)[0] + SUFFIXES[freq] + '.nc'
+                     for freq in freqs}
+    tmp_filepaths = {freq: f + '.' + str(os.getpid()) + '.tmp'
+                     for freq, f in out_filepaths.items()}
+
+    with xr.open_dataset(filepath) as ds:
+        if variables is None:
+            variables = [v for v in ds.data_vars if 'time' in ds[v].dims]
+        fields = {v: hourly_field(ds[v]) for v in variables}
+        first = fields[variables[0]]
+        lat_name, lon_name = first.dims[1:]
+        times = first.time.values
+
+        store_variables = {}
+        for v in variables:
+            store_variables.update({v + '_mean': 'f4', v + '_max': 'f4',
+                                    v + '_count': 'i2'})
+        for freq, tmp_filepath in tmp_filepaths.items():
+            appendstore.create(tmp_filepath, first[lat_name].values,
+                               first[lon_name].values, store_variables,
+                               chunk_time=CHUNK_TIME[freq],
+                               dims=(lat_name, lon_name))
+
+        accumulators = {(freq, v): PeriodAccumulator(freq)
+                        for freq in freqs for v in variables}
+        time_block = min(block_length(f.shape[1:], f.dtype.itemsize,
+                                      max_block_bytes)
+                         for f in fields.values())
+        with stage('aggregate', filepath=filepath, time_block=time_block):
+            for start in range(0, len(times), time_block):
+                block_times = times[start:start + time_block]
+                completed = {}
+                for v in variables:
+                    block = fields[v].isel(
+                        time=slice(start, start + time_block)).values
+                    for freq in freqs:
+                        completed[(freq, v)] = accumulators[(freq, v)].add(
+                            block_times, block)
+                _append(tmp_filepaths, completed)
+            _append(tmp_filepaths, {key: accumulator.flush()
+                                    for key, accumulator in accumulators.items()})
+
+    for freq, tmp_filepath in tmp_filepaths.items():
+        os.replace(tmp_filepath, out_filepaths[freq])
+    return out_filepaths
+
+
+def hourly_field(da: xr.DataArray) -> xr.DataArray:
+    """ Returns a (time, latitude, longitude) field of an ERA5 variable, dropping other dimensions """
+    if 'expver' in da.dims:
+        da = da.sel(expver=1)
+    extra_dims = [d for d in da.dims if d not in (
+        'time', 'latitude', 'longitude', 'lat', 'lon')]
+    da = da.isel({d: 0 for d in extra_dims})
+    return da.transpose('time', *[d for d in da.dims if d != 'time'])
+
+
+def block_length(shape: tuple, itemsize: int, max_block_bytes: int = MAX_BLOCK_BYTES) -> int:
+    """ Returns the number of time steps of a given shape and item size that fit in a block """
+    step_bytes = int(np.prod(shape)) * itemsize
+    return max(1, int(max_block_bytes // max(step_bytes, 1)))
+
+
+def period_starts(times: np.array, freq: str) -> np.array:
+    """ Returns the start of the day ('D') or month ('MS') of each time """
+    if freq == 'MS':
+        return times.astype('datetime64[M]')
+    if freq == 'D':
+        return times.astype('datetime64[D]')
+    raise ValueError('Unsupported frequency: ' + freq)
+
+
+def _append(filepaths: dict, completed: dict):
+    """ Append completed periods, {(freq, variable): periods}, to the stores """
+    for freq, filepath in filepaths.items():
+        data, times = {}, None
+        for (key_freq, v), periods in completed.items():
+            if key_freq != freq or len(periods) == 0:
+                continue
+            times = np.array([p[0] for p in periods])
+            data[v + '_mean'] = np.stack([p[1] for p in periods])
+            data[v + '_max'] = np.stack([p[2] for p in periods])
+            data[v + '_count'] = np.stack([p[3] for p in periods])
+        if times is not None:
+            appendstore.append(filepath, times, data)
@@ -8,13 +8,18 @@ Native precipiation values are in mm/day.
 import glob
 import numpy as np
 import xarray as xr
-from tqdm import tqdm
 
 import load.location_sel as ls
+import load.pointstore as pointstore
+from load.instrument import stage
+from load.memo import memoize
+from load.compact import compact_dataset, netcdf_encoding
+from load.resample import monthly
 from load import data_dir
 
 
-def collect_APHRO(location: str or tuple, minyear: str, maxyear: str) -> xr.Dataset:
+@memoize(lambda args: [data_dir + "APHRODITE/aphrodite_hma_1951_2016.nc"])
+def collect_APHRO(location: str or tuple, minyear: str, maxyear: str, from_cube=False) -> xr.Dataset:
     """
     Download data from APHRODITE model.
 
@@ -22,57 +27,72 @@ def collect_APHRO(location: str or tuple, minyear: str, maxyear: str) -> xr.Data
         location (str or tuple): location string or lat/lon coordinate tuple
         minyear (float): start date in years
         maxyear (float): end date in years
+        from_cube (bool, optional): read from the common-grid cube, see
+            cube.build_cube. Defaults to False.
 
     Returns:
         xr.Dataset: APHRODITE data
     """
 
-    aphro_ds = xr.open_dataset(
-        data_dir + "APHRODITE/aphrodite_hma_1951_2016.nc")
+    if from_cube:
+        import load.cube as cube
+        ds = cube.collect('aphrodite', location, minyear, maxyear)
+        return compact_dataset(ds.assign_attrs(plot_legend="APHRODITE"))
+
+    filepath = data_dir + "APHRODITE/aphrodite_hma_1951_2016.nc"
+    with stage('open', filepath=filepath):
+        aphro_ds = xr.open_dataset(filepath)
 
     if type(location) == str:
         loc_ds = ls.select_basin(aphro_ds, location)
     else:
         lat, lon = location
-        loc_ds = aphro_ds.interp(coords={"lon": lon, "lat": lat},
-                                 method="nearest")
-
-    tim_ds = loc_ds.sel(time=slice(minyear, maxyear))
+        with stage('interp', location=location):
+            if pointstore.is_current(filepath):
+                loc_ds = pointstore.point_series(filepath, lat, lon)
+            else:
+                loc_ds = aphro_ds.interp(coords={"lon": lon, "lat": lat},
+                                         method="nearest")
+
+    with stage('slice', minyear=minyear, maxyear=maxyear):
+        tim_ds = loc_ds.sel(time=slice(minyear, maxyear))
     ds = tim_ds.assign_attrs(plot_legend="APHRODITE")  # in mm/day
-    return ds
+    return compact_dataset(ds)
 
 
 def merge_og_files():
     """Function to open, crop and merge the raw APHRODITE data files."""
+    from tqdm import tqdm
 
     ds_list = []
     extent = ls.basin_extent('hma')
 
-    print('1951-2007')
     for f in tqdm(glob.glob(data_dir +
                             'APHRODITE/APHRO_MA_025deg_V1101.1951-2007.gz/*.nc')):
-        ds = xr.open_dataset(f)
-        ds = ds.rename({'latitude': 'lat', 'longitude': 'lon', 'precip': 'tp'})
-        da_cropped = ds.tp.sel(lon=slice(extent[1], extent[3]),
-                               lat=slice(extent[2], extent[0]))
-        ds_resampled = da_cropped.resample(time='MS').mean()
+        with stage('open', filepath=f, version='1951-2007'):
+            ds = xr.open_dataset(f)
+            ds = ds.rename({'latitude': 'lat', 'longitude': 'lon', 'precip': 'tp'})
+            da_cropped = ds.tp.sel(lon=slice(extent[1], extent[3]),
+                                   lat=slice(extent[2], extent[0]))
+            ds_resampled = monthly(da_cropped)
         #ds_resampled['time'] = ds_resampled.time.astype(float)/365/24/60/60/1e9
         #ds_resampled['time'] = ds_resampled['time'] + 1970
         ds_list.append(ds_resampled)
 
-    print('2007-2016')
     for f in tqdm(
             glob.glob(data_dir + 'APHRODITE/APHRO_MA_025deg_V1101_EXR1/*.nc')):
-        ds = xr.open_dataset(f)
-        ds = ds.rename({'precip': 'tp'})
-        da_cropped = ds.tp.sel(lon=slice(extent[1], extent[3]),
-                               lat=slice(extent[2], extent[0]))
-        ds_resampled = da_cropped.resample(time='MS').mean()
+        with stage('open', filepath=f, version='2007-2016'):
+            ds = xr.open_dataset(f)
+            ds = ds.rename({'precip': 'tp'})
+            da_cropped = ds.tp.sel(lon=slice(extent[1], extent[3]),
+                                   lat=slice(extent[2], extent[0]))
+            ds_resampled = monthly(da_cropped)
         #ds_resampled['time'] = ds_resampled.time.astype(float)/365/24/60/60/1e9
         #ds_resampled['time'] = ds_resampled['time'] + 1970
         ds_list.append(ds_resampled)
 
-    ds_merged = xr.merge(ds_list)
+    with stage('merge', n_files=len(ds_list)):
+        ds_merged = xr.merge(ds_list)
 
     '''
     # Standardise time resolution
@@ -81,4 +101,7 @@ def merge_og_files():
     time_arr = np.arange(round(minyear) + 1./24., round(maxyear), 1./12.)
     da_merged['time'] = time_arr
     '''
-    ds_merged.to_netcdf(data_dir + "APHRODITE/aphrodite_hma_1951_2016.nc")
+    out_filepath = data_dir + "APHRODITE/aphrodite_hma_1951_2016.nc"
+    with stage('write', filepath=out_filepath):
+        ds_merged.to_netcdf(out_filepath, encoding=netcdf_encoding(ds_merged))
+    pointstore.build(out_filepath)
@@ -0,0 +1,79 @@
+"""
+NetCDF stores on a lat/lon grid with an unlimited time dimension, so that
+data can be written in time-ordered chunks as it is produced instead of
+being merged in memory first. The stores open as usual with
+xr.open_dataset.
+"""
+
+import numpy as np
+import netCDF4
+
+TIME_UNITS = 'days since 1970-01-01'
+
+
+def create(filepath: str, lat: np.array, lon: np.array, variables: dict, attrs: dict = None, chunk_time: int = 1, dims: tuple = ('lat', 'lon')):
+    """
+    Create an empty store.
+
+    Args:
+        filepath (str): store filepath
+        lat (np.array): latitudes in °N
+        lon (np.array): longitudes in °E
+        variables (dict): {variable name: numpy dtype}
+        attrs (dict, optional): global attributes. Defaults to None.
+        chunk_time (int, optional): number of time steps per chunk. Defaults to 1.
+        dims (tuple, optional): names of the latitude and longitude
+            dimensions. Defaults to ('lat', 'lon').
+    """
+    lat_name, lon_name = dims
+    with netCDF4.Dataset(filepath, 'w') as nc:
+        nc.createDimension('time', None)
+        nc.createDimension(lat_name, len(lat))
+        nc.createDimension(lon_name, len(lon))
+
+        time_var = nc.createVariable('time', 'f8', ('time',))
+        time_var.units = TIME_UNITS
+        time_var.calendar = 'proleptic_gregorian'
+        nc.createVariable(lat_name, 'f8', (lat_name,))[:] = lat
+        nc.createVariable(lon_name, 'f8', (lon_name,))[:] = lon
+
+        for name, dtype in variables.items():
+            nc.createVariable(name, dtype, ('time', lat_name, lon_name), zlib=True,
+                              chunksizes=(chunk_time, len(lat), len(lon)))
+        if attrs is not None:
+            nc.setncatts(attrs)
+
+
+def append(filepath: str, times: np.array, data: dict):
+    """
+    Append time steps to a store.
+
+    Args:
+        filepath (str): store filepath
+        times (np.array): datetime64 times, after the times already stored
+        data (dict): {variable name: array of shape (time, lat, lon)}
+    """
+    times = np.asarray(times, dtype='datetime64[ns]')
+    with netCDF4.Dataset(filepath, 'a') as nc:
+        start = len(nc.dimensions['time'])
+        end = start + len(times)
+        nc['time'][start:end] = (times - np.datetime64('1970-01-01')
+                                 ) / np.timedelta64(1, 'D')
+        for name, values in data.items():
+            nc[name][start:end] = values
+
+
+def stored_times(filepath: str) -> np.array:
+    """ Returns the datetime64 times already in a store """
+    with netCDF4.Dataset(filepath, 'r') as nc:
+        days = nc['time'][:].filled(np.nan)
+    return (np.datetime64('1970-01-01') +
+            np.round(days * 86400).astype('int64').astype('timedelta64[s]')
+            ).astype('datetime64[ns]')
+
+
+def stored_dtypes(filepath: str) -> dict:
+    """ Returns the numpy dtypes of the variables of a store, {variable name: dtype} """
+    with netCDF4.Dataset(filepath, 'r') as nc:
+        return {name: np.dtype(var.dtype) for name, var in nc.variables.items()
+                if var.dimensions[:1] == ('time',) and name != 'time'}
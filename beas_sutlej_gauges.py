@@ -7,6 +7,7 @@ import numpy as np
 import pandas as pd
 import xarray as xr
 # from math import floor, ceil
+from load.resample import monthly_frame
 from load import data_dir
 
 
@@ -33,7 +34,7 @@ def gauge_download(station: str, minyear: str, maxyear: str) -> xr.DataArray:
     with pd.option_context('mode.chained_assignment', None):
         clean_df.loc[:, 'tp'] = pd.to_numeric(
             clean_df.loc[:, 'tp'], errors='coerce')
-    df = clean_df.tp.resample('MS').mean()
+    df = monthly_frame(clean_df.tp)
     # df = df.reset_index()
     # df.loc[:, 'Date'] = df['Date'].values.astype(float)/365/24/60/60/1e9
     # df.loc[:, 'Date'] = df['Date'] + 1970
@@ -94,7 +95,7 @@ def all_gauge_data(minyear: float, maxyear: float, threshold: int = None) -> xr.
         df_masked = df_masked.dropna(axis=1, thresh=threshold)
 
     df_masked.index = pd.to_datetime(df_masked.index)
-    df_monthly = df_masked.resample('MS').mean()
+    df_monthly = monthly_frame(df_masked)
     df = df_monthly.reset_index()
     # df['Date'] = df['Date'].values.astype(float)/365/24/60/60/1e9 + 1970
 
@@ -4,14 +4,18 @@ Raw and bias corrected (Bannister et al.) WRF output.
 
 import xarray as xr
 import numpy as np
-from scipy.interpolate import griddata
-from tqdm import tqdm
 
 import load.location_sel as ls
+import load.pointstore as pointstore
+from load.instrument import stage
+from load.memo import memoize
+from load.compact import compact_dataset, netcdf_encoding
+from load.resample import monthly
 from load import data_dir
 
 
-def collect_WRF(location: str or tuple, minyear: float, maxyear: float) -> xr.Dataset:
+@memoize(lambda args: [data_dir + 'Bannister/Bannister_WRF_raw.nc'])
+def collect_WRF(location: str or tuple, minyear: float, maxyear: float, from_cube=False) -> xr.Dataset:
     """
     Load uncorrected WRF run data.
 
@@ -19,25 +23,40 @@ def collect_WRF(location: str or tuple, minyear: float, maxyear: float) -> xr.Da
         location (str or tuple): location string or lat/lon coordinate tuple
         minyear (float): start date in years
         maxyear (float): end date in years
+        from_cube (bool, optional): read from the common-grid cube, see
+            cube.build_cube. Defaults to False.
 
     Returns:
         xr.DataArray: WRF data
     """
-    wrf_ds = xr.open_dataset(data_dir + 'Bannister/Bannister_WRF_raw.nc')
+    if from_cube:
+        import load.cube as cube
+        ds = cube.collect('wrf', location, minyear, maxyear)
+        return compact_dataset(ds.assign_attrs(plot_legend="WRF"))
+
+    filepath = data_dir + 'Bannister/Bannister_WRF_raw.nc'
+    with stage('open', filepath=filepath):
+        wrf_ds = xr.open_dataset(filepath)
 
     if type(location) == str:
         loc_ds = ls.select_basin(wrf_ds, location)
     else:
         lat, lon = location
-        loc_ds = wrf_ds.interp(
-            coords={"lon": lon, "lat": lat}, method="nearest")
-
-    tim_ds = loc_ds.sel(time=slice(minyear, maxyear))
+        with stage('interp', location=location):
+            if pointstore.is_current(filepath):
+                loc_ds = pointstore.point_series(filepath, lat, lon)
+            else:
+                loc_ds = wrf_ds.interp(
+                    coords={"lon": lon, "lat": lat}, method="nearest")
+
+    with stage('slice', minyear=minyear, maxyear=maxyear):
+        tim_ds = loc_ds.sel(time=slice(minyear, maxyear))
     ds = tim_ds.assign_attrs(plot_legend="WRF")
-    return ds
+    return compact_dataset(ds)
 
 
-def collect_BC_WRF(location: str or tuple, minyear: float, maxyear: float) -> xr.Dataset:
+@memoize(lambda args: [data_dir + 'Bannister/Bannister_WRF_corrected.nc'])
+def collect_BC_WRF(location: str or tuple, minyear: float, maxyear: float, from_cube=False) -> xr.Dataset:
     """
     Load bias-corrected WRF run data. 
 
@@ -45,24 +64,37 @@ def collect_BC_WRF(location: str or tuple, minyear: float, maxyear: float) -> xr
         location (str or tuple): location string or lat/lon coordinate tuple
         minyear (float): start date in years
         maxyear (float): end date in years
+        from_cube (bool, optional): read from the common-grid cube, see
+            cube.build_cube. Defaults to False.
 
     Returns:
         xr.DataArray: bias-corrected WRF data
     """
 
-    bc_wrf_ds = xr.open_dataset(
-        data_dir + 'Bannister/Bannister_WRF_corrected.nc')
+    if from_cube:
+        import load.cube as cube
+        ds = cube.collect('bc_wrf', location, minyear, maxyear)
+        return compact_dataset(ds.assign_attrs(plot_legend="Bias corrected WRF"))
+
+    filepath = data_dir + 'Bannister/Bannister_WRF_corrected.nc'
+    with stage('open', filepath=filepath):
+        bc_wrf_ds = xr.open_dataset(filepath)
 
     if type(location) == str:
         loc_ds = ls.select_basin(bc_wrf_ds, location)
     else:
         lat, lon = location
-        loc_ds = bc_wrf_ds.interp(
-            coords={"lon": lon, "lat": lat}, method="nearest")
-
-    tim_ds = loc_ds.sel(time=slice(minyear, maxyear))
+        with stage('interp', location=location):
+            if pointstore.is_current(filepath):
+                loc_ds = pointstore.point_series(filepath, lat, lon)
+            else:
+                loc_ds = bc_wrf_ds.interp(
+                    coords={"lon": lon, "lat": lat}, method="nearest")
+
+    with stage('slice', minyear=minyear, maxyear=maxyear):
+        tim_ds = loc_ds.sel(time=slice(minyear, maxyear))
     ds = tim_ds.assign_attrs(plot_legend="Bias corrected WRF")
-    return ds
+    return compact_dataset(ds)
 
 
 def reformat_bannister_data():
@@ -79,7 +111,7 @@ def reformat_bannister_data():
                     bias_corr_precip=(["time", "x", "y"], bias_corr_precip)),
                     coords=dict(lon=(["x", "y"], XLONG),
                     lat=(["x", "y"], XLAT), time=time))
-    ds2 = ds.resample(time="MS").mean()
+    ds2 = monthly(ds)
     #da2['time'] = da2.time.astype(float)/365/24/60/60/1e9 + 1970
 
     '''
@@ -92,19 +124,29 @@ def reformat_bannister_data():
     # Raw WRF data
     wrf_ds = ds2.drop('bias_corr_precip')
     wrf_ds = wrf_ds.rename({'m_precip': 'tp'})
-    wrf_ds = interp(wrf_ds)
-    wrf_ds.to_netcdf(data_dir + '/Bannister/Bannister_WRF_raw.nc')
+    with stage('interp'):
+        wrf_ds = interp(wrf_ds)
+    with stage('write', filepath=data_dir + 'Bannister/Bannister_WRF_raw.nc'):
+        wrf_ds.to_netcdf(data_dir + '/Bannister/Bannister_WRF_raw.nc',
+                         encoding=netcdf_encoding(wrf_ds))
+    pointstore.build(data_dir + 'Bannister/Bannister_WRF_raw.nc')
 
     # Bias corrected WRF data
     bc_ds = ds2.drop('m_precip')
     bc_ds = bc_ds.rename({'bias_corr_precip': 'tp'})
-    bc_ds = interp(bc_ds)
-    bc_ds.to_netcdf(data_dir + 'Bannister/Bannister_WRF_corrected.nc')
+    with stage('interp'):
+        bc_ds = interp(bc_ds)
+    with stage('write', filepath=data_dir + 'Bannister/Bannister_WRF_corrected.nc'):
+        bc_ds.to_netcdf(data_dir + 'Bannister/Bannister_WRF_corrected.nc',
+                        encoding=netcdf_encoding(bc_ds))
+    pointstore.build(data_dir + 'Bannister/Bannister_WRF_corrected.nc')
 
 
 def interp(ds):
     """ Interpolate to match sta to ERA5 grid."""
 
+    from scipy.interpolate import griddata
+
     # Generate a regular grid to interpolate the data
     x = np.arange(70, 85, 0.25)
     y = np.arange(25, 35, 0.25)
@@ -134,6 +176,7 @@ def interp(ds):
 
 def test_interp_grid(test_ds):
     """ Test that the interpolation grid is consistent. """
+    from tqdm import tqdm
 
     indices_to_check = np.random.randint(0, 100, 10)
 
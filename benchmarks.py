@@ -0,0 +1,324 @@
+# Benchmarks
+#
+# Run with `python -m pytest benchmarks.py -s`. The loaders read synthetic
+# files written in the layout each module expects, so no data is needed.
+#
+# Environment variables:
+#   LOAD_BENCHMARK_YEARS   number of years in the synthetic datasets (5)
+#   LOAD_BENCHMARK_REPEAT  number of timed runs per benchmark (3)
+#   LOAD_BENCHMARK_OUTPUT  JSON filepath to save the results to (optional)
+#   LOAD_BENCHMARK_BASELINE  JSON results to compare against
+#                          (benchmarks_baseline.json)
+#   LOAD_BENCHMARK_TIME_TOLERANCE    allowed time ratio to the baseline (3)
+#   LOAD_BENCHMARK_MEMORY_TOLERANCE  allowed memory ratio to the baseline (1.25)
+#
+# The time is the fastest of the timed runs and the memory is the peak of
+# Python allocations (tracemalloc) during an extra, untimed run. Memory
+# allocated in worker processes, e.g. by gpm.to_netcdf, is not counted.
+#
+# A benchmark fails when it is slower, or uses more memory, than its
+# baseline result by more than the tolerance. Baseline results are only
+# compared at the same LOAD_BENCHMARK_YEARS. The time tolerance allows for
+# slower machines than the one benchmarks_baseline.json was recorded on; to
+# update the baseline, run with LOAD_BENCHMARK_OUTPUT=benchmarks_baseline.json.
+
+import os
+import gc
+import sys
+import json
+import time
+import subprocess
+import tracemalloc
+
+import h5py
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pytest
+
+import load
+from load import aphrodite, beas_sutlej_gauges, beas_sutlej_wrf, cru, era5, gpm
+import load.location_sel as ls
+import load.pointstore as pointstore
+
+YEARS = int(os.environ.get('LOAD_BENCHMARK_YEARS', 5))
+REPEAT = int(os.environ.get('LOAD_BENCHMARK_REPEAT', 3))
+OUTPUT = os.environ.get('LOAD_BENCHMARK_OUTPUT')
+BASELINE = os.environ.get('LOAD_BENCHMARK_BASELINE', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'benchmarks_baseline.json'))
+TIME_TOLERANCE = float(os.environ.get('LOAD_BENCHMARK_TIME_TOLERANCE', 3))
+MEMORY_TOLERANCE = float(os.environ.get('LOAD_BENCHMARK_MEMORY_TOLERANCE', 1.25))
+
+minyear = '1990'
+maxyear = str(1990 + YEARS - 1)
+location = 'uib'
+stations = ['Bhuntar', 'Larji', 'Sainj']
+
+# Dependencies only needed to download or preprocess data
+heavy_modules = ['cdsapi', 'metpy', 'pint', 'h5py', 'requests', 'scipy',
+                 'tqdm', 'psutil', 'load.noaa_indices']
+
+results = {}
+baseline = {}
+if os.path.exists(BASELINE):
+    with open(BASELINE) as f:
+        baseline = json.load(f)
+
+
+def measure(name: str, function, *args, setup=None):
+    """ Time a function and record its peak Python memory use """
+    times = []
+    for _ in range(REPEAT):
+        if setup is not None:
+            setup()
+        gc.collect()
+        start = time.perf_counter()
+        function(*args)
+        times.append(time.perf_counter() - start)
+
+    if setup is not None:
+        setup()
+    gc.collect()
+    tracemalloc.start()
+    function(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    record(name, min(times), peak / 1e6)
+
+
+def record(name: str, seconds: float, peak_mb: float):
+    """ Record a result and check it against its baseline, if any """
+    results[name] = {'seconds': seconds, 'peak_mb': peak_mb, 'years': YEARS}
+    reference = baseline.get(name)
+    if reference is None or reference['years'] != YEARS:
+        return
+    # small absolute margins for results close to zero
+    assert seconds <= reference['seconds'] * TIME_TOLERANCE + 0.05, (
+        name + ' took {:.3f} s, baseline {:.3f} s'.format(
+            seconds, reference['seconds']))
+    assert peak_mb <= reference['peak_mb'] * MEMORY_TOLERANCE + 1, (
+        name + ' used {:.1f} MB, baseline {:.1f} MB'.format(
+            peak_mb, reference['peak_mb']))
+
+
+@pytest.fixture(scope='session', autouse=True)
+def report():
+    """ Print the results, and save them if LOAD_BENCHMARK_OUTPUT is set """
+    yield
+    print('\n{:<44}{:>12}{:>12}'.format('benchmark', 'seconds', 'peak MB'))
+    for name, result in results.items():
+        print('{:<44}{:>12.3f}{:>12.1f}'.format(
+            name, result['seconds'], result['peak_mb']))
+    if OUTPUT is not None:
+        with open(OUTPUT, 'w') as f:
+            json.dump(results, f, indent=1)
+
+
+def monthly_times() -> pd.DatetimeIndex:
+    return pd.date_range(minyear, periods=12 * YEARS, freq='MS')
+
+
+def daily_times(year: int) -> pd.DatetimeIndex:
+    return pd.date_range(str(year), str(year) + '-12-31', freq='D')
+
+
+def gridded_ds(lat: np.array, lon: np.array, times, dims=('time', 'lat', 'lon')) -> xr.Dataset:
+    """ Returns a random precipitation Dataset """
+    rng = np.random.default_rng(0)
+    sizes = {'time': len(times), 'lat': len(lat), 'lon': len(lon)}
+    tp = rng.gamma(0.5, 4, [sizes[d] for d in dims])
+    return xr.Dataset({'tp': (dims, tp)},
+                      coords={'time': times, 'lat': lat, 'lon': lon})
+
+
+@pytest.fixture(scope='session')
+def gridded_dir(tmp_path_factory) -> str:
+    """ Preprocessed files read by the collect_* functions """
+    path = tmp_path_factory.mktemp('gridded')
+    for folder in ['APHRODITE', 'CRU', 'GPM', 'Bannister', 'Masks', 'ERA5',
+                   'bs_gauges']:
+        os.mkdir(path / folder)
+    lat = np.arange(25, 35, 0.25)
+    lon = np.arange(70, 85, 0.25)
+    times = monthly_times()
+
+    gridded_ds(np.arange(20, 42, 0.25), np.arange(60, 110, 0.25), times
+               ).to_netcdf(path / 'APHRODITE/aphrodite_hma_1951_2016.nc')
+    gridded_ds(lat, lon, times).to_netcdf(
+        path / 'CRU/interpolated_cru_1901-2019.nc')
+    gridded_ds(np.arange(25, 36, 0.25), lon, times).to_netcdf(
+        path / 'GPM/gpm_prtmi_1997-2015.nc')
+    for filename in ['Bannister_WRF_raw.nc', 'Bannister_WRF_corrected.nc']:
+        gridded_ds(lat, lon, times, dims=('time', 'lon', 'lat')).to_netcdf(
+            path / 'Bannister' / filename)
+
+    # Upper Indus mask on the ERA5 grid
+    overlap = ((lat[:, np.newaxis] > 31) & (lon[np.newaxis, :] < 80)) * 1.
+    xr.Dataset({'overlap': (('latitude', 'longitude'), overlap)},
+               coords={'latitude': lat, 'longitude': lon}
+               ).to_netcdf(path / 'Masks/ERA5_Upper_Indus_mask.nc')
+
+    # ERA5 CSV cache
+    era5_df = gridded_ds(lat, lon, times).to_dataframe().reset_index()
+    for var in ['z', 'd2m', 'tcwv', 'anor', 'slor', 'N34']:
+        era5_df[var] = np.random.default_rng(1).normal(size=len(era5_df))
+    era5_df.to_csv(path / 'ERA5/combi_data_indus_2022-11.csv')
+
+    # Beas and Sutlej gauges
+    pd.DataFrame({'station': stations, 'lat': [31.9, 31.8, 31.7],
+                  'lon': [77.1, 77.2, 77.4], 'elv': [1100, 950, 1300]}
+                 ).to_csv(path / 'bs_gauges/gauge_info.csv', index=False)
+    with pd.ExcelWriter(path / 'bs_gauges/RawGauge_BeasSutlej_.xlsx') as writer:
+        dates = pd.date_range(minyear, periods=365 * YEARS, freq='D')
+        for station in stations:
+            pd.DataFrame({'Date': dates,
+                          'tp': np.random.default_rng(2).gamma(0.5, 4, len(dates))}
+                         ).to_excel(writer, sheet_name=station, index=False)
+    return str(path) + '/'
+
+
+@pytest.fixture(scope='session')
+def raw_dir(tmp_path_factory) -> str:
+    """ Raw files read by the preprocessing functions """
+    path = tmp_path_factory.mktemp('raw')
+    old_path = path / 'APHRODITE/APHRO_MA_025deg_V1101.1951-2007.gz'
+    new_path = path / 'APHRODITE/APHRO_MA_025deg_V1101_EXR1'
+    gpm_path = path / 'GPM/PRTMI_1997-2015_TRMM3B43'
+    for folder in [old_path, new_path, gpm_path]:
+        os.makedirs(folder)
+
+    # Daily APHRODITE files, one per year, half of them in each version
+    lat = np.arange(18, 44, 0.25)
+    lon = np.arange(58, 112, 0.25)
+    for i in range(YEARS):
+        year = int(minyear) + i
+        ds = gridded_ds(lat, lon, daily_times(year)).rename({'tp': 'precip'})
+        if i < YEARS / 2:
+            ds = ds.rename({'lat': 'latitude', 'lon': 'longitude'})
+            ds.to_netcdf(old_path / ('APHRO_MA_025deg_V1101.' + str(year) + '.nc'))
+        else:
+            ds.to_netcdf(new_path / ('APHRO_MA_025deg_V1101_EXR1.' + str(year) + '.nc'))
+
+    # Monthly TRMM HDF5 files with the G2 precipitation rate
+    rng = np.random.default_rng(3)
+    for month in monthly_times():
+        filename = ('3A-MO.TRMM.PR.3PRTMI.' + month.strftime('%Y%m%d') +
+                    '-S000000-E235959.' + month.strftime('%m') + '.V07A.HDF5')
+        tp = np.zeros((1, 1440, 536), dtype='f4')
+        tp[0, 900:1080, 300:480] = rng.gamma(0.5, 0.2, (180, 180))
+        with h5py.File(gpm_path / filename, 'w') as f:
+            f.create_dataset('Grids/G2/estimSurfPrecipTotRateUn', data=tp,
+                             compression='gzip', chunks=(1, 360, 536))
+    return str(path) + '/'
+
+
+@pytest.fixture
+def gridded_data(gridded_dir, monkeypatch):
+    for module in [aphrodite, beas_sutlej_gauges, beas_sutlej_wrf, cru,
+                   era5, gpm, ls]:
+        monkeypatch.setattr(module, 'data_dir', gridded_dir)
+    return gridded_dir
+
+
+@pytest.fixture
+def raw_data(raw_dir, monkeypatch):
+    for module in [aphrodite, gpm]:
+        monkeypatch.setattr(module, 'data_dir', raw_dir)
+    return raw_dir
+
+
+@pytest.mark.parametrize('collect_function', [aphrodite.collect_APHRO,
+                                              cru.collect_CRU,
+                                              era5.collect_ERA5,
+                                              gpm.collect_GPM,
+                                              beas_sutlej_wrf.collect_WRF],
+                         ids=lambda f: f.__name__)
+def test_collect(gridded_data, collect_function):
+    def collect():
+        collect_function(location, minyear, maxyear).load()
+    measure(collect_function.__name__, collect)
+
+
+def test_collect_point(gridded_data):
+    def collect():
+        cru.collect_CRU((31.5, 77.5), minyear, maxyear).load()
+    measure('collect_CRU (point)', collect)
+
+
+def test_collect_point_store(gridded_data):
+    filepath = gridded_data + 'CRU/interpolated_cru_1901-2019.nc'
+    pointstore.build(filepath)
+
+    def collect():
+        cru.collect_CRU((31.5, 77.5), minyear, maxyear).load()
+    try:
+        measure('collect_CRU (point store)', collect)
+    finally:
+        for store_filepath in pointstore.store_filepaths(filepath):
+            os.remove(store_filepath)
+
+
+def test_download_data(gridded_data):
+    measure('era5.download_data (CSV cache)', era5.download_data, 'indus',
+            True)
+
+
+def test_apply_mask(gridded_data):
+    ds = xr.open_dataset(gridded_data + 'APHRODITE/aphrodite_hma_1951_2016.nc')
+    mask_filepath = ls.find_mask(location)
+    measure('location_sel.apply_mask', lambda: ls.apply_mask(
+        ds, mask_filepath).load())
+
+
+def test_gauge_download(gridded_data):
+    measure('beas_sutlej_gauges.gauge_download (XLSX)',
+            beas_sutlej_gauges.gauge_download, stations[0], minyear, maxyear)
+
+
+def test_interp(gridded_data):
+    rng = np.random.default_rng(4)
+    x, y = np.meshgrid(np.linspace(0, 1, 60), np.linspace(0, 1, 40),
+                       indexing='ij')
+    ds = xr.Dataset({'tp': (('time', 'x', 'y'),
+                            rng.gamma(0.5, 4, (12 * YEARS, 60, 40)))},
+                    coords={'time': monthly_times(),
+                            'lon': (('x', 'y'), 70 + 15 * x + y),
+                            'lat': (('x', 'y'), 25 + 10 * y - 0.5 * x)})
+    measure('beas_sutlej_wrf.interp', beas_sutlej_wrf.interp, ds)
+
+
+def test_merge_og_files(raw_data):
+    measure('aphrodite.merge_og_files', aphrodite.merge_og_files)
+
+
+def test_to_netcdf(raw_data):
+    out_filepath = raw_data + 'GPM/gpm_prtmi_1997-2015.nc'
+
+    def remove_output():
+        if os.path.exists(out_filepath):
+            os.remove(out_filepath)
+    measure('gpm.to_netcdf', gpm.to_netcdf, setup=remove_output)
+
+
+@pytest.mark.parametrize('module', ['load', 'load.aphrodite', 'load.cru',
+                                    'load.era5', 'load.gpm',
+                                    'load.beas_sutlej_wrf'])
+def test_import_time(module):
+    """ Cold import in a new interpreter, which must not load heavy_modules """
+    code = ('import sys, time, json\n'
+            'start = time.perf_counter()\n'
+            'import ' + module + '\n'
+            'seconds = time.perf_counter() - start\n'
+            'print(json.dumps([seconds, sorted(sys.modules)]))')
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [os.path.dirname(os.path.dirname(load.__file__)),
+         os.environ.get('PYTHONPATH', '')]))
+    times = []
+    for _ in range(REPEAT):
+        output = subprocess.run([sys.executable, '-c', code], env=env,
+                                check=True, capture_output=True, text=True)
+        seconds, modules = json.loads(output.stdout.splitlines()[-1])
+        times.append(seconds)
+    assert [m for m in heavy_modules if m in modules] == []
+    record('import ' + module, min(times), 0)
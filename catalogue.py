@@ -0,0 +1,146 @@
+"""
+Persistent catalogues of model output files.
+
+A catalogue maps every file in a directory to the fields parsed from its
+name (model, experiment, year range...). It is saved next to the directory,
+so that saving it does not change the directory itself, and only refreshed
+for added or removed files when the directory modification time changes.
+Files are then selected by year range with an interval tree.
+"""
+
+import os
+import json
+import threading
+import warnings
+
+
+CATALOGUE_SUFFIX = '.catalogue.json'
+
+# In-process cache of {directory: (mtime, keys, index)}
+_indices = {}
+
+
+class IntervalTree:
+    """
+    Static interval tree over closed (start, end, item) intervals.
+
+    The intervals are sorted by start and stored as an implicit balanced
+    tree, each node keeping the maximum end of its subtree, so that an
+    overlap query costs O(log n + k) for k matches.
+    """
+
+    def __init__(self, intervals: list):
+        self.intervals = sorted(intervals, key=lambda i: (i[0], i[1]))
+        self.max_end = [None] * len(self.intervals)
+        self._build(0, len(self.intervals))
+
+    def _build(self, lo: int, hi: int):
+        if lo >= hi:
+            return float('-inf')
+        mid = (lo + hi) // 2
+        self.max_end[mid] = max(self.intervals[mid][1],
+                                self._build(lo, mid),
+                                self._build(mid + 1, hi))
+        return self.max_end[mid]
+
+    def overlap(self, start, end) -> list:
+        """ Returns the items of all intervals overlapping [start, end], ordered by start """
+        items = []
+        self._query(0, len(self.intervals), start, end, items)
+        return items
+
+    def _query(self, lo: int, hi: int, start, end, items: list):
+        if lo >= hi:
+            return
+        mid = (lo + hi) // 2
+        if self.max_end[mid] < start:
+            return
+        self._query(lo, mid, start, end, items)
+        i_start, i_end, item = self.intervals[mid]
+        if i_start > end:
+            return
+        if i_end >= start:
+            items.append(item)
+        self._query(mid + 1, hi, start, end, items)
+
+    def __len__(self):
+        return len(self.intervals)
+
+
+def load_catalogue(directory: str, parse_filename) -> dict:
+    """
+    Return the catalogue of a directory, refreshing it if files were added
+    or removed since it was saved.
+
+    Args:
+        directory (str): directory of data files
+        parse_filename (function): returns a dictionary of fields (including
+            'minyear' and 'maxyear') for a filename, or None if the filename
+            cannot be parsed
+
+    Returns:
+        dict: {filename: fields} for all files that could be parsed
+    """
+    filepath = os.path.normpath(directory) + CATALOGUE_SUFFIX
+    mtime = os.stat(directory).st_mtime_ns
+
+    try:
+        with open(filepath) as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        saved = {'mtime': None, 'files': {}}
+
+    if saved['mtime'] != mtime:
+        filenames = set(os.listdir(directory))
+        files = {f: fields for f, fields in saved['files'].items()
+                 if f in filenames}
+        for f in filenames - set(files):
+            files[f] = parse_filename(f)
+            if files[f] is None:
+                warnings.warn('Could not parse filename: ' + f)
+        saved = {'mtime': mtime, 'files': files}
+        _save(filepath, saved)
+
+    return {f: fields for f, fields in saved['files'].items()
+            if fields is not None}
+
+
+def file_index(directory: str, parse_filename, keys: tuple) -> dict:
+    """
+    Return an interval tree of files by year range for each combination of
+    catalogue fields.
+
+    Args:
+        directory (str): directory of data files
+        parse_filename (function): see load_catalogue
+        keys (tuple): names of the fields to group files by
+
+    Returns:
+        dict: {tuple of field values: IntervalTree of filepaths}
+    """
+    mtime = os.stat(directory).st_mtime_ns
+    cached = _indices.get(directory)
+    if cached is not None and cached[:2] == (mtime, keys):
+        return cached[2]
+
+    groups = {}
+    for f, fields in load_catalogue(directory, parse_filename).items():
+        key = tuple(fields[k] for k in keys)
+        groups.setdefault(key, []).append(
+            (fields['minyear'], fields['maxyear'], os.path.join(directory, f)))
+    index = {key: IntervalTree(intervals) for key, intervals in groups.items()}
+
+    _indices[directory] = (mtime, keys, index)
+    return index
+
+
+def _save(filepath: str, catalogue: dict):
+    """ Atomically writes catalogue, skipping read-only data directories """
+    tmp_filepath = (filepath + '.' + str(os.getpid()) + '-' +
+                    str(threading.get_ident()) + '.tmp')
+    try:
+        with open(tmp_filepath, 'w') as f:
+            json.dump(catalogue, f)
+        os.replace(tmp_filepath, filepath)
+    except OSError:
+        pass
@@ -1,37 +1,161 @@
-import xarray as xr
+"""
+CMIP model output, found through a catalogue of the CMIP files in a local
+directory (see load.catalogue). Files follow the CMIP5 or CMIP6 naming
+convention, e.g. pr_Amon_HadCM3_historical_r1i1p1_195912-198411.nc
+
+Native precipitation values are in kg/m2/s.
+"""
+
+import os
 import numpy as np
-import datetime
+import xarray as xr
+
+import load.catalogue as cat
+import load.location_sel as ls
+from load.multifile import open_files
 from load import data_dir
 
-def collect_CMIP5():
-    """Download data from CMIP5."""
-    cmip_59_84_ds = xr.open_dataset(
-        "data/cmip5/pr_Amon_HadCM3_historical_r1i1p1_195912-198411.nc")
-    cmip_84_05_ds = xr.open_dataset(
-        "data/cmip5/pr_Amon_HadCM3_historical_r1i1p1_198412-200512.nc")
-    cmip_ds = cmip_84_05_ds.merge(cmip_59_84_ds)  # in kg/m2/s
-    cmip_ds = cmip_ds.assign_attrs(plot_legend="HadCM3 historical")
-    cmip_ds = cmip_ds.rename({'pr': 'tp'})
-    cmip_ds['tp'] *= 60 * 60 * 24  # to mm/day
-    cmip_ds['time'] = standardised_time(cmip_ds)
+RUN_KEYS = ('variable', 'table', 'model', 'experiment', 'member', 'grid')
+
+
+def collect_CMIP(location: str or tuple, minyear: str, maxyear: str, model: str, experiment: str, member='r1i1p1', variable='pr', table='Amon', grid=None, path=None) -> xr.Dataset:
+    """
+    Load CMIP data for a given model run. The files are subset to the
+    location and years when they are opened, so only data over the
+    location is read.
+
+    Args:
+        location (str or tuple): location string or lat/lon coordinate
+            tuple, None for the whole globe
+        minyear (str): start date in years, None for the start of the run
+        maxyear (str): end date in years (inclusive), None for the end of the run
+        model (str): model name, e.g. 'HadCM3'
+        experiment (str): experiment name, e.g. 'historical'
+        member (str, optional): ensemble member. Defaults to 'r1i1p1'.
+        variable (str, optional): CMIP variable name. Defaults to 'pr'.
+        table (str, optional): CMIP table name. Defaults to 'Amon'.
+        grid (str, optional): CMIP6 grid label, e.g. 'gn' or 'gr'. Needed
+            only when a run has files on several grids. Defaults to None.
+        path (str, optional): directory of CMIP files. Defaults to data_dir + 'CMIP5/'.
+
+    Returns:
+        xr.Dataset: CMIP data
+    """
+    if path is None:
+        path = data_dir + 'CMIP5/'
+    key = select_run(path, variable, table, model, experiment, member, grid)
+    file_list = cat.file_index(path, parse_filename, keys=RUN_KEYS)[key].overlap(
+        -np.inf if minyear is None else int(minyear),
+        np.inf if maxyear is None else int(maxyear))
+
+    def _subset(ds):
+        if location is None:
+            return ds
+        if type(location) == str:
+            latmax, lonmin, latmin, lonmax = ls.basin_extent(
+                ls.basin_finder(location))
+            return subset_extent(ds, latmin, latmax, lonmin, lonmax)
+        lat, lon = location
+        return subset_extent(ds, lat, lat, lon, lon)
+
+    cmip_ds = open_files(file_list, minyear, maxyear, preprocess=_subset,
+                         month_start=table.endswith('mon'))
+    cmip_ds = cmip_ds.assign_attrs(plot_legend=model + " " + experiment)
+
+    if variable == 'pr':
+        cmip_ds = cmip_ds.rename({'pr': 'tp'})
+        cmip_ds['tp'] *= 60 * 60 * 24  # to mm/day
+
+    if type(location) == str:
+        cmip_ds = ls.select_basin(cmip_ds, location)
+    elif location is not None:
+        lat, lon = location
+        cmip_ds = cmip_ds.interp(coords={"lon": lon, "lat": lat},
+                                 method="nearest")
     return cmip_ds
 
 
-def standardised_time(dataset: xr.DataArray) -> np.array:
+def collect_CMIP5(location=None, minyear=None, maxyear=None) -> xr.Dataset:
+    """ Load data from the HadCM3 historical run of CMIP5. """
+    return collect_CMIP(location, minyear, maxyear, model='HadCM3',
+                        experiment='historical', member='r1i1p1')
+
+
+def select_run(path: str, variable: str, table: str, model: str, experiment: str, member: str, grid: str = None) -> tuple:
     """
-    Return array of standardised times to plot.
+    Return the catalogue key of a run's files, i.e. the run's fields and
+    grid label. Files on different grids are never mixed.
 
     Args:
-        dataset (xr.DataArray): 
+        path (str): directory of CMIP files
+        variable (str): CMIP variable name
+        table (str): CMIP table name
+        model (str): model name
+        experiment (str): experiment name
+        member (str): ensemble member
+        grid (str, optional): grid label, any grid if None. Defaults to None.
 
     Returns:
-        np.array: standardised time values
-    """
-    try:
-        utime = dataset.time.values.astype(int)/(1e9 * 60 * 60 * 24 * 365)
-    except Exception:
-        time = np.array([d.strftime() for d in dataset.time.values])
-        time2 = np.array([datetime.datetime.strptime(
-            d, "%Y-%m-%d %H:%M:%S") for d in time])
-        utime = np.array([d.timestamp() for d in time2]) / (60 * 60 * 24 * 365)
-    return (utime + 1970)
+        tuple: (variable, table, model, experiment, member, grid)
+    """
+    index = cat.file_index(path, parse_filename, keys=RUN_KEYS)
+    run = (variable, table, model, experiment, member)
+    keys = [k for k in index if k[:5] == run and (grid is None or k[5] == grid)]
+    if len(keys) == 0:
+        raise OSError('No CMIP files for ' + ' '.join(run) + ' in ' + path)
+    if len(keys) > 1:
+        raise ValueError('CMIP files for ' + ' '.join(run) + ' on several grids: ' +
+                         ', '.join(str(k[5]) for k in keys) + ', choose a grid')
+    return keys[0]
+
+
+def subset_extent(ds: xr.Dataset, latmin: float, latmax: float, lonmin: float, lonmax: float) -> xr.Dataset:
+    """
+    Lazily select the grid cells covering an extent, with a margin of one
+    grid cell so the data can still be interpolated at the edges. Longitudes
+    are returned in °E between -180 and 180.
+
+    Args:
+        ds (xr.Dataset): data on a regular lat/lon grid
+        latmin (float): minimum latitude in °N
+        latmax (float): maximum latitude in °N
+        lonmin (float): minimum longitude in °E
+        lonmax (float): maximum longitude in °E
+
+    Returns:
+        xr.Dataset: data over the extent
+    """
+    lat = ds.lat.values
+    lon = (ds.lon.values + 180) % 360 - 180
+    dlat = np.abs(np.diff(lat)).max()
+    dlon = np.abs(np.diff(np.sort(lon))).max()
+
+    lat_index = np.nonzero((lat >= latmin - dlat) & (lat <= latmax + dlat))[0]
+    lon_index = np.nonzero((lon >= lonmin - dlon) & (lon <= lonmax + dlon))[0]
+    lon_index = lon_index[np.argsort(lon[lon_index])]
+
+    subset_ds = ds.isel(lat=lat_index, lon=lon_index)
+    return subset_ds.assign_coords(lon=lon[lon_index])
+
+
+def parse_filename(filename: str) -> dict:
+    """
+    Return the fields of a CMIP5 or CMIP6 filename.
+
+    Args:
+        filename (str): CMIP filename
+
+    Returns:
+        dict: filename fields, or None if the filename does not follow the
+            CMIP naming convention or has no time range (fixed fields)
+    """
+    parts = os.path.splitext(filename)[0].split('_')
+    if len(parts) not in [6, 7]:
+        return None
+    period = parts[-1].split('-')
+    if len(period) != 2 or not all(p[:4].isdigit() for p in period):
+        return None
+    return {'variable': parts[0], 'table': parts[1], 'model': parts[2],
+            'experiment': parts[3], 'member': parts[4],
+            'grid': parts[5] if len(parts) == 7 else None,
+            'minyear': int(period[0][:4]), 'maxyear': int(period[1][:4])}
@@ -0,0 +1,129 @@
+"""
+Co-location of gridded datasets with stations, e.g. to build gauge vs
+reanalysis training tables.
+
+The value of every source at every station's grid cell is gathered with one
+vectorised index lookup per source, and the results are returned as one
+long table indexed by (station, time), with the station metadata repeated
+on each row. Gauge observations indexed the same way can then be joined
+directly.
+"""
+
+import importlib
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from load.dispatch import COLLECT_FUNCTIONS
+from load.gmted2010 import nearest_index
+from load import data_dir
+
+
+def station_table(network: str = 'beas_sutlej') -> pd.DataFrame:
+    """
+    Return station coordinates and metadata.
+
+    Args:
+        network (str, optional): 'beas_sutlej' or 'value'. Defaults to 'beas_sutlej'.
+
+    Returns:
+        pd.DataFrame: stations indexed by name, with 'lat', 'lon' and 'z' columns
+    """
+    if network == 'beas_sutlej':
+        df = pd.read_csv(data_dir + 'bs_gauges/gauge_info.csv',
+                         index_col='station')
+        return df.rename(columns={'elv': 'z'})
+    if network == 'value':
+        df = pd.read_csv(data_dir + 'VALUE_ECA_86_v2/stations.txt',
+                         sep='\t', lineterminator='\r', index_col='name')
+        df.index = df.index.str.strip()
+        return df.rename(columns={'longitude': 'lon', 'latitude': 'lat',
+                                  'altitude': 'z'})
+    raise ValueError('Unknown station network: ' + network)
+
+
+def colocate(stations: pd.DataFrame, sources: list or dict, minyear: str = None, maxyear: str = None, variable: str = 'tp') -> pd.DataFrame:
+    """
+    Return the values of gridded sources at the stations' grid cells.
+
+    Args:
+        stations (pd.DataFrame): stations indexed by name with 'lat' and
+            'lon' columns, other columns are kept as metadata
+        sources (list or dict): dataset names, keys of
+            dispatch.COLLECT_FUNCTIONS, loaded over the Indus, or
+            {name: xr.Dataset}
+        minyear (str, optional): start date in years, for dataset names
+        maxyear (str, optional): end date in years, for dataset names
+        variable (str, optional): variable to extract. Defaults to 'tp'.
+
+    Returns:
+        pd.DataFrame: one column per source and per metadata column,
+            indexed by (station, time). Stations outside a source's grid
+            get NaNs.
+    """
+    if not isinstance(sources, dict):
+        sources = {name: _collect(name, minyear, maxyear) for name in sources}
+
+    lat = stations['lat'].values.astype(float)
+    lon = stations['lon'].values.astype(float)
+
+    series = {}
+    for name, ds in sources.items():
+        times, values = station_values(ds[variable], lat, lon)
+        series[name] = pd.DataFrame(values, index=times)
+
+    times = pd.DatetimeIndex(np.unique(np.concatenate(
+        [s.index.values for s in series.values()])), name='time')
+    index = pd.MultiIndex.from_product([stations.index, times],
+                                       names=['station', 'time'])
+
+    columns = {}
+    for name, df in series.items():
+        # (time, station) -> station-major column matching the index
+        columns[name] = df.reindex(times).values.T.ravel()
+    for column in stations.columns:
+        columns[column] = np.repeat(stations[column].values, len(times))
+    return pd.DataFrame(columns, index=index)
+
+
+def station_values(da: xr.DataArray, lat: np.array, lon: np.array) -> tuple:
+    """
+    Gather the time series of the grid cells containing given points.
+
+    Args:
+        da (xr.DataArray): data with 'time', 'lat' and 'lon' dimensions
+        lat (np.array): point latitudes in °N
+        lon (np.array): point longitudes in °E
+
+    Returns:
+        tuple: datetime64 times, values with shape (time, point)
+    """
+    grid_lat = da.lat.values
+    grid_lon = da.lon.values
+    lat_index = nearest_index(grid_lat, lat)
+    lon_index = nearest_index(grid_lon, lon)
+
+    points_da = da.isel(lat=xr.DataArray(lat_index, dims='point'),
+                        lon=xr.DataArray(lon_index, dims='point'))
+    values = points_da.transpose('time', 'point').values.astype(float)
+    values[:, ~(_inside(grid_lat, lat) & _inside(grid_lon, lon))] = np.nan
+
+    times = da.time.values
+    if times.dtype.kind != 'M':
+        times = pd.to_datetime(times).values
+    return times, values
+
+
+def _inside(coord: np.array, values: np.array) -> np.array:
+    """ Returns whether values fall within the cells of a regular coordinate """
+    half_step = np.abs(np.diff(coord)).max() / 2 if len(coord) > 1 else 0
+    return (values >= coord.min() - half_step) & (values <= coord.max() + half_step)
+
+
+def _collect(name: str, minyear: str, maxyear: str) -> xr.Dataset:
+    """ Loads a dataset over the Indus """
+    module_name, function_name = COLLECT_FUNCTIONS[name]
+    collect_function = getattr(importlib.import_module(module_name),
+                               function_name)
+    return collect_function('indus', minyear, maxyear)
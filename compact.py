@@ -0,0 +1,92 @@
+"""
+Opt-in compact dtype mode.
+
+Precipitation in mm/day and the covariates do not need float64. In compact
+mode:
+- the collect functions return float32 data variables, and float32
+  coordinates where the values are exactly representable (e.g. 0.25° grids)
+- the ERA5 CSV cache is read as float32
+- preprocessed NetCDF files are written as int16 with a scale factor and
+  offset per variable
+
+Compact mode is switched on with `set_compact()` or by setting the
+LOAD_COMPACT environment variable. It is off by default, in which case the
+functions below return their inputs unchanged.
+"""
+
+import os
+import numpy as np
+
+PACKED_FILL_VALUE = np.iinfo('int16').min
+
+_compact = os.environ.get('LOAD_COMPACT', '0') not in ('', '0')
+
+
+def set_compact(enabled: bool = True):
+    """ Switch compact mode on or off """
+    global _compact
+    _compact = enabled
+
+
+def is_compact() -> bool:
+    return _compact
+
+
+def compact_dataset(ds):
+    """
+    Returns a Dataset with float64 data variables as float32, and float64
+    coordinates as float32 when no value changes, in compact mode.
+    """
+    if not _compact:
+        return ds
+    data_vars = {name: da.astype('float32') for name, da in ds.data_vars.items()
+                 if da.dtype == np.float64}
+    coords = {}
+    for name, coord in ds.coords.items():
+        if coord.dtype == np.float64:
+            values = coord.values
+            if np.array_equal(values.astype('float32').astype('float64'),
+                              values, equal_nan=True):
+                coords[name] = coord.astype('float32')
+    return ds.assign(data_vars).assign_coords(coords)
+
+
+def compact_dataframe(df):
+    """ Returns a DataFrame with float64 columns as float32, in compact mode """
+    if not _compact:
+        return df
+    float_columns = df.select_dtypes('float64').columns
+    return df.astype({column: 'float32' for column in float_columns})
+
+
+def csv_dtypes(columns: list, exclude: tuple = ('time', 'Unnamed: 0')) -> dict:
+    """ Returns pd.read_csv dtypes reading numeric columns as float32, in compact mode """
+    if not _compact:
+        return None
+    return {column: 'float32' for column in columns if column not in exclude}
+
+
+def netcdf_encoding(ds) -> dict:
+    """
+    Returns a to_netcdf encoding storing the float data variables as int16
+    with a scale factor and offset spanning their range, in compact mode.
+    """
+    if not _compact:
+        return None
+    encoding = {}
+    for name, da in ds.data_vars.items():
+        if da.dtype.kind != 'f':
+            continue
+        vmin, vmax = float(da.min()), float(da.max())
+        if np.isnan(vmin):
+            vmin, vmax = 0., 0.
+        # packed values from -32766 to 32766, leaving room for rounding of
+        # the float32 packing attributes; -32768 is the fill value
+        scale_factor = (vmax - vmin) / 65532 if vmax > vmin else 1.
+        # float32 packing attributes, so that the values decode as float32
+        encoding[name] = {'dtype': 'int16',
+                          'scale_factor': np.float32(scale_factor),
+                          'add_offset': np.float32(vmin + 32766 * scale_factor),
+                          '_FillValue': PACKED_FILL_VALUE,
+                          'zlib': True}
+    return encoding
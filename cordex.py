@@ -1,7 +1,11 @@
-import xarray as xr
+import os
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import datetime
-import glob
+import xarray as xr
+
+import load.catalogue as cat
+from load.multifile import open_files
 from load import data_dir
 
 
@@ -12,7 +16,7 @@ def collect_CORDEX(domain: str, minyear: str, maxyear: str, experiment: str, rcm
     Args:
         domain (str): CORDEX domain (EAS or WAS)
         minyear (str): minimum year of data
-        maxyear (str): maximum year of data (exclusive)
+        maxyear (str): maximum year of data (inclusive)
         experiment (str): experiment name
         rcm_model (str): RCM model name
         gcm_model (str): GCM model name
@@ -22,43 +26,203 @@ def collect_CORDEX(domain: str, minyear: str, maxyear: str, experiment: str, rcm
         xr.DataArray: output CORDEX data
     """
 
-    # generate list of files
+    # select files overlapping the requested years from the catalogue
     path = data_dir + "CORDEX/" + domain + "/" + freq + "/" + experiment + "/"
-    all_files = glob.glob(path+'*')
+    file_list = select_files(path, experiment, gcm_model, rcm_model,
+                             int(minyear), int(maxyear))
 
-    # sort files
-    file_list = []
-    for f in all_files:
-        try:
-            f_minyear = f.split("_")[-1].split('-')[-2][:4]
-            f_maxyear = f.split("_")[-1].split('-')[-1][:4]
-        except:
-            print(f)
-
-        if experiment in f:
-            #print(experiment)
-            if gcm_model in f:
-                #print(gcm_model)
-                if rcm_model in f:
-                    #print(rcm_model)
-                    if int(f_maxyear) > int(minyear):
-                        if int(f_minyear) < int(maxyear):
-                            file_list.append(f)
-
-    # load data
-    ds_list = []
-    for f in file_list:
-        ds = xr.open_dataset(f)
-        ds['time'] = ds['time'].astype('datetime64[M]')
-        ds_list.append(ds)
-
-    # concatenate data
-    cordex_ds = xr.concat(ds_list, 'time')
-    cordex_ds = cordex_ds.sortby('time')
+    # lazily open and slice the files, nothing is read until used
+    cordex_ds = open_files(file_list, minyear, maxyear,
+                           month_start=(freq == 'mon'))
     cordex_ds = cordex_ds.assign_attrs(
         plot_legend="CORDEX " + domain + " " + gcm_model + " " + rcm_model + " " + experiment,)
     cordex_ds = cordex_ds.rename_vars({'pr': 'tp'})
     cordex_ds['tp'] *= 86400   # to mm/day
-    sliced_cordex_ds = cordex_ds.sel(time=slice(minyear, maxyear))
 
-    return  sliced_cordex_ds
+    return cordex_ds
+
+
+def collect_CORDEX_ensemble(domain: str, minyear: str, maxyear: str, experiments: list, rcm_models: list, gcm_models: list, freq='mon', lat=None, lon=None, max_workers=8) -> xr.Dataset:
+    """
+    Collect several CORDEX GCM/RCM/experiment combinations concurrently and
+    combine them along a 'model' dimension on a common grid. The members
+    are lazy, so the ensemble is only read when it is used.
+
+    Args:
+        domain (str): CORDEX domain (EAS or WAS)
+        minyear (str): minimum year of data
+        maxyear (str): maximum year of data (inclusive)
+        experiments (list): experiment names
+        rcm_models (list): RCM model names
+        gcm_models (list): GCM model names
+        freq (str): frequency of data (mon or day)
+        lat (np.array, optional): common grid latitudes. Defaults to the 0.25° Indus grid.
+        lon (np.array, optional): common grid longitudes. Defaults to the 0.25° Indus grid.
+        max_workers (int, optional): number of members loaded concurrently. Defaults to 8.
+
+    Returns:
+        xr.Dataset: CORDEX ensemble with a 'model' dimension
+    """
+    if lat is None:
+        lat = np.arange(25, 35, 0.25)
+    if lon is None:
+        lon = np.arange(70, 85, 0.25)
+
+    def _collect_member(combination):
+        experiment, gcm_model, rcm_model = combination
+        try:
+            ds = collect_CORDEX(domain, minyear, maxyear, experiment,
+                                rcm_model, gcm_model, freq=freq)
+        except OSError:
+            warnings.warn('No CORDEX files for ' + ' '.join(combination))
+            return None
+        member_ds = regrid(ds[['tp']], lat, lon)
+        model = gcm_model + ' ' + rcm_model + ' ' + experiment
+        return member_ds.expand_dims(model=[model])
+
+    combinations = [(e, g, r) for e in experiments
+                    for g in gcm_models for r in rcm_models]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        members = [m for m in executor.map(_collect_member, combinations)
+                   if m is not None]
+
+    if len(members) == 0:
+        raise OSError('No CORDEX files for any of the GCMs ' + str(gcm_models) +
+                      ' and RCMs ' + str(rcm_models) + ' in experiments ' +
+                      str(experiments) + ' (' + domain + ', ' + freq + ')')
+    ensemble_ds = xr.concat(members, 'model', join='outer')
+    ensemble_ds = ensemble_ds.assign_attrs(
+        plot_legend="CORDEX " + domain + " ensemble")
+    return ensemble_ds
+
+
+def ensemble_stats(ensemble_ds: xr.Dataset, percentiles=(10, 50, 90)) -> xr.Dataset:
+    """
+    Return the ensemble mean, spread (standard deviation) and percentiles
+    across models. The statistics are computed lazily chunk by chunk, so
+    the members are never all held in memory.
+
+    Args:
+        ensemble_ds (xr.Dataset): ensemble from collect_CORDEX_ensemble
+        percentiles (tuple, optional): percentiles to compute. Defaults to (10, 50, 90).
+
+    Returns:
+        xr.Dataset: ensemble statistics
+    """
+    tp = ensemble_ds.tp.chunk({'model': -1})
+    quantiles = tp.quantile(np.array(percentiles) / 100, dim='model')
+    quantiles = quantiles.rename(quantile='percentile')
+    quantiles = quantiles.assign_coords(percentile=list(percentiles))
+    stats_ds = xr.Dataset({'tp_mean': tp.mean('model'),
+                           'tp_spread': tp.std('model'),
+                           'tp_percentile': quantiles})
+    return stats_ds.assign_attrs(ensemble_ds.attrs)
+
+
+def regrid(ds: xr.Dataset, lat: np.array, lon: np.array, max_distance=0.5) -> xr.Dataset:
+    """
+    Lazily regrid CORDEX data to a regular grid by nearest neighbour. Works
+    for regular lat/lon grids and for curvilinear (rotated pole) grids with
+    2D lat/lon coordinates.
+
+    Args:
+        ds (xr.Dataset): CORDEX data
+        lat (np.array): target latitudes
+        lon (np.array): target longitudes
+        max_distance (float, optional): maximum distance in degrees to the
+            nearest source cell, further cells are NaN, on either kind of
+            grid. Defaults to 0.5.
+
+    Returns:
+        xr.Dataset: regridded data
+    """
+    if 'lat' in ds.dims and 'lon' in ds.dims:
+        regridded_ds = ds.interp(lat=lat, lon=lon, method='nearest')
+        distance = np.hypot(*np.meshgrid(_axis_distance(ds.lat.values, lat),
+                                         _axis_distance(ds.lon.values, lon),
+                                         indexing='ij'))
+        near = xr.DataArray(distance <= max_distance, dims=('lat', 'lon'))
+        return regridded_ds.where(near)
+
+    from scipy.spatial import cKDTree
+
+    y_dim, x_dim = ds.lat.dims
+    src_points = np.column_stack((ds.lat.values.ravel(), ds.lon.values.ravel()))
+    grid_lat, grid_lon = np.meshgrid(lat, lon, indexing='ij')
+    distance, flat_index = cKDTree(src_points).query(
+        np.column_stack((grid_lat.ravel(), grid_lon.ravel())))
+    y_index, x_index = np.unravel_index(flat_index, ds.lat.shape)
+
+    ds = ds.drop_vars([c for c in ds.coords if c != 'time'])
+    regridded_ds = ds.isel({
+        y_dim: xr.DataArray(y_index.reshape(grid_lat.shape), dims=('lat', 'lon')),
+        x_dim: xr.DataArray(x_index.reshape(grid_lat.shape), dims=('lat', 'lon'))})
+    regridded_ds = regridded_ds.assign_coords(lat=lat, lon=lon)
+    near = xr.DataArray(distance.reshape(grid_lat.shape) <= max_distance,
+                        dims=('lat', 'lon'))
+    return regridded_ds.where(near)
+
+
+def _axis_distance(source: np.array, target: np.array) -> np.array:
+    """ Returns the distance from each target value to the nearest source value """
+    source = np.sort(source)
+    pos = np.clip(np.searchsorted(source, target), 1, max(len(source) - 1, 1))
+    return np.minimum(np.abs(target - source[pos - 1]),
+                      np.abs(source[np.minimum(pos, len(source) - 1)] - target))
+
+
+def select_files(path: str, experiment: str, gcm_model: str, rcm_model: str, minyear: int, maxyear: int) -> list:
+    """
+    Return the CORDEX files in a directory overlapping the given years.
+    Model names are matched exactly, or else as substrings of the names in
+    the filenames (e.g. 'EC-EARTH' for 'ICHEC-EC-EARTH'), as long as they
+    match a single experiment/GCM/RCM combination.
+
+    Args:
+        path (str): directory of CORDEX files
+        experiment (str): experiment name
+        gcm_model (str): GCM model name
+        rcm_model (str): RCM model name
+        minyear (int): minimum year of data
+        maxyear (int): maximum year of data (inclusive)
+
+    Returns:
+        list: filepaths ordered by start date
+    """
+    index = cat.file_index(path, parse_filename,
+                           keys=('experiment', 'gcm', 'rcm'))
+    key = (experiment, gcm_model, rcm_model)
+    if key not in index:
+        keys = [k for k in index if experiment in k[0]
+                and gcm_model in k[1] and rcm_model in k[2]]
+        if len(keys) > 1:
+            raise ValueError('Ambiguous CORDEX models ' + str(key) +
+                             ', matching: ' + str(sorted(keys)))
+        if len(keys) == 0:
+            return []
+        key = keys[0]
+    return index[key].overlap(minyear, maxyear)
+
+
+def parse_filename(filename: str) -> dict:
+    """
+    Return the fields of a CORDEX filename, e.g.
+    pr_WAS-44_ICHEC-EC-EARTH_historical_r12i1p1_SMHI-RCA4_v1_mon_195101-195512.nc
+
+    Args:
+        filename (str): CORDEX filename
+
+    Returns:
+        dict: filename fields, or None if the filename does not follow the
+            CORDEX naming convention
+    """
+    parts = os.path.splitext(filename)[0].split('_')
+    if len(parts) != 9:
+        return None
+    period = parts[8].split('-')
+    if len(period) != 2 or not all(p[:4].isdigit() for p in period):
+        return None
+    return {'variable': parts[0], 'domain': parts[1], 'gcm': parts[2],
+            'experiment': parts[3], 'ensemble': parts[4], 'rcm': parts[5],
+            'rcm_version': parts[6], 'freq': parts[7],
+            'minyear': int(period[0][:4]), 'maxyear': int(period[1][:4])}
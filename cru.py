@@ -2,16 +2,20 @@
 CRU dataset
 """
 
-import datetime
 import xarray as xr
 import numpy as np
 
 
 import load.location_sel as ls
+import load.pointstore as pointstore
+from load.instrument import stage
+from load.memo import memoize
+from load.compact import compact_dataset, netcdf_encoding
 from load import data_dir
 
 
-def collect_CRU(location: str or tuple, minyear: str, maxyear: str) -> xr.DataArray:
+@memoize(lambda args: [data_dir + "CRU/interpolated_cru_1901-2019.nc"])
+def collect_CRU(location: str or tuple, minyear: str, maxyear: str, from_cube=False) -> xr.DataArray:
     """
     Download interpolated data from CRU model.
 
@@ -19,22 +23,36 @@ def collect_CRU(location: str or tuple, minyear: str, maxyear: str) -> xr.DataAr
         location (str or tuple): location string or lat/lon coordinate tuple
         minyear (float): start date in years
         maxyear (float): end date in years
+        from_cube (bool, optional): read from the common-grid cube, see
+            cube.build_cube. Defaults to False.
 
     Returns:
         xr.DataArray: Interpolated CRU data
     """
-    cru_ds = xr.open_dataset(data_dir + "CRU/interpolated_cru_1901-2019.nc")
+    if from_cube:
+        import load.cube as cube
+        ds = cube.collect('cru', location, minyear, maxyear)
+        return compact_dataset(ds.assign_attrs(plot_legend="CRU"))
+
+    filepath = data_dir + "CRU/interpolated_cru_1901-2019.nc"
+    with stage('open', filepath=filepath):
+        cru_ds = xr.open_dataset(filepath)
 
     if type(location) == str:
         loc_ds = ls.select_basin(cru_ds, location)
     else:
         lat, lon = location
-        loc_ds = cru_ds.interp(
-            coords={"lon": lon, "lat": lat}, method="nearest")
-
-    tim_ds = loc_ds.sel(time=slice(minyear, maxyear))
+        with stage('interp', location=location):
+            if pointstore.is_current(filepath):
+                loc_ds = pointstore.point_series(filepath, lat, lon)
+            else:
+                loc_ds = cru_ds.interp(
+                    coords={"lon": lon, "lat": lat}, method="nearest")
+
+    with stage('slice', minyear=minyear, maxyear=maxyear):
+        tim_ds = loc_ds.sel(time=slice(minyear, maxyear))
     ds = tim_ds.assign_attrs(plot_legend="CRU")  # in mm/month
-    return ds
+    return compact_dataset(ds)
 
 
 def download():
@@ -61,27 +79,9 @@ def download():
     da = da_cropped.rename_vars({'pre': 'tp'})
     x = np.arange(70, 85, 0.25)
     y = np.arange(25, 35, 0.25)
-    interp_da = da.interp(lon=x, lat=y, method="nearest")
-    interp_da.to_netcdf(data_dir + "CRU/interpolated_cru_1901-2019.nc")
-
-
-def standardised_time(dataset: xr.DataArray) -> np.array:
-    """
-    FOR ARCHIVE ONLY - DO NOT USE
-
-    Return array of standardised times to plot.
-
-    Args:
-        dataset (xr.DataArray):
-
-    Returns:
-        np.array: standardised time values
-    """
-    try:
-        utime = dataset.time.values.astype(int)/(1e9 * 60 * 60 * 24 * 365)
-    except Exception:
-        time = np.array([d.strftime() for d in dataset.time.values])
-        time2 = np.array([datetime.datetime.strptime(
-            d, "%Y-%m-%d %H:%M:%S") for d in time])
-        utime = np.array([d.timestamp() for d in time2]) / (60 * 60 * 24 * 365)
-    return (utime + 1970)
+    with stage('interp'):
+        interp_da = da.interp(lon=x, lat=y, method="nearest")
+    out_filepath = data_dir + "CRU/interpolated_cru_1901-2019.nc"
+    with stage('write', filepath=out_filepath):
+        interp_da.to_netcdf(out_filepath, encoding=netcdf_encoding(interp_da))
+    pointstore.build(out_filepath)
@@ -0,0 +1,138 @@
+"""
+Analysis-ready cube of the gridded precipitation datasets.
+
+The datasets are regridded once onto the common 0.25° Indus grid (the grid
+of the interpolated CRU and WRF files) and a shared monthly time axis, and
+written as one Zarr store with a variable per source, in mm/day, and a
+variable per basin mask. Two copies are kept with different chunk layouts:
+- 'time': whole time series in each chunk, for point and basin series
+- 'space': whole grid in each chunk, for maps
+"""
+
+import os
+import shutil
+import importlib
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+import load.location_sel as ls
+from load.dispatch import COLLECT_FUNCTIONS
+from load.time_encoding import to_month_start
+from load import data_dir
+
+CUBE_LAT = np.arange(25, 35, 0.25)
+CUBE_LON = np.arange(70, 85, 0.25)
+CUBE_CHUNKS = {'time': {'time': -1, 'lat': 8, 'lon': 8},
+               'space': {'time': 12, 'lat': -1, 'lon': -1}}
+MASK_LOCATIONS = ['ngari', 'khyber', 'gilgit', 'uib', 'sutlej', 'beas',
+                  'beas_sutlej']
+
+
+def build_cube(minyear: str, maxyear: str, sources: list = None):
+    """
+    Regrid the datasets and write both cube layouts.
+
+    Args:
+        minyear (str): first year of the time axis
+        maxyear (str): last year of the time axis
+        sources (list, optional): dataset names, keys of
+            dispatch.COLLECT_FUNCTIONS. Defaults to all of them.
+    """
+    if sources is None:
+        sources = list(COLLECT_FUNCTIONS)
+    times = pd.date_range(str(minyear), str(maxyear) + '-12-01', freq='MS')
+
+    cube_ds = xr.Dataset(coords={'time': times, 'lat': CUBE_LAT,
+                                 'lon': CUBE_LON})
+    for source in sources:
+        module_name, function_name = COLLECT_FUNCTIONS[source]
+        collect_function = getattr(importlib.import_module(module_name),
+                                   function_name)
+        ds = collect_function('indus', str(minyear), str(maxyear))
+        cube_ds[source] = regrid(ds.tp, times)
+        cube_ds[source].attrs.update(units='mm/day',
+                                     plot_legend=ds.attrs.get('plot_legend', source))
+
+    for location in MASK_LOCATIONS:
+        mask_filepath = ls.find_mask(location)
+        if mask_filepath is not None and os.path.exists(mask_filepath):
+            cube_ds['mask_' + location] = regrid_mask(mask_filepath)
+
+    for layout, chunks in CUBE_CHUNKS.items():
+        _write(cube_ds.chunk(chunks), cube_filepath(layout))
+
+
+def regrid(da: xr.DataArray, times: pd.DatetimeIndex) -> xr.DataArray:
+    """ Returns float32 data at month starts on the cube grid (nearest neighbour) """
+    time_values = da.time.values
+    if time_values.dtype.kind not in 'Mm' and isinstance(time_values[0], str):
+        time_values = pd.to_datetime(time_values).values
+    da = da.assign_coords(time=to_month_start(time_values))
+    da = da.interp(lat=CUBE_LAT, lon=CUBE_LON, method='nearest')
+    da = da.reindex(time=times).transpose('time', 'lat', 'lon')
+    return da.astype('float32').drop_vars(
+        [c for c in da.coords if c not in ('time', 'lat', 'lon')])
+
+
+def regrid_mask(mask_filepath: str) -> xr.DataArray:
+    """ Returns a basin mask on the cube grid, 1 inside and 0 outside """
+    with xr.open_dataset(mask_filepath) as mask:
+        if 'latitude' in list(mask.dims):
+            mask = mask.rename({'latitude': 'lat', 'longitude': 'lon'})
+        overlap = mask.overlap.interp(lat=CUBE_LAT, lon=CUBE_LON,
+                                      method='nearest').load()
+    return (overlap.fillna(0) > 0).astype('int8')
+
+
+def cube_filepath(layout: str) -> str:
+    return data_dir + 'Cube/indus_025deg_' + layout + '.zarr'
+
+
+def open_cube(layout: str = 'time') -> xr.Dataset:
+    """ Open a cube layout, 'time' or 'space' """
+    return xr.open_zarr(cube_filepath(layout))
+
+
+def collect(source: str, location: str or tuple, minyear: str, maxyear: str, layout: str = None) -> xr.Dataset:
+    """
+    Load a dataset from the cube, in the same format as its collect function.
+
+    Args:
+        source (str): dataset name, e.g. 'aphrodite'
+        location (str or tuple): location string or lat/lon coordinate tuple
+        minyear (str): start date in years
+        maxyear (str): end date in years
+        layout (str, optional): cube layout to read. Defaults to 'space'
+            for locations without a mask and 'time' otherwise.
+
+    Returns:
+        xr.Dataset: data with 'tp' in mm/day
+    """
+    if layout is None:
+        unmasked = type(location) == str and ls.find_mask(location) is None
+        layout = 'space' if unmasked else 'time'
+    cube_ds = open_cube(layout)
+    tp = cube_ds[source].sel(time=slice(minyear, maxyear))
+
+    if type(location) == str:
+        if 'mask_' + location in cube_ds:
+            mask = cube_ds['mask_' + location].load()
+            tp = tp.where(mask > 0, drop=True)
+        else:
+            tp = ls.select_basin(tp.to_dataset(name='tp'), location).tp
+    else:
+        lat, lon = location
+        tp = tp.interp(coords={"lon": lon, "lat": lat}, method="nearest")
+    return tp.transpose('time', ...).to_dataset(name='tp')
+
+
+def _write(ds: xr.Dataset, filepath: str):
+    """ Writes a Zarr store, replacing the previous one once complete """
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    tmp_filepath = filepath + '.' + str(os.getpid()) + '.tmp'
+    ds.to_zarr(tmp_filepath, mode='w')
+    if os.path.exists(filepath):
+        shutil.rmtree(filepath)
+    os.replace(tmp_filepath, filepath)
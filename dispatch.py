@@ -0,0 +1,111 @@
+"""
+Single entry point to collect several gridded datasets for the same
+location and period. The datasets are read concurrently, so the total time
+is close to that of the slowest source, and are returned aligned on their
+common time axis and on a common grid.
+"""
+
+import importlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+COLLECT_FUNCTIONS = {'aphrodite': ('load.aphrodite', 'collect_APHRO'),
+                     'era5': ('load.era5', 'collect_ERA5'),
+                     'cru': ('load.cru', 'collect_CRU'),
+                     'gpm': ('load.gpm', 'collect_GPM'),
+                     'wrf': ('load.beas_sutlej_wrf', 'collect_WRF'),
+                     'bc_wrf': ('load.beas_sutlej_wrf', 'collect_BC_WRF')}
+
+
+def collect(datasets: list, location: str or tuple, minyear: str, maxyear: str, align=True, executor='thread', max_workers=None) -> dict:
+    """
+    Collect several datasets concurrently.
+
+    Args:
+        datasets (list): dataset names, keys of COLLECT_FUNCTIONS
+        location (str or tuple): location string or lat/lon coordinate tuple
+        minyear (str): start date in years
+        maxyear (str): end date in years
+        align (bool, optional): whether to align the datasets on their
+            common times and on the grid of the first dataset. Defaults to True.
+        executor (str, optional): 'thread', or 'process' to also spread
+            the decoding and masking over processes. Defaults to 'thread'.
+        max_workers (int, optional): number of workers. Defaults to one
+            per dataset.
+
+    Returns:
+        dict: {dataset name: xr.Dataset}
+    """
+    executor_class = {'thread': ThreadPoolExecutor,
+                      'process': ProcessPoolExecutor}[executor]
+    if len(datasets) == 0:
+        return {}
+    if max_workers is None:
+        max_workers = len(datasets)
+
+    with executor_class(max_workers=max_workers) as pool:
+        futures = {name: pool.submit(_collect_one, name, location, minyear,
+                                     maxyear, executor == 'process')
+                   for name in datasets}
+        ds_dict = {name: future.result() for name, future in futures.items()}
+
+    if align:
+        ds_dict = align_datasets(ds_dict)
+    return ds_dict
+
+
+def align_datasets(ds_dict: dict, grid_from: str = None) -> dict:
+    """
+    Select the times common to all datasets and interpolate the gridded
+    datasets (nearest neighbour) onto the grid of one of them.
+
+    Args:
+        ds_dict (dict): {dataset name: xr.Dataset}
+        grid_from (str, optional): name of the dataset whose grid is used.
+            Defaults to the first gridded dataset.
+
+    Returns:
+        dict: {dataset name: aligned xr.Dataset}
+    """
+    ds_dict = {name: _datetime_time(ds) for name, ds in ds_dict.items()}
+
+    common_times = None
+    for ds in ds_dict.values():
+        times = ds.time.values
+        common_times = times if common_times is None else np.intersect1d(
+            common_times, times)
+
+    gridded = [name for name, ds in ds_dict.items()
+               if 'lat' in ds.dims and 'lon' in ds.dims]
+    if grid_from is None and len(gridded) > 0:
+        grid_from = gridded[0]
+
+    aligned_dict = {}
+    for name, ds in ds_dict.items():
+        ds = ds.sel(time=common_times)
+        if grid_from is not None and name in gridded and name != grid_from:
+            grid_ds = ds_dict[grid_from]
+            ds = ds.interp(lat=grid_ds.lat, lon=grid_ds.lon, method='nearest')
+        aligned_dict[name] = ds
+    return aligned_dict
+
+
+def _collect_one(name: str, location: str or tuple, minyear: str, maxyear: str, load: bool):
+    """ Runs the collect function of one dataset """
+    module_name, function_name = COLLECT_FUNCTIONS[name]
+    collect_function = getattr(importlib.import_module(module_name),
+                               function_name)
+    ds = collect_function(location, minyear, maxyear)
+    if load:
+        # send data rather than open file handles back from worker processes
+        ds = ds.load()
+    return ds
+
+
+def _datetime_time(ds):
+    """ Returns dataset with a datetime64 time coordinate, e.g. for times read from CSV """
+    if ds.time.dtype.kind != 'M':
+        ds = ds.assign_coords(time=pd.to_datetime(ds.time.values))
+    return ds
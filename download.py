@@ -0,0 +1,186 @@
+"""
+Concurrent, resumable HTTP downloads.
+
+Files are streamed to disk in chunks through a pooled session. Incomplete
+downloads are kept as '.part' files and resumed with Range requests, only
+appending ranges that start at the end of the part file, and a file only
+gets its final name once its size (and checksum, if given) has been
+verified, so files that already exist are complete and are skipped.
+Existing files can also be revalidated with conditional requests (see
+load.http_cache), and the part files of changed files are discarded.
+"""
+
+import os
+import hashlib
+import warnings
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from tqdm import tqdm
+
+import load.http_cache as http_cache
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def make_session(max_workers: int = 4, retries: int = 3) -> requests.Session:
+    """
+    Return a session with a connection pool sized for max_workers and
+    retries with backoff on connection errors and server errors.
+    """
+    session = requests.Session()
+    retry = Retry(total=retries, backoff_factor=1,
+                  status_forcelist=[429, 500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=max_workers,
+                          pool_maxsize=max_workers, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def download_file(url: str, filepath: str, session: requests.Session = None, checksum: str = None, retries: int = 3, revalidate: bool = False) -> str:
+    """
+    Download a file, resuming any partial download.
+
+    Args:
+        url (str): file URL
+        filepath (str): local filepath
+        session (requests.Session, optional): session to reuse. Defaults to None.
+        checksum (str, optional): expected checksum as 'algorithm:hexdigest',
+            e.g. 'md5:9e107d9d372bb6826bd81d3542a419d6'. Defaults to None.
+        retries (int, optional): number of times an interrupted transfer is
+            resumed. Defaults to 3.
+        revalidate (bool, optional): whether to check existing files with a
+            conditional request and download them again if they changed.
+            Defaults to False.
+
+    Returns:
+        str: local filepath
+    """
+    if session is None:
+        session = make_session()
+    part_filepath = filepath + '.part'
+    if os.path.exists(filepath):
+        if not revalidate or not http_cache.is_modified(url, filepath, session):
+            return filepath
+        # a partial download may be of the previous version
+        if os.path.exists(part_filepath):
+            os.remove(part_filepath)
+
+    for attempt in range(retries + 1):
+        try:
+            headers = _stream(session, url, part_filepath)
+        except requests.RequestException:
+            if attempt == retries:
+                raise
+            continue
+        if headers is not None:
+            break
+    else:
+        raise OSError('Incomplete download after ' + str(retries) +
+                      ' retries: ' + url)
+
+    if checksum is not None and not _verify_checksum(part_filepath, checksum):
+        os.remove(part_filepath)
+        raise OSError('Checksum mismatch: ' + url)
+
+    os.replace(part_filepath, filepath)
+    http_cache.save_validators(filepath, headers)
+    return filepath
+
+
+def download_files(urls: list, directory: str, max_workers: int = 4, checksums: dict = None, session: requests.Session = None, revalidate: bool = False) -> list:
+    """
+    Download files concurrently into a directory, skipping completed files.
+
+    Args:
+        urls (list): file URLs
+        directory (str): local directory
+        max_workers (int, optional): number of concurrent downloads. Defaults to 4.
+        checksums (dict, optional): {filename: 'algorithm:hexdigest'}. Defaults to None.
+        session (requests.Session, optional): session to reuse. Defaults to None.
+        revalidate (bool, optional): see download_file. Defaults to False.
+
+    Returns:
+        list: local filepaths, in the same order as urls
+    """
+    if session is None:
+        session = make_session(max_workers)
+    if checksums is None:
+        checksums = {}
+    os.makedirs(directory, exist_ok=True)
+
+    filepaths = [os.path.join(directory, url.split('/')[-1]) for url in urls]
+    failed = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(download_file, url, filepath, session,
+                                   checksums.get(os.path.basename(filepath)),
+                                   revalidate=revalidate): url
+                   for url, filepath in zip(urls, filepaths)}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            try:
+                future.result()
+            except (requests.RequestException, OSError) as e:
+                failed.append(futures[future])
+                warnings.warn('Download of ' + futures[future] + ' failed: ' + str(e))
+
+    if failed:
+        raise OSError(str(len(failed)) + ' downloads failed: ' + ', '.join(failed))
+    return filepaths
+
+
+def _stream(session: requests.Session, url: str, part_filepath: str):
+    """
+    Streams url to part_filepath from its current size. Returns the response
+    headers once the file is complete, None otherwise.
+    """
+    offset = os.path.getsize(part_filepath) if os.path.exists(part_filepath) else 0
+    headers = {'Accept-Encoding': 'identity'}
+    if offset:
+        headers['Range'] = 'bytes=' + str(offset) + '-'
+
+    with session.get(url, headers=headers, stream=True, allow_redirects=True,
+                     timeout=60) as r:
+        if r.status_code == 416:
+            # nothing left to send: the part file is complete or is stale
+            total = r.headers.get('Content-Range', '').split('/')[-1]
+            if total.isdigit() and int(total) == offset:
+                return r.headers
+            os.remove(part_filepath)
+            return None
+        r.raise_for_status()
+
+        if r.status_code == 206:
+            # e.g. 'bytes 1000-4095/4096'
+            content_range = r.headers['Content-Range'].split()[-1]
+            start = int(content_range.split('-')[0])
+            if start != offset:
+                # the range does not continue the part file, start again
+                os.remove(part_filepath)
+                return None
+            mode = 'ab'
+            total = int(content_range.split('/')[-1])
+        else:
+            mode, offset = 'wb', 0
+            total = int(r.headers['Content-Length']) \
+                if 'Content-Length' in r.headers else None
+
+        with open(part_filepath, mode) as f:
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+
+    if total is None or os.path.getsize(part_filepath) == total:
+        return r.headers
+    return None
+
+
+def _verify_checksum(filepath: str, checksum: str) -> bool:
+    """ Returns whether a file matches a checksum given as 'algorithm:hexdigest' """
+    algorithm, expected = checksum.split(':', 1)
+    h = hashlib.new(algorithm)
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest() == expected.lower()
@@ -0,0 +1,226 @@
+"""
+Empirical orthogonal functions (EOFs) of the ERA5 geopotential.
+
+Builds the global_{level}_EOF{n}.nc files read by era5.mean_downloader and
+era5.eof_downloader from the hourly geopotential downloaded by
+era5.update_cds_hourly_data. The computation is out-of-core:
+
+1. the hourly field is read in time blocks and averaged into monthly (or
+   daily) means, kept in a float32 memory-mapped file. Blocks are sized
+   from a byte budget (max_block_bytes), whatever the grid and time step
+2. anomalies from the calendar month (or day) climatology are weighted by
+   sqrt(cos(latitude)), so that each cell counts in proportion to its area
+3. the leading EOFs are found with a randomized SVD, which only needs
+   products of the anomaly matrix with thin matrices, computed block by
+   block over time
+
+The 'EOF' variable of each file is the mode's contribution to the field,
+i.e. its principal component times its spatial pattern, on the source's
+(time, latitude, longitude) grid.
+"""
+
+import os
+
+import numpy as np
+import xarray as xr
+
+import load.appendstore as appendstore
+from load.aggregate import (MAX_BLOCK_BYTES, PeriodAccumulator, block_length,
+                            hourly_field, period_starts)
+from load.instrument import stage
+from load import data_dir
+
+
+def build_eofs(level: str = '200', n_eofs: int = 2, filepath: str = None, variable: str = 'z', freq: str = 'MS', max_block_bytes: int = MAX_BLOCK_BYTES, n_iter: int = 2, seed: int = 0) -> list:
+    """
+    Compute the leading EOFs of a pressure level's geopotential and write
+    them as data_dir + 'ERA5/global_{level}_EOF{n}.nc'.
+
+    Args:
+        level (str, optional): pressure level in hPa. Defaults to '200'.
+        n_eofs (int, optional): number of EOFs. Defaults to 2.
+        filepath (str, optional): hourly NetCDF file. Defaults to the
+            update_cds_hourly_data file of the level.
+        variable (str, optional): variable name. Defaults to 'z'.
+        freq (str, optional): 'MS' for monthly or 'D' for daily means.
+            Defaults to 'MS'.
+        max_block_bytes (int, optional): size of the blocks read at once.
+            Defaults to MAX_BLOCK_BYTES.
+        n_iter (int, optional): number of power iterations of the
+            randomized SVD. Defaults to 2.
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        list: EOF filepaths
+    """
+    if filepath is None:
+        from load.era5 import update_cds_hourly_data
+        filepath = update_cds_hourly_data(pressure_level=level)
+
+    means_filepath = (data_dir + 'ERA5/global_' + level + '_' + freq + '.' +
+                      str(os.getpid()) + '.means.f4')
+    try:
+        with xr.open_dataset(filepath) as ds:
+            da = hourly_field(ds[variable])
+            lat = da.latitude.values
+            lon = da.longitude.values
+            with stage('open', filepath=filepath):
+                times, means = period_means(da, means_filepath, freq=freq,
+                                            max_block_bytes=max_block_bytes)
+
+        weights = np.where(np.abs(lat) < 90,
+                           np.sqrt(np.abs(np.cos(np.deg2rad(lat)))), 0)
+        weights = np.repeat(weights, len(lon))
+        groups = calendar_groups(times, freq)
+        clim = climatology(means, groups)
+
+        def anomalies(start, end):
+            block = means[start:end].astype('float64')
+            for i, group in enumerate(groups[start:end]):
+                block[i] -= clim[group]
+            block *= weights
+            return np.nan_to_num(block, copy=False)
+
+        with stage('svd', level=level):
+            u, s, vt = randomized_svd(anomalies, means.shape, n_eofs,
+                                      max_block_bytes=max_block_bytes,
+                                      n_iter=n_iter, seed=seed)
+
+        # patterns in the units of the field, undefined at the poles
+        with np.errstate(divide='ignore', invalid='ignore'):
+            patterns = np.where(weights > 0, vt / weights, np.nan)
+
+        eof_filepaths = []
+        for n in range(n_eofs):
+            eof_filepath = (data_dir + 'ERA5/global_' + level + '_EOF' +
+                            str(n + 1) + '.nc')
+            with stage('write', filepath=eof_filepath):
+                write_eof(eof_filepath, times, lat, lon, u[:, n] * s[n],
+                          patterns[n], max_block_bytes=max_block_bytes)
+            eof_filepaths.append(eof_filepath)
+    finally:
+        if os.path.exists(means_filepath):
+            os.remove(means_filepath)
+    return eof_filepaths
+
+
+def period_means(da: xr.DataArray, filepath: str, freq: str = 'MS', max_block_bytes: int = MAX_BLOCK_BYTES) -> tuple:
+    """
+    Average a (time, latitude, longitude) field over months or days,
+    reading it in time blocks.
+
+    Args:
+        da (xr.DataArray): field sorted by time
+        filepath (str): memory-mapped file for the means
+        freq (str, optional): 'MS' or 'D'. Defaults to 'MS'.
+        max_block_bytes (int, optional): size of the time blocks read at
+            once. Defaults to MAX_BLOCK_BYTES.
+
+    Returns:
+        tuple: datetime64 period starts, float32 means with shape
+            (period, latitude * longitude) backed by the file
+    """
+    periods = np.unique(period_starts(da.time.values, freq))
+    n_cells = da.shape[1] * da.shape[2]
+    means = np.memmap(filepath, dtype='float32', mode='w+',
+                      shape=(len(periods), n_cells))
+
+    accumulator = PeriodAccumulator(freq)
+    time_block = block_length(da.shape[1:], da.dtype.itemsize, max_block_bytes)
+    i = 0
+    for start in range(0, da.shape[0], time_block):
+        block_da = da.isel(time=slice(start, start + time_block))
+        for _, mean, _, _ in accumulator.add(block_da.time.values,
+                                             block_da.values):
+            means[i] = mean.reshape(n_cells)
+            i += 1
+    for _, mean, _, _ in accumulator.flush():
+        means[i] = mean.reshape(n_cells)
+    means.flush()
+    return periods.astype('datetime64[ns]'), means
+
+
+def calendar_groups(times: np.array, freq: str = 'MS') -> np.array:
+    """ Returns the calendar month (0-11), or day of the year (0-365), of each period """
+    if freq == 'MS':
+        return (times.astype('datetime64[M]').astype(int) % 12)
+    days = times.astype('datetime64[D]')
+    return (days - days.astype('datetime64[Y]')).astype(int)
+
+
+def climatology(means: np.array, groups: np.array) -> np.array:
+    """ Returns the mean of each calendar group, with shape (group, cell), adding one period at a time """
+    n_groups = groups.max() + 1
+    sums = np.zeros((n_groups, means.shape[1]))
+    counts = np.zeros((n_groups, means.shape[1]), dtype='int64')
+    for mean, group in zip(means, groups):
+        valid = ~np.isnan(mean)
+        np.add(sums[group], mean, out=sums[group], where=valid)
+        counts[group] += valid
+    with np.errstate(invalid='ignore'):
+        return sums / counts
+
+
+def randomized_svd(blocks, shape: tuple, n_components: int, n_oversamples: int = 10, max_block_bytes: int = MAX_BLOCK_BYTES, n_iter: int = 2, seed: int = 0) -> tuple:
+    """
+    Truncated SVD of a matrix read in row blocks (Halko et al. 2011).
+
+    Args:
+        blocks (function): takes start and end rows and returns the
+            matrix's rows, as float64
+        shape (tuple): matrix shape (rows, columns)
+        n_components (int): number of singular vectors
+        n_oversamples (int, optional): extra random vectors. Defaults to 10.
+        max_block_bytes (int, optional): size of the float64 row blocks
+            read at once. Defaults to MAX_BLOCK_BYTES.
+        n_iter (int, optional): power iterations. Defaults to 2.
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        tuple: u (rows, n_components), s (n_components),
+            vt (n_components, columns), with the sign of each pattern set so
+            that its largest value is positive
+    """
+    n_rows, n_cols = shape
+    rank = min(n_components + n_oversamples, n_rows, n_cols)
+    time_block = block_length((n_cols,), 8, max_block_bytes)
+    starts = range(0, n_rows, time_block)
+    omega = np.random.default_rng(seed).standard_normal((n_cols, rank))
+
+    def left_product(m):
+        """ A @ m """
+        return np.concatenate([blocks(s, s + time_block) @ m for s in starts])
+
+    def right_product(q):
+        """ A.T @ q """
+        product = np.zeros((n_cols, q.shape[1]))
+        for s in starts:
+            product += blocks(s, s + time_block).T @ q[s:s + time_block]
+        return product
+
+    q, _ = np.linalg.qr(left_product(omega))
+    for _ in range(n_iter):
+        z, _ = np.linalg.qr(right_product(q))
+        q, _ = np.linalg.qr(left_product(z))
+
+    ub, s, vt = np.linalg.svd(right_product(q).T, full_matrices=False)
+    u = q @ ub
+    u, s, vt = u[:, :n_components], s[:n_components], vt[:n_components]
+
+    signs = np.sign(vt[np.arange(len(vt)), np.abs(vt).argmax(axis=1)])
+    return u * signs, s, vt * signs[:, None]
+
+
+def write_eof(filepath: str, times: np.array, lat: np.array, lon: np.array, pc: np.array, pattern: np.array, max_block_bytes: int = MAX_BLOCK_BYTES):
+    """ Write a mode's principal component times its pattern, in time blocks """
+    tmp_filepath = filepath + '.' + str(os.getpid()) + '.tmp'
+    appendstore.create(tmp_filepath, lat, lon, {'EOF': 'f4'},
+                       chunk_time=min(len(times), 12),
+                       dims=('latitude', 'longitude'))
+    pattern = pattern.reshape(len(lat), len(lon))
+    time_block = block_length(pattern.shape, 8, max_block_bytes)
+    for start in range(0, len(times), time_block):
+        end = start + time_block
+        appendstore.append(tmp_filepath, times[start:end], {
+            'EOF': pc[start:end, None, None] * pattern})
+    os.replace(tmp_filepath, filepath)
@@ -12,16 +12,25 @@ import datetime
 import numpy as np
 import xarray as xr
 import pandas as pd
-import cdsapi
-import metpy.calc
-from metpy.units import units
 
 import load.location_sel as ls
-from load.noaa_indices import indice_downloader
+from load.instrument import stage
+from load.memo import memoize
+import load.compact as compact
+from load.compact import compact_dataset
 from load import data_dir
 
 
-def collect_ERA5(location: str or tuple, minyear: str, maxyear: str, all_var=False) -> xr.DataArray:
+def _collect_sources(args: dict) -> list:
+    """ Returns the CSV files and the basin's feature groups read by collect_ERA5 """
+    location = args['location']
+    basin = ls.basin_finder(location) if type(location) == str else 'indus'
+    return (glob.glob(data_dir + 'ERA5/*.csv') +
+            glob.glob(data_dir + 'ERA5/features/' + basin + '/*.nc'))
+
+
+@memoize(_collect_sources)
+def collect_ERA5(location: str or tuple, minyear: str, maxyear: str, all_var=False, from_cube=False) -> xr.DataArray:
     """
     Download data from ERA5 for a given location
 
@@ -29,10 +38,19 @@ def collect_ERA5(location: str or tuple, minyear: str, maxyear: str, all_var=Fal
         location (str or tuple): location string or lat/lon coordinate tuple
         minyear (float): start date in years
         maxyear (float): end date in years
+        from_cube (bool, optional): read precipitation from the common-grid
+            cube, see cube.build_cube. Defaults to False.
 
     Returns:
         xr.DataArray: ERA5 data
     """
+    if from_cube:
+        import load.cube as cube
+        if type(location) != str:
+            lon, lat = location
+            location = (lat, lon)
+        ds = cube.collect('era5', location, minyear, maxyear)
+        return compact_dataset(ds.assign_attrs(plot_legend="ERA5"))
 
     if type(location) == str:
         era5_ds = download_data(location, xarray=True, all_var=all_var)
@@ -40,11 +58,13 @@ def collect_ERA5(location: str or tuple, minyear: str, maxyear: str, all_var=Fal
     else:
         era5_ds = download_data('indus', xarray=True, all_var=all_var)
         lon, lat = location
-        loc_ds = era5_ds.interp(
-            coords={"lon": lon, "lat": lat}, method="nearest")
-    tim_ds = loc_ds.sel(time=slice(minyear, maxyear))
+        with stage('interp', location=location):
+            loc_ds = era5_ds.interp(
+                coords={"lon": lon, "lat": lat}, method="nearest")
+    with stage('slice', minyear=minyear, maxyear=maxyear):
+        tim_ds = loc_ds.sel(time=slice(minyear, maxyear))
     ds = tim_ds.assign_attrs(plot_legend="ERA5")  # in mm/day
-    return ds
+    return compact_dataset(ds)
 
 
 def gauge_download(station: str, minyear: str, maxyear: str) -> xr.Dataset:
@@ -55,7 +75,6 @@ def gauge_download(station: str, minyear: str, maxyear: str) -> xr.Dataset:
     # Interpolate at location
     all_station_dict = pd.read_csv(
         data_dir + 'bs_gauges/gauge_info.csv', index_col='station').T
-    print(all_station_dict)
     lat, lon, _elv = all_station_dict[station]
     loc_ds = era5_ds.interp(coords={"lon": lon, "lat": lat}, method="nearest")
     tim_ds = loc_ds.sel(time=slice(minyear, maxyear))
@@ -130,6 +149,11 @@ def download_data(location, xarray=False, ensemble=False, all_var=False, latest=
         xarray: boolean
         ensemble: boolean
         all_var: boolean
+        latest: boolean, rebuild the CSV file of the current month
+
+    With all_var (and not ensemble), the features are read from the feature
+    store (see load.feature_store): `latest` is ignored, and so are existing
+    all_data_<basin>_*.csv files, which are no longer read or written.
 
     Returns
         df: DataFrame of data, or
@@ -137,7 +161,13 @@ def download_data(location, xarray=False, ensemble=False, all_var=False, latest=
     """
 
     basin = ls.basin_finder(location)
-    print(basin)
+
+    if all_var is True and ensemble is False:
+        # Feature groups are built and stored separately
+        import load.feature_store as feature_store
+        if xarray is True:
+            return feature_store.load_features(basin)
+        return feature_store.feature_table(basin)
 
     path = data_dir + "ERA5/"
     now = datetime.datetime.now()
@@ -175,11 +205,13 @@ def download_data(location, xarray=False, ensemble=False, all_var=False, latest=
                 "_" + now.strftime("%Y-%m") + ".csv"
 
         filepath = os.path.expanduser(path + filename)
-    
-    print(filepath)
 
     if not os.path.exists(filepath):
-       # print(basin)
+        # Only needed to build the CSV file
+        import metpy.calc
+        from metpy.units import units
+        from load.noaa_indices import indice_downloader
+
         # Orography, humidity, precipitation and indices
         cds_df = cds_downloader(basin, ensemble=ensemble, all_var=all_var)
         ind_df = indice_downloader(all_var=all_var)
@@ -213,8 +245,10 @@ def download_data(location, xarray=False, ensemble=False, all_var=False, latest=
         df_clean["tp"] *= 1000  # to mm/day
         df_clean = df_clean.rename(
             columns={'latitude': 'lat', 'longitude': 'lon'})
-        #df_clean = df_clean.astype("float64")
-        df_clean.to_csv(filepath)
+        # the cache is shared by both modes, so it is written at full precision
+        with stage('write', filepath=filepath):
+            df_clean.to_csv(filepath)
+        df_clean = compact.compact_dataframe(df_clean)
 
         if xarray is True:
             if ensemble is True:
@@ -237,7 +271,9 @@ def download_data(location, xarray=False, ensemble=False, all_var=False, latest=
             return df_clean
 
     else:
-        df = pd.read_csv(filepath)
+        with stage('open', filepath=filepath):
+            columns = pd.read_csv(filepath, nrows=0).columns
+            df = pd.read_csv(filepath, dtype=compact.csv_dtypes(columns))
         df_clean = df.drop(columns=["Unnamed: 0"])
 
         if xarray is True:
@@ -430,23 +466,6 @@ def cds_downloader(basin, ensemble=False, all_var=False):
     return cds_df
 
 
-def standardised_time(dataset):
-    """ 
-    FOR ARCHIVE ONLY - NOT IN USE
-
-    Returns array of standardised times to plot.
-
-    """
-    try:
-        utime = dataset.time.values.astype(int)/(1e9 * 60 * 60 * 24 * 365)
-    except Exception:
-        time = np.array([d.strftime() for d in dataset.time.values])
-        time2 = np.array([datetime.datetime.strptime(
-            d, "%Y-%m-%d %H:%M:%S") for d in time])
-        utime = np.array([d.timestamp() for d in time2]) / (60 * 60 * 24 * 365)
-    return (utime + 1970)
-
-
 def update_cds_monthly_data(
         dataset_name="reanalysis-era5-single-levels-monthly-means",
         product_type="monthly_averaged_reanalysis",
@@ -510,38 +529,41 @@ def update_cds_monthly_data(
         months = ['01', '02', '03', '04', '05', '06',
                   '07', '08', '09', '10', '11', '12']
 
+        import cdsapi
         c = cdsapi.Client()
 
         if pressure_level is None:
-            print(product_type, variables, pressure_level,
-                  years.tolist(), months, area_extent)
-            c.retrieve(
-                'reanalysis-era5-single-levels-monthly-means',
-                {
-                    "format": "netcdf",
-                    "product_type": product_type,
-                    "variable": variables,
-                    "year": years.tolist(),
-                    "time": "00:00",
-                    "month": months,
-                    "area": area_extent,
-                },
-                filepath,
+            with stage('download', filepath=filepath, variables=variables,
+                       area=area_extent):
+                c.retrieve(
+                    'reanalysis-era5-single-levels-monthly-means',
+                    {
+                        "format": "netcdf",
+                        "product_type": product_type,
+                        "variable": variables,
+                        "year": years.tolist(),
+                        "time": "00:00",
+                        "month": months,
+                        "area": area_extent,
+                    },
+                    filepath,
 
-            )
+                )
         else:
-            c.retrieve("reanalysis-era5-single-levels-monthly-means",
-                       {
-                           "format": "netcdf",
-                           "product_type": product_type,
-                           "variable": variables,
-                           "pressure_level": pressure_level,
-                           "year": years.tolist(),
-                           "time": "00:00",
-                           "month": months,
-                           "area": area_extent,
-                       },
-                       filepath,)
+            with stage('download', filepath=filepath, variables=variables,
+                       area=area_extent, pressure_level=pressure_level):
+                c.retrieve("reanalysis-era5-single-levels-monthly-means",
+                           {
+                               "format": "netcdf",
+                               "product_type": product_type,
+                               "variable": variables,
+                               "pressure_level": pressure_level,
+                               "year": years.tolist(),
+                               "time": "00:00",
+                               "month": months,
+                               "area": area_extent,
+                           },
+                           filepath,)
 
     return filepath
 
@@ -598,6 +620,7 @@ def update_cds_hourly_data(
         months = np.arange(1, 13, 1).astype(str)
         days = np.arange(1, 32, 1).astype(str)
 
+        import cdsapi
         c = cdsapi.Client()
 
         if pressure_level is None:
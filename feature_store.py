@@ -0,0 +1,183 @@
+"""
+Feature store for the ERA5 GP inputs.
+
+The features are split into groups that are computed and stored
+independently, one NetCDF file per group, basin and group version:
+
+    ERA5/features/indus/era5_fields_v1.nc
+    ERA5/features/indus/indices_v1.nc
+    ...
+
+Each group declares its columns, so that only the groups holding the
+requested columns are built and read. Groups are joined on (time, lat, lon)
+when read. Adding a feature group, or changing the version of one, only
+builds that group. Each basin's groups are replaced, and old versions
+removed, under an exclusive lock on ERA5/features/<basin>/.lock, and read
+under a shared one, so that other processes do not read a group while it is
+replaced.
+"""
+
+import os
+import glob
+import fcntl
+
+import pandas as pd
+import xarray as xr
+
+from load.memo import locked
+from load import data_dir
+
+KEYS = ['time', 'lat', 'lon']
+
+
+def era5_fields(basin: str) -> pd.DataFrame:
+    """ Orography, humidity and precipitation fields """
+    import metpy.calc
+    from metpy.units import units
+    from load.era5 import cds_downloader
+
+    df = cds_downloader(basin)
+    # choose experiment version 1
+    df = df[[c for c in df.columns if c != 'expver' and not c.endswith('_0005')]]
+    df.columns = [c[:-len('_0001')] if c.endswith('_0001') else c
+                  for c in df.columns]
+    u = units.meter * units.meter / units.second / units.second
+    df['z'] = metpy.calc.geopotential_to_height(df['z'].values * u).magnitude
+    df['tp'] *= 1000  # to mm/day
+    return df
+
+
+def indices(basin: str) -> pd.DataFrame:
+    """ NOAA N34, NAO and N4 indices """
+    from load.noaa_indices import indice_downloader
+    return indice_downloader(all_var=True).reset_index()
+
+
+def regional_means(basin: str) -> pd.DataFrame:
+    """ Basin mean 2m temperature and regional means of the EOFs """
+    from load.era5 import mean_downloader
+    return mean_downloader(basin)
+
+
+def uib_eofs(basin: str) -> pd.DataFrame:
+    """ EOF fields over the basin """
+    from load.era5 import eof_downloader
+    return eof_downloader(basin, all_var=True).reset_index()
+
+
+EOF_LEVELS = ['200', '500', '850']
+
+# {group name: (builder, keys, columns, version)}, bump the version when a
+# builder changes
+FEATURE_GROUPS = {
+    'era5_fields': (era5_fields, ['time', 'lat', 'lon'],
+                    ['z', 'd2m', 'anor', 'slor', 'tcwv', 'tp'], 1),
+    'indices': (indices, ['time'], ['N34', 'NAO', 'N4'], 1),
+    'regional_means': (regional_means, ['time'],
+                       ['t2m'] + ['EOF' + level + region + n
+                                  for level in EOF_LEVELS for region in 'BC'
+                                  for n in '12'], 1),
+    'uib_eofs': (uib_eofs, ['time', 'lat', 'lon'],
+                 ['EOF' + level + 'U' + n for level in EOF_LEVELS
+                  for n in '12'], 1)}
+
+
+def register_feature_group(name: str, builder, keys: list, columns: list, version: int = 1):
+    """
+    Add a feature group.
+
+    Args:
+        name (str): group name
+        builder (function): takes a basin name and returns a DataFrame with
+            the keys and feature columns
+        keys (list): join keys of the group, a subset of KEYS
+        columns (list): feature columns of the group
+        version (int, optional): group version. Defaults to 1.
+    """
+    FEATURE_GROUPS[name] = (builder, keys, columns, version)
+
+
+def group_filepath(basin: str, name: str) -> str:
+    _, _, _, version = FEATURE_GROUPS[name]
+    return (data_dir + 'ERA5/features/' + basin + '/' + name + '_v' +
+            str(version) + '.nc')
+
+
+def build_group(basin: str, name: str, overwrite: bool = False) -> str:
+    """
+    Compute and store a feature group, unless its current version is stored.
+
+    Returns:
+        str: group filepath
+    """
+    filepath = group_filepath(basin, name)
+    if os.path.exists(filepath) and not overwrite:
+        return filepath
+
+    builder, keys, columns, _ = FEATURE_GROUPS[name]
+    df = builder(basin).rename(columns={'latitude': 'lat', 'longitude': 'lon'})
+    df['time'] = pd.to_datetime(df['time']).values.astype(
+        'datetime64[M]').astype('datetime64[ns]')
+    ds = df.groupby(keys)[columns].mean().to_xarray()
+
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    tmp_filepath = filepath + '.' + str(os.getpid()) + '.tmp'
+    ds.to_netcdf(tmp_filepath)
+    with locked(_lock_filepath(basin), fcntl.LOCK_EX):
+        os.replace(tmp_filepath, filepath)
+        # remove the other versions of the group
+        for old_filepath in glob.glob(os.path.dirname(filepath) + '/' + name + '_v*.nc'):
+            if old_filepath != filepath:
+                os.remove(old_filepath)
+    return filepath
+
+
+def load_features(basin: str, columns: list = None, groups: list = None) -> xr.Dataset:
+    """
+    Join feature groups on (time, lat, lon), building missing groups.
+
+    Args:
+        basin (str): basin name, e.g. 'indus'
+        columns (list, optional): features to read. Defaults to all the
+            columns of the groups.
+        groups (list, optional): groups to read. Defaults to the groups
+            holding the columns, or all groups.
+
+    Returns:
+        xr.Dataset: features over the times and cells common to the groups
+    """
+    if groups is None:
+        groups = list(FEATURE_GROUPS)
+    if columns is not None:
+        group_columns = {name: [c for c in columns
+                                if c in FEATURE_GROUPS[name][2]]
+                         for name in groups}
+        missing = [c for c in columns
+                   if not any(c in cs for cs in group_columns.values())]
+        if len(missing) > 0:
+            raise KeyError('Features not in the groups ' + str(groups) +
+                           ': ' + str(missing))
+    else:
+        group_columns = {name: FEATURE_GROUPS[name][2] for name in groups}
+
+    group_dss = []
+    for name, selected in group_columns.items():
+        if len(selected) == 0:
+            continue
+        filepath = build_group(basin, name)
+        # read while holding the lock, as the group may be replaced after
+        with locked(_lock_filepath(basin), fcntl.LOCK_SH):
+            with xr.open_dataset(filepath) as ds:
+                group_dss.append(ds[selected].load())
+    return xr.merge(group_dss, join='inner', compat='override')
+
+
+def feature_table(basin: str, columns: list = None) -> pd.DataFrame:
+    """ Returns the features as a table without missing values, like the all_var CSV file """
+    ds = load_features(basin, columns=columns)
+    df = ds.to_dataframe().dropna()
+    return df.reset_index()[KEYS + [c for c in df.columns if c not in KEYS]]
+
+
+def _lock_filepath(basin: str) -> str:
+    return data_dir + 'ERA5/features/' + basin + '/.lock'
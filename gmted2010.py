@@ -4,50 +4,314 @@ GMTED2010 dataset is a 0.0625° DEM computed from satellite data.
 Slope and aspect are calculated using:
     Horn, B.K.P., 1981. Hill shading and the reflectance map. Proceedings of
     the IEEE 69, 14–47. doi:10.1109/PROC.1981.11918
+Curvature is calculated using:
+    Zevenbergen, L.W., Thorne, C.R., 1987. Quantitative analysis of land
+    surface topography. Earth Surface Processes and Landforms 12, 47–56.
+    doi:10.1002/esp.3290120107
 """
 
 import numpy as np
 import pandas as pd
 import xarray as xr
+import dask.array as dsa
 from load import data_dir
-#import richdem as rd
 
+EARTH_RADIUS = 6371000  # m
+GMTED_FILEPATH = data_dir + 'Elevation/GMTED2010_15n015_00625deg.nc'
+PYRAMID_FILEPATH = data_dir + 'Elevation/GMTED2010_pyramid.nc'
 
-# TODO: Fix richdem import
-''' 
-def generate_slope_aspect():
-    """Generate slope and aspect from DEM."""
-    dem_ds = xr.open_dataset(
-        '/Users/kenzatazi/Downloads/GMTED2010_15n015_00625deg.nc')
+# Pyramid levels already opened, by resolution
+_pyramid_levels = {}
+
+
+def generate_slope_aspect(dem_filepath=GMTED_FILEPATH, lat_range=(29, 34), lon_range=(75, 83), tile_size=1024):
+    """
+    Generate slope, aspect and curvature from DEM.
+
+    Args:
+        dem_filepath (str, optional): GMTED2010 filepath.
+        lat_range (tuple, optional): latitude range, None for the whole tile. Defaults to (29, 34).
+        lon_range (tuple, optional): longitude range, None for the whole tile. Defaults to (75, 83).
+        tile_size (int, optional): number of cells along each side of the
+            tiles processed in parallel. Defaults to 1024.
+    """
+    dem_ds = xr.open_dataset(dem_filepath)
     dem_ds = dem_ds.assign_coords(
         {'nlat': dem_ds.latitude, 'nlon': dem_ds.longitude})
-    dem_ds = dem_ds.sel(nlat=slice(29, 34), nlon=slice(75, 83))
+    if lat_range is not None:
+        dem_ds = dem_ds.sel(nlat=slice(*lat_range))
+    if lon_range is not None:
+        dem_ds = dem_ds.sel(nlon=slice(*lon_range))
 
-    elev_arr = dem_ds.elevation.values
-    elev_rd_arr = rd.rdarray(elev_arr, no_data=np.nan)
+    terrain_ds = terrain_attributes(dem_ds.elevation, tile_size=tile_size)
+    streamlined_dem_ds = xr.merge([dem_ds[['elevation']], terrain_ds])
+    streamlined_dem_ds.to_netcdf(
+        data_dir + 'Elevation/SRTM_data.nc')
 
-    slope_rd_arr = rd.TerrainAttribute(elev_rd_arr, attrib='slope_riserun')
-    slope_arr = np.array(slope_rd_arr)
 
-    aspect_rd_arr = rd.TerrainAttribute(elev_rd_arr, attrib='aspect')
-    aspect_arr = np.array(aspect_rd_arr)
+def terrain_attributes(elevation: xr.DataArray, tile_size=1024) -> xr.Dataset:
+    """
+    Return slope (rise/run), aspect (° clockwise from north, NaN for flat
+    cells) and curvature (1/m, positive for convex cells) of a DEM on a
+    regular lat/lon grid. The DEM is processed lazily in square tiles with
+    a one-cell halo, in parallel over tiles. Edge cells are NaN.
 
-    dem_ds['slope'] = (('nlat', 'nlon'), slope_arr)
-    dem_ds['aspect'] = (('nlat', 'nlon'), aspect_arr)
+    Args:
+        elevation (xr.DataArray): elevation in m with (lat, lon) dimensions
+        tile_size (int, optional): number of cells along each side of a tile. Defaults to 1024.
 
-    streamlined_dem_ds = dem_ds[['elevation', 'slope', 'aspect']]
-    streamlined_dem_ds.to_netcdf(
+    Returns:
+        xr.Dataset: slope, aspect and curvature
+    """
+    lat_dim, lon_dim = elevation.dims
+    lat = elevation[lat_dim].values
+    lon = elevation[lon_dim].values
+
+    # Signed cell sizes, so that derivatives point north and east
+    dy = np.deg2rad(lat[1] - lat[0]) * EARTH_RADIUS
+    dx_deg = np.deg2rad(lon[1] - lon[0]) * EARTH_RADIUS
+
+    elev_arr = elevation.astype(float).chunk(tile_size).data
+    lat_arr = dsa.broadcast_to(dsa.from_array(lat[:, np.newaxis], chunks=tile_size),
+                               elev_arr.shape, chunks=elev_arr.chunks)
+
+    terrain_ds = xr.Dataset(coords=elevation.coords)
+    for attribute in ['slope', 'aspect', 'curvature']:
+        attribute_arr = dsa.map_overlap(
+            _horn_tile, elev_arr, lat_arr, depth=1, boundary=np.nan,
+            dtype=float, attribute=attribute, dx_deg=dx_deg, dy=dy)
+        terrain_ds[attribute] = ((lat_dim, lon_dim), attribute_arr)
+    return terrain_ds
+
+
+def horn_derivatives(z: np.array, dx: np.array, dy: float) -> tuple:
+    """
+    Return the Horn (1981) east and north derivatives, and the
+    Zevenbergen & Thorne (1987) second derivatives, of the interior of an
+    array with a one-cell halo.
+
+    Args:
+        z (np.array): elevation with a one-cell halo, rows ordered by latitude
+        dx (np.array): signed eastward cell size in m for each interior row
+        dy (float): signed northward cell size in m
+
+    Returns:
+        tuple: dz/dx, dz/dy, d2z/dx2, d2z/dy2
+    """
+    a, b, c = z[:-2, :-2], z[:-2, 1:-1], z[:-2, 2:]
+    d, e, f = z[1:-1, :-2], z[1:-1, 1:-1], z[1:-1, 2:]
+    g, h, i = z[2:, :-2], z[2:, 1:-1], z[2:, 2:]
+    dx = np.asarray(dx)[:, np.newaxis]
+
+    dzdx = ((c + 2 * f + i) - (a + 2 * d + g)) / (8 * dx)
+    dzdy = ((g + 2 * h + i) - (a + 2 * b + c)) / (8 * dy)
+    d2zdx2 = (d + f - 2 * e) / dx ** 2
+    d2zdy2 = (b + h - 2 * e) / dy ** 2
+    return dzdx, dzdy, d2zdx2, d2zdy2
+
+
+def _horn_tile(z: np.array, lat: np.array, attribute: str, dx_deg: float, dy: float) -> np.array:
+    """ Returns a terrain attribute for a tile with a one-cell halo, keeping its shape """
+    dx = dx_deg * np.cos(np.deg2rad(lat[1:-1, 1]))
+    dzdx, dzdy, d2zdx2, d2zdy2 = horn_derivatives(z, dx, dy)
+
+    if attribute == 'slope':
+        values = np.hypot(dzdx, dzdy)
+    elif attribute == 'aspect':
+        values = np.degrees(np.arctan2(-dzdx, -dzdy)) % 360
+        values[(dzdx == 0) & (dzdy == 0)] = np.nan
+    else:
+        values = -(d2zdx2 + d2zdy2)
+
+    out = np.full(z.shape, np.nan)
+    out[1:-1, 1:-1] = values
+    return out
+
+
+def build_dem_pyramid(dem_filepath=GMTED_FILEPATH, resolutions=(0.0625, 0.25, 0.5, 1.0)):
+    """
+    Precompute the mean, minimum, maximum and standard deviation of the
+    elevation in the cells of coarser grids. Coarse cells are centred on
+    multiples of their resolution, as for ERA5. Each resolution is saved as
+    a group of the pyramid NetCDF file.
+
+    Args:
+        dem_filepath (str, optional): GMTED2010 filepath.
+        resolutions (tuple, optional): grid resolutions in °, multiples of
+            the DEM resolution. Defaults to (0.0625, 0.25, 0.5, 1.0).
+    """
+    dem_ds = xr.open_dataset(dem_filepath)
+    elevation = xr.DataArray(dem_ds.elevation.values, dims=('lat', 'lon'),
+                             coords={'lat': dem_ds.latitude.values,
+                                     'lon': dem_ds.longitude.values})
+    elevation = elevation.sortby('lat').sortby('lon')
+    native = float(elevation.lat[1] - elevation.lat[0])
+
+    mode = 'w'
+    for res in resolutions:
+        factor = int(round(res / native))
+        # first native cell on the edge of a coarse cell
+        lat_start = _first_edge(elevation.lat.values, native, res)
+        lon_start = _first_edge(elevation.lon.values, native, res)
+        cells = elevation.isel(lat=slice(lat_start, None),
+                               lon=slice(lon_start, None)).coarsen(
+            lat=factor, lon=factor, boundary='trim')
+        level_ds = xr.Dataset({'elevation_mean': cells.mean(),
+                               'elevation_min': cells.min(),
+                               'elevation_max': cells.max(),
+                               'elevation_std': cells.std()})
+        level_ds = level_ds.assign_attrs(resolution=res)
+        level_ds.to_netcdf(PYRAMID_FILEPATH, group=_pyramid_group(res),
+                           mode=mode)
+        mode = 'a'
+    _pyramid_levels.clear()
+
+
+def pyramid_level(resolution: float) -> xr.Dataset:
+    """ Returns the DEM pyramid level of a given resolution in ° """
+    if resolution not in _pyramid_levels:
+        with xr.open_dataset(PYRAMID_FILEPATH,
+                             group=_pyramid_group(resolution)) as level_ds:
+            _pyramid_levels[resolution] = level_ds.load()
+    return _pyramid_levels[resolution]
+
+
+def dem_lookup(lat: np.array, lon: np.array, resolution=0.25) -> xr.Dataset:
+    """
+    Return the elevation statistics of the cells containing given points.
+
+    Args:
+        lat (np.array): latitudes in °N
+        lon (np.array): longitudes in °E
+        resolution (float, optional): pyramid resolution in °. Defaults to 0.25.
+
+    Returns:
+        xr.Dataset: elevation mean, min, max and std with a 'point'
+            dimension, NaN for points outside the pyramid's cells
+    """
+    level_ds = pyramid_level(resolution)
+    lat, lon = np.atleast_1d(lat), np.atleast_1d(lon)
+    lat_index = nearest_index(level_ds.lat.values, lat)
+    lon_index = nearest_index(level_ds.lon.values, lon)
+    points_ds = level_ds.isel(lat=xr.DataArray(lat_index, dims='point'),
+                              lon=xr.DataArray(lon_index, dims='point'))
+    # points off the pyramid's cells have no elevation
+    inside = ~(_outside(level_ds.lat.values, lat) |
+               _outside(level_ds.lon.values, lon))
+    return points_ds.where(xr.DataArray(inside, dims='point'))
+
+
+def elevation_covariates(ds: xr.Dataset, resolution=None) -> xr.Dataset:
+    """
+    Return the elevation statistics on the grid of a dataset, e.g. to use
+    the sub-grid roughness (elevation_std) as a covariate next to ERA5 'z'.
+
+    Args:
+        ds (xr.Dataset): data with 'lat' and 'lon' coordinates
+        resolution (float, optional): pyramid resolution in °. Defaults to
+            the pyramid level closest to the dataset grid.
+
+    Returns:
+        xr.Dataset: elevation mean, min, max and std on the dataset grid,
+            NaN outside the pyramid's cells
+    """
+    if resolution is None:
+        ds_res = float(np.abs(np.diff(ds.lat.values)).min())
+        levels = np.array(_available_resolutions())
+        resolution = float(levels[np.argmin(np.abs(levels - ds_res))])
+
+    level_ds = pyramid_level(resolution)
+    lat_index = nearest_index(level_ds.lat.values, ds.lat.values)
+    lon_index = nearest_index(level_ds.lon.values, ds.lon.values)
+    covariates_ds = level_ds.isel(lat=lat_index, lon=lon_index)
+    covariates_ds = covariates_ds.assign_coords(lat=ds.lat.values,
+                                                lon=ds.lon.values)
+    inside_lat = ~_outside(level_ds.lat.values, ds.lat.values)
+    inside_lon = ~_outside(level_ds.lon.values, ds.lon.values)
+    return covariates_ds.where(xr.DataArray(inside_lat, dims='lat') &
+                               xr.DataArray(inside_lon, dims='lon'))
+
+
+def find_slopes(stations: list = None) -> xr.Dataset:
+    """
+    Return terrain attributes for several stations, gathered from the DEM
+    in one indexing operation.
+
+    Args:
+        stations (list, optional): station names, None for all stations. Defaults to None.
+
+    Returns:
+        xr.Dataset: terrain attributes with a 'station' dimension
+    """
+    dem_ds = xr.open_dataset(
         data_dir + 'Elevation/SRTM_data.nc')
-'''
+    all_station_df = pd.read_csv(
+        data_dir + 'bs_gauges/gauge_info.csv', index_col='station')
+    if stations is not None:
+        all_station_df = all_station_df.loc[stations]
+
+    station_lat = all_station_df.iloc[:, 0].values
+    station_lon = all_station_df.iloc[:, 1].values
+    stations = xr.DataArray(all_station_df.index.values, dims='station')
+    lat_index = nearest_index(dem_ds.nlat.values, station_lat)
+    lon_index = nearest_index(dem_ds.nlon.values, station_lon)
+
+    station_ds = dem_ds.isel(
+        nlat=xr.DataArray(lat_index, dims='station'),
+        nlon=xr.DataArray(lon_index, dims='station'))
+    return station_ds.assign_coords(station=stations)
 
 
 def find_slope(station):
     """Return slope for given station."""
-    dem_ds = xr.open_dataset(
-        data_dir + 'Elevation/SRTM_data.nc')
-    all_station_dict = pd.read_csv(
-        data_dir + 'bs_gauges/gauge_info.csv')
-    location = all_station_dict[station]
-    station_slope = dem_ds.interp(
-        coords={"nlon": location[1], "nlat": location[0]}, method="nearest")
-    return station_slope
+    return find_slopes([station]).isel(station=0)
+
+
+def nearest_index(coord: np.array, values: np.array) -> np.array:
+    """
+    Return the index of the nearest coordinate for each value.
+
+    Args:
+        coord (np.array): monotonic coordinate values
+        values (np.array): values to look up
+
+    Returns:
+        np.array: indices into coord
+    """
+    order = np.argsort(coord)
+    sorted_coord = coord[order]
+    pos = np.clip(np.searchsorted(sorted_coord, values), 1, len(coord) - 1)
+    closer_left = (values - sorted_coord[pos - 1]) < (sorted_coord[pos] - values)
+    return order[pos - closer_left]
+
+
+def _pyramid_group(resolution: float) -> str:
+    """ Returns the NetCDF group name of a pyramid level, the same for 1 and 1.0 """
+    return 'res_{:g}'.format(resolution)
+
+
+def _available_resolutions() -> list:
+    """ Returns the resolutions of the levels in the pyramid file """
+    import netCDF4
+    with netCDF4.Dataset(PYRAMID_FILEPATH) as nc:
+        return [float(group[len('res_'):]) for group in nc.groups
+                if group.startswith('res_')]
+
+
+def _outside(coord: np.array, values: np.array) -> np.array:
+    """ Returns whether values are more than half a cell outside a regular coordinate """
+    half = np.abs(np.diff(coord)).min() / 2 if len(coord) > 1 else 0
+    return (values < coord.min() - half) | (values > coord.max() + half)
+
+
+def _first_edge(coord: np.array, native: float, res: float) -> int:
+    """ Returns the index of the first cell whose lower edge is a coarse cell edge """
+    if np.isclose(res, native):
+        # the native grid is kept as it is
+        return 0
+    lower_edges = coord - native / 2 + res / 2
+    offsets = np.abs(lower_edges / res - np.round(lower_edges / res))
+    if offsets.min() >= 1e-6:
+        raise ValueError('No DEM cell edge lines up with a ' + str(res) +
+                         '° cell edge')
+    return int(np.argmax(offsets < 1e-6))
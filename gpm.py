@@ -15,57 +15,82 @@ with TRMM.
 GPM precipitation is in mm/hour.
 """
 
+import os
+import re
 import glob
-import h5py
-import requests
+from concurrent.futures import ProcessPoolExecutor
 
 import xarray as xr
 import numpy as np
-from tqdm import tqdm
 
 
 import load.location_sel as ls
+import load.pointstore as pointstore
+from load.instrument import stage
+from load.memo import memoize
+import load.compact as compact
+from load.compact import compact_dataset
 from load import data_dir
 
+FILENAME_DATE = re.compile(r'[._-]((?:19|20)\d{2})(0[1-9]|1[0-2])(?:\d{2})?[._-]')
+
 # trmm_filepath =  'data/GPM/subset_GPM_3PR_06_20210611_090054.txt'
 # gpm_filepath =  'data/GPM/combi_TRMM_1997_2015_urls.txt'
 
 
-def collect_GPM(location: str, minyear: str, maxyear: str) -> xr.Dataset:
-    """ Load GPM data """
-    gpm_ds = xr.open_dataset(data_dir + "GPM/gpm_prtmi_1997-2015.nc")
+@memoize(lambda args: [data_dir + "GPM/gpm_prtmi_1997-2015.nc"])
+def collect_GPM(location: str, minyear: str, maxyear: str, from_cube=False) -> xr.Dataset:
+    """ Load GPM data, optionally from the common-grid cube (see cube.build_cube) """
+    if from_cube:
+        import load.cube as cube
+        ds = cube.collect('gpm', location, minyear, maxyear)
+        return compact_dataset(ds.assign_attrs(plot_legend="TRMM"))
+
+    filepath = data_dir + "GPM/gpm_prtmi_1997-2015.nc"
     # "GPM/gpm_pr_unc_2000-2010.nc")
+    with stage('open', filepath=filepath):
+        gpm_ds = xr.open_dataset(filepath)
 
     if type(location) == str:
         loc_ds = ls.select_basin(gpm_ds, location)
     else:
         lat, lon = location
-        loc_ds = gpm_ds.interp(
-            coords={"lon": lon, "lat": lat}, method="nearest")
-
-    tim_ds = loc_ds.sel(time=slice(minyear, maxyear))
+        with stage('interp', location=location):
+            if pointstore.is_current(filepath):
+                loc_ds = pointstore.point_series(filepath, lat, lon)
+            else:
+                loc_ds = gpm_ds.interp(
+                    coords={"lon": lon, "lat": lat}, method="nearest")
+
+    with stage('slice', minyear=minyear, maxyear=maxyear):
+        tim_ds = loc_ds.sel(time=slice(minyear, maxyear))
     ds = tim_ds.assign_attrs(plot_legend="TRMM")  # in mm/day
-    return ds
+    return compact_dataset(ds)
 
 
-def hdf5_download(url_filepath):
-    """ Downloads the monthly TRMM/GPM datasets """
+def hdf5_download(url_filepath, max_workers=4, revalidate=False):
+    """
+    Downloads the monthly TRMM/GPM datasets concurrently. Interrupted
+    downloads are resumed and files already downloaded are skipped, or if
+    revalidate is True, only downloaded again if they changed on the server.
+    """
+    from load.download import download_files
 
     with open(url_filepath) as f:
-        for line in tqdm(f):
-            url = line[:-1]
-            path = data_dir + 'GPM/PRTMI_1997-2015_TRMM3B43/' + \
-                url.split('/', -1)[-1]
-            r = requests.get(url, allow_redirects=True)
-            with open(path, 'wb') as file:
-                file.write(r.content)
-                file.close()
+        urls = [line.strip() for line in f if line.strip()]
+    download_files(urls, data_dir + 'GPM/PRTMI_1997-2015_TRMM3B43/',
+                   max_workers=max_workers, revalidate=revalidate)
 
 
-def to_netcdf():
+def to_netcdf(max_workers=None, chunk_size=12):
     """
     Function to open and merge files into one netcdf file.
 
+    HDF5 files are read in parallel worker processes, each reading only the
+    Indus hyperslab of the G2 grid. The monthly fields are appended to the
+    NetCDF file in time-ordered chunks, and months already in the file are
+    skipped so new files can be added incrementally.
+
     HDF5 keys :
     Level 1 : 'Grids', 'InputAlgorithmVersions', 'InputFileNames',
     'InputGenerationDateTimes'
@@ -87,33 +112,88 @@ def to_netcdf():
         ltH (536): high resolution 0.25° grid intervals of latitude from
         0.67°S to 0.67°N
     """
+    from tqdm import tqdm
+    import load.appendstore as appendstore
+    import load.http_cache as http_cache
 
-    ds_list = []
-    extent = ls.basin_extent('indus')
+    out_filepath = data_dir + "GPM/gpm_prtmi_1997-2015.nc"
     lon_arr = np.arange(-180, 180, 0.25)
     lat_arr = np.arange(-67, 67, 0.25)
+    extent = ls.basin_extent('indus')
+    lon_slice = slice(np.searchsorted(lon_arr, extent[1], side='left'),
+                      np.searchsorted(lon_arr, extent[3], side='right'))
+    lat_slice = slice(np.searchsorted(lat_arr, extent[2], side='left'),
+                      np.searchsorted(lat_arr, 36.0, side='right'))
+
+    files = glob.glob(data_dir + 'GPM/PRTMI_1997-2015_TRMM3B43/*')
+    files = [f for f in files
+             if not f.endswith(('.part', http_cache.VALIDATOR_SUFFIX))]
+    times = [file_month(f) for f in files]
+    order = np.argsort(times)
+    files = [files[i] for i in order]
+    times = np.array(times)[order]
+
+    # float32 only in compact mode, as with the other preprocessed files
+    tp_dtype = np.dtype('f4' if compact.is_compact() else 'f8')
+
+    # Only add months after those already stored, otherwise start again
+    if os.path.exists(out_filepath):
+        stored = appendstore.stored_times(out_filepath)
+        new = ~np.isin(times, stored)
+        if appendstore.stored_dtypes(out_filepath).get('tp') != tp_dtype:
+            os.remove(out_filepath)
+        elif len(stored) == 0 or np.all(times[new] > stored[-1]):
+            files, times = [f for f, n in zip(files, new) if n], times[new]
+        else:
+            os.remove(out_filepath)
+    if not os.path.exists(out_filepath):
+        appendstore.create(out_filepath, lat_arr[lat_slice], lon_arr[lon_slice],
+                           {'tp': tp_dtype}, chunk_time=chunk_size)
+
+    args = [(f, lon_slice, lat_slice) for f in files]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        tp_arrs = executor.map(read_hyperslab, args, chunksize=4)
+        for start in tqdm(range(0, len(files), chunk_size)):
+            chunk_times = times[start:start + chunk_size]
+            with stage('open', n_files=len(chunk_times)):
+                chunk_tp = np.stack([next(tp_arrs) for _ in chunk_times])
+            with stage('write', filepath=out_filepath):
+                appendstore.append(out_filepath, chunk_times,
+                                   {'tp': chunk_tp * 24})  # mm/hour ->  mm/day
+    pointstore.build(out_filepath)
+
+
+def read_hyperslab(args: tuple) -> np.array:
+    """
+    Read the G2 precipitation rate over a lat/lon index range from a HDF5
+    file.
 
-    for file in tqdm(glob.glob(data_dir + 'GPM/PRTMI_1997-2015_TRMM3B43/*')):
-
-        f = h5py.File(file, 'r')
-        dset = f['Grids']
-        tp_arr = dset['G2']['estimSurfPrecipTotRateUn']
-
-        #month_arr = np.arange(1./24., 1, 1./12.)
-        month = file[99:101]  # month_arr[int(file[52:54])-1]
-        year = file[95:99]
-        time = np.datetime64(year+'-'+month)  # np.float(file[48:52]) + month
-        ds = xr.Dataset(data_vars=dict(tp=(["time", "lon", "lat"],
-                                           [tp_arr[0, :, :]])),
-                        coords=dict(time=(["time"], [time]),
-                                    lat=(['lat'], lat_arr),
-                                    lon=(['lon'], lon_arr)))
-        ds_tr = ds.transpose('time', 'lat', 'lon')
-        ds_cropped = ds_tr.sel(
-            lon=slice(extent[1], extent[3]), lat=slice(extent[2], 36.0))
-        ds_list.append(ds_cropped)
-
-    ds_merged = xr.merge(ds_list)
-    print(ds_merged)
-    ds_merged['tp'] = ds_merged['tp'] * 24  # mm/hour ->  mm/day
-    ds_merged.to_netcdf(data_dir + "GPM/gpm_prtmi_1997-2015.nc")
+    Args:
+        args (tuple): filepath, longitude index slice, latitude index slice
+
+    Returns:
+        np.array: precipitation rate with shape (lat, lon)
+    """
+    import h5py
+
+    filepath, lon_slice, lat_slice = args
+    with h5py.File(filepath, 'r') as f:
+        tp_arr = f['Grids']['G2']['estimSurfPrecipTotRateUn']
+        return tp_arr[0, lon_slice, lat_slice].T
+
+
+def file_month(filepath: str) -> np.datetime64:
+    """
+    Return the month of a TRMM/GPM file from the YYYYMM or YYYYMMDD date in
+    its filename, e.g. 3A-MO.TRMM.PR.3PRTMI.19980101-S000000-E235959.01.V07A.HDF5
+
+    Args:
+        filepath (str): TRMM/GPM filepath
+
+    Returns:
+        np.datetime64: month of the data
+    """
+    match = FILENAME_DATE.search(os.path.basename(filepath))
+    if match is None:
+        raise ValueError('No date in filename: ' + filepath)
+    return np.datetime64(match.group(1) + '-' + match.group(2), 'ns')
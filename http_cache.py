@@ -0,0 +1,104 @@
+"""
+Conditional HTTP revalidation of downloaded files.
+
+The ETag and Last-Modified validators of each download are stored next to
+the file ('<file>.http.json'). Later requests send them back as
+If-None-Match/If-Modified-Since, so an unchanged file costs a 304 Not
+Modified round-trip instead of a transfer.
+"""
+
+import os
+import json
+import datetime
+
+import requests
+
+VALIDATOR_SUFFIX = '.http.json'
+
+
+def fetch(url: str, filepath: str, session: requests.Session = None) -> bool:
+    """
+    Download url to filepath, unless the local copy is still current.
+
+    Args:
+        url (str): file URL
+        filepath (str): local filepath
+        session (requests.Session, optional): session to reuse. Defaults to None.
+
+    Returns:
+        bool: whether the file was downloaded, False if it was not modified
+    """
+    if session is None:
+        session = requests.Session()
+
+    with session.get(url, headers=conditional_headers(filepath), stream=True,
+                     timeout=60) as r:
+        if r.status_code == 304:
+            save_validators(filepath, r.headers)
+            return False
+        r.raise_for_status()
+
+        tmp_filepath = filepath + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp_filepath, 'wb') as f:
+            for chunk in r.iter_content(chunk_size=1024 * 1024):
+                f.write(chunk)
+        os.replace(tmp_filepath, filepath)
+        save_validators(filepath, r.headers)
+    return True
+
+
+def is_modified(url: str, filepath: str, session: requests.Session = None) -> bool:
+    """
+    Return whether the remote file differs from the local copy, using a
+    conditional HEAD request. Files without stored validators count as
+    modified.
+    """
+    headers = conditional_headers(filepath)
+    if not headers:
+        return True
+    if session is None:
+        session = requests.Session()
+    r = session.head(url, headers=headers, allow_redirects=True, timeout=60)
+    if r.status_code == 304:
+        save_validators(filepath, r.headers)
+        return False
+    r.raise_for_status()
+    return True
+
+
+def conditional_headers(filepath: str) -> dict:
+    """ Returns the conditional request headers for a local file """
+    if not os.path.exists(filepath):
+        return {}
+    validators = read_validators(filepath)
+    headers = {}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+
+def read_validators(filepath: str) -> dict:
+    """ Returns the stored validators of a local file """
+    try:
+        with open(filepath + VALIDATOR_SUFFIX) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_validators(filepath: str, headers) -> dict:
+    """
+    Store the validators from response headers next to a local file. The
+    validators of a 304 response are merged with those already stored.
+    """
+    validators = read_validators(filepath)
+    if headers.get('ETag'):
+        validators['etag'] = headers['ETag']
+    if headers.get('Last-Modified'):
+        validators['last_modified'] = headers['Last-Modified']
+    validators['checked'] = datetime.datetime.now().isoformat()
+    with open(filepath + VALIDATOR_SUFFIX, 'w') as f:
+        json.dump(validators, f)
+    return validators
@@ -0,0 +1,172 @@
+"""
+Timing and memory instrumentation of the loading pipelines.
+
+Stages of the loaders (open, mask, slice, interp, merge, write, ...) are
+wrapped in `stage` blocks. When instrumentation is enabled, each block
+records an event with its wall time, the bytes read by the process, the
+change in its resident memory over the stage (rss_change) and the peak
+resident memory of the process so far (process_peak_rss). The peak is that
+of the whole process, so it is the same for every stage after the largest
+one. When it is disabled, which is the default, `stage`
+returns a shared no-op context manager.
+
+Instrumentation is switched on with `enable()` or by setting the LOAD_TRACE
+environment variable, and the events can be saved as JSON or as a Chrome
+trace (open in chrome://tracing or https://ui.perfetto.dev).
+
+Datasets are mostly opened lazily, so the data is read, and the time
+spent, in the stage that first uses the values.
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+import resource
+
+_enabled = os.environ.get('LOAD_TRACE', '0') not in ('', '0')
+_events = []
+_lock = threading.Lock()
+_process = None
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+_MAXRSS_BYTES = 1 if sys.platform == 'darwin' else 1024
+
+
+class _NullStage():
+    """ Context manager that does nothing, used when disabled """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage():
+    """ Context manager recording one event """
+
+    def __init__(self, name: str, args: dict):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start_read = _bytes_read()
+        self.start_rss = _rss()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.perf_counter()
+        event = {'name': self.name,
+                 'start': self.start,
+                 'seconds': end - self.start,
+                 'bytes_read': _bytes_read() - self.start_read,
+                 'rss_change': _rss() - self.start_rss,
+                 'process_peak_rss': resource.getrusage(
+                     resource.RUSAGE_SELF).ru_maxrss * _MAXRSS_BYTES,
+                 'pid': os.getpid(),
+                 'thread': threading.get_ident(),
+                 'args': {key: str(value) for key, value in self.args.items()}}
+        with _lock:
+            _events.append(event)
+        return False
+
+
+def stage(name: str, **args):
+    """
+    Returns a context manager recording a pipeline stage, e.g.
+    `with stage('open', filepath=filepath): ...`
+
+    Args:
+        name (str): stage name
+        **args: details stored with the event, e.g. filepath or location
+
+    Returns:
+        context manager
+    """
+    if not _enabled:
+        return _NULL_STAGE
+    return _Stage(name, args)
+
+
+def enable():
+    """ Start recording events """
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    """ Stop recording events """
+    global _enabled
+    _enabled = False
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def clear():
+    """ Forget the recorded events """
+    with _lock:
+        _events.clear()
+
+
+def events() -> list:
+    """ Returns a copy of the recorded events """
+    with _lock:
+        return list(_events)
+
+
+def to_json(filepath: str):
+    """ Save the recorded events as a JSON list """
+    with open(filepath, 'w') as f:
+        json.dump(events(), f, indent=1)
+
+
+def to_chrome_trace(filepath: str):
+    """ Save the recorded events in the Chrome trace event format """
+    trace_events = []
+    for event in events():
+        args = dict(event['args'], bytes_read=event['bytes_read'],
+                    rss_change=event['rss_change'],
+                    process_peak_rss=event['process_peak_rss'])
+        trace_events.append({'name': event['name'], 'ph': 'X',
+                             'ts': event['start'] * 1e6,
+                             'dur': event['seconds'] * 1e6,
+                             'pid': event['pid'], 'tid': event['thread'],
+                             'args': args})
+    with open(filepath, 'w') as f:
+        json.dump({'traceEvents': trace_events,
+                   'displayTimeUnit': 'ms'}, f)
+
+
+def _psutil_process():
+    """ Returns the psutil Process of the current process """
+    global _process
+    import psutil
+
+    if _process is None or _process.pid != os.getpid():
+        _process = psutil.Process()
+    return _process
+
+
+def _rss() -> int:
+    """ Returns the resident memory of the process in bytes """
+    return _psutil_process().memory_info().rss
+
+
+def _bytes_read() -> int:
+    """ Returns the number of bytes read by the process so far """
+    import psutil
+
+    _process = _psutil_process()
+    try:
+        counters = _process.io_counters()
+    except (AttributeError, psutil.Error):
+        # io_counters is not available on macOS
+        return 0
+    return getattr(counters, 'read_chars', counters.read_bytes)
@@ -5,6 +5,7 @@ Functions to help download data given
 - Coordinates
 """
 import xarray as xr
+from load.instrument import stage
 from load import data_dir
 
 
@@ -14,7 +15,8 @@ def select_basin(dataset, location):
     if mask_filepath is None:
         basin = dataset
     else:
-        basin = apply_mask(dataset, mask_filepath)
+        with stage('mask', location=location, filepath=mask_filepath):
+            basin = apply_mask(dataset, mask_filepath)
     return basin
 
 
@@ -0,0 +1,199 @@
+"""
+Persistent on-disk cache of collect_* results.
+
+Results are keyed by the function, its arguments, the compact mode and a
+fingerprint (path, size and modification time) of the function's module and
+of the source files it reads, so that they are recomputed when a data file,
+a mask or the code changes. Datasets are stored as NetCDF and other results
+are pickled, in data_dir + 'Memo/'.
+
+The cache is shared by processes: writes are atomic, and a lock file
+(fcntl) serialises writes and evictions. Once the total size goes over the
+limit, the least recently used results are evicted.
+
+Memoisation is switched on with `enable()` or by setting the LOAD_MEMO
+environment variable; the size limit is set with `set_max_size()` or
+LOAD_MEMO_MAX_SIZE (bytes).
+"""
+
+import os
+import glob
+import json
+import fcntl
+import pickle
+import hashlib
+import inspect
+import functools
+from contextlib import contextmanager
+
+import xarray as xr
+
+import load.compact as compact
+import load.location_sel as ls
+import load.pointstore as pointstore
+from load import data_dir
+
+_enabled = os.environ.get('LOAD_MEMO', '0') not in ('', '0')
+_max_size = int(os.environ.get('LOAD_MEMO_MAX_SIZE', 2 * 1024**3))
+RESULT_SUFFIXES = ('.nc', '.pkl')
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def set_max_size(max_size: int):
+    """ Set the total size limit of the cache in bytes """
+    global _max_size
+    _max_size = max_size
+
+
+def memo_dir() -> str:
+    return data_dir + 'Memo/'
+
+
+def memoize(sources):
+    """
+    Decorator caching the results of a function on disk when memoisation
+    is enabled.
+
+    Args:
+        sources (function): takes the function's arguments as a dict and
+            returns the filepaths it reads. The mask or point stores used
+            for a 'location' argument, and the cube if 'from_cube' is
+            True, are added automatically.
+
+    Returns:
+        decorator
+    """
+    def decorator(function):
+        signature = inspect.signature(function)
+        module_filepath = inspect.getsourcefile(function)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = dict(bound.arguments)
+            source_filepaths = list(sources(arguments))
+            filepaths = [module_filepath] + source_filepaths
+            location = arguments.get('location')
+            if type(location) == str:
+                filepaths.append(_mask_filepath(location))
+            elif location is not None:
+                for filepath in source_filepaths:
+                    filepaths.extend(pointstore.store_filepaths(filepath))
+            if arguments.get('from_cube'):
+                import load.cube as cube
+                filepaths.extend(cube.cube_filepath(layout)
+                                 for layout in cube.CUBE_CHUNKS)
+            key = cache_key(function, arguments, filepaths)
+
+            result = load_result(key)
+            if result is None:
+                result = function(*args, **kwargs)
+                save_result(key, result)
+            return result
+        return wrapper
+    return decorator
+
+
+def cache_key(function, arguments: dict, filepaths: list) -> str:
+    """ Returns the key of a call from its arguments and its files' fingerprints """
+    fingerprints = []
+    for filepath in filepaths:
+        if filepath is not None and os.path.exists(filepath):
+            stat = os.stat(filepath)
+            fingerprints.append([os.path.abspath(filepath), stat.st_size,
+                                 stat.st_mtime_ns])
+        else:
+            fingerprints.append([filepath, None, None])
+    description = [function.__module__ + '.' + function.__qualname__,
+                   {name: repr(value) for name, value in arguments.items()},
+                   compact.is_compact(), fingerprints]
+    return hashlib.sha256(json.dumps(description).encode()).hexdigest()
+
+
+def load_result(key: str):
+    """ Returns a cached result, or None """
+    with locked(memo_dir() + '.lock', fcntl.LOCK_SH):
+        for suffix in RESULT_SUFFIXES:
+            filepath = memo_dir() + key + suffix
+            if not os.path.exists(filepath):
+                continue
+            if suffix == '.nc':
+                result = xr.load_dataset(filepath)
+            else:
+                with open(filepath, 'rb') as f:
+                    result = pickle.load(f)
+            # the modification time records the last use, for eviction
+            os.utime(filepath)
+            return result
+    return None
+
+
+def save_result(key: str, result):
+    """ Atomically store a result, then evict old results over the size limit """
+    suffix = '.nc' if isinstance(result, xr.Dataset) else '.pkl'
+    filepath = memo_dir() + key + suffix
+    os.makedirs(memo_dir(), exist_ok=True)
+    tmp_filepath = filepath + '.' + str(os.getpid()) + '.tmp'
+    if suffix == '.nc':
+        result.to_netcdf(tmp_filepath)
+    else:
+        with open(tmp_filepath, 'wb') as f:
+            pickle.dump(result, f)
+
+    with locked(memo_dir() + '.lock', fcntl.LOCK_EX):
+        os.replace(tmp_filepath, filepath)
+        evict(_max_size)
+
+
+def evict(max_size: int):
+    """ Remove the least recently used results until the cache fits in max_size bytes """
+    filepaths = [f for f in glob.glob(memo_dir() + '*')
+                 if f.endswith(RESULT_SUFFIXES)]
+    stats = sorted(((os.stat(f).st_mtime, os.stat(f).st_size, f)
+                    for f in filepaths), reverse=True)
+    total = 0
+    for _, size, filepath in stats:
+        total += size
+        if total > max_size:
+            os.remove(filepath)
+
+
+def clear():
+    """ Remove all cached results """
+    with locked(memo_dir() + '.lock', fcntl.LOCK_EX):
+        evict(0)
+
+
+@contextmanager
+def locked(lock_filepath: str, operation):
+    """
+    Holds a lock file, shared (fcntl.LOCK_SH) for reads and exclusive
+    (fcntl.LOCK_EX) for writes, e.g. the cache lock memo_dir() + '.lock'.
+    """
+    os.makedirs(os.path.dirname(lock_filepath), exist_ok=True)
+    with open(lock_filepath, 'a') as lock_file:
+        fcntl.flock(lock_file, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _mask_filepath(location: str) -> str:
+    try:
+        return ls.find_mask(location)
+    except KeyError:
+        return None
@@ -0,0 +1,43 @@
+"""
+Lazy multi-file opening for datasets split in time across several files
+(CORDEX, CMIP). Files are opened in parallel and only their metadata is
+read; the data stays lazy (dask) until it is used.
+"""
+
+import xarray as xr
+
+from load.time_encoding import to_month_start
+
+
+def open_files(files: list, minyear: str = None, maxyear: str = None, preprocess=None, month_start=True) -> xr.Dataset:
+    """
+    Lazily open and concatenate files along time.
+
+    Each file is preprocessed and sliced to the requested years before
+    concatenation, so only the data within [minyear, maxyear] is ever read.
+
+    Args:
+        files (list): filepaths ordered by time
+        minyear (str, optional): minimum year of data. Defaults to None.
+        maxyear (str, optional): maximum year of data (inclusive). Defaults to None.
+        preprocess (function, optional): applied to each file's dataset
+            before slicing. Defaults to None.
+        month_start (bool, optional): whether to set times to the start of
+            the month, as for all monthly datasets. Defaults to True.
+
+    Returns:
+        xr.Dataset: lazy dataset
+    """
+
+    def _preprocess(ds):
+        if preprocess is not None:
+            ds = preprocess(ds)
+        if month_start:
+            ds = ds.assign_coords(time=to_month_start(ds.time.values))
+        return ds.sel(time=slice(minyear, maxyear))
+
+    ds = xr.open_mfdataset(files, preprocess=_preprocess, parallel=True,
+                           combine='nested', concat_dim='time',
+                           data_vars='minimal', coords='minimal',
+                           compat='override')
+    return ds
@@ -1,35 +1,80 @@
+"""
+Monthly climate indices from NOAA PSL.
+
+The parsed indices are kept in a single NetCDF store (one float variable
+per index on a shared monthly time axis), which is refreshed once a month.
+Stale indices are revalidated concurrently, and only downloaded again if
+they changed on the server.
+"""
+
 import os
-import urllib
-import numpy as np
 import datetime
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
+import xarray as xr
+
 from load import data_dir
 
+INDICE_URLS = {"N34": "https://psl.noaa.gov/data/correlation/nina34.data",
+               "NAO": "https://www.psl.noaa.gov/data/correlation/nao.data",
+               "N4": "https://psl.noaa.gov/data/correlation/nina4.data"}
+
 
 def indice_downloader(all_var=False):
     """ Return indice Dataframe."""
 
-    nao_url = "https://www.psl.noaa.gov/data/correlation/nao.data"
-    n34_url = "https://psl.noaa.gov/data/correlation/nina34.data"
-    n4_url = "https://psl.noaa.gov/data/correlation/nina4.data"
-
-    n34_df = update_url_data(n34_url, "N34")
-
     if all_var is False:
-        ind_df = n34_df.astype("float64")
+        ind_df = load_indices(["N34"])
     else:
-        nao_df = update_url_data(nao_url, "NAO")
-        n4_df = update_url_data(n4_url, "N4")
-        ind_df = n34_df.join([nao_df, n4_df])
+        ind_df = load_indices(["N34", "NAO", "N4"])
+
+    # keep the months covered by N34
+    return ind_df[ind_df["N34"].notna()]
+
+
+def load_indices(names: list) -> pd.DataFrame:
+    """
+    Return monthly indices from the index store, downloading the indices
+    that are missing or were not updated this month.
+
+    Args:
+        names (list): index names, keys of INDICE_URLS
 
-    return ind_df
+    Returns:
+        pd.DataFrame: indices with a 'time' index
+    """
+    store_filepath = data_dir + "NOAA/indices.nc"
+    now = datetime.datetime.now().strftime("%m-%Y")
+
+    stored, updated = {}, {}
+    if os.path.exists(store_filepath):
+        with xr.open_dataset(store_filepath) as store_ds:
+            for name in store_ds.data_vars:
+                stored[name] = store_ds[name].to_series().dropna()
+                updated[name] = store_ds[name].attrs.get("updated")
+
+    stale = [name for name in names if updated.get(name) != now]
+    if len(stale) > 0:
+        with ThreadPoolExecutor(max_workers=len(stale)) as executor:
+            dfs = executor.map(update_url_data,
+                               [INDICE_URLS[name] for name in stale], stale)
+            for name, df in zip(stale, dfs):
+                stored[name] = df[name]
+                updated[name] = now
+        _save_store(store_filepath, stored, updated)
+
+    return pd.concat([stored[name] for name in names], axis=1)
 
 
 def save_csv_from_url(url, saving_path):
-    """Downloads data from a url and saves it to a specified path."""
-    response = urllib.request.urlopen(url)
-    with open(saving_path, "wb") as f:
-        f.write(response.read())
+    """
+    Downloads data from a url and saves it to a specified path. A saved
+    file is revalidated with a conditional request and only downloaded
+    again if it changed.
+    """
+    import load.http_cache as http_cache
+    return http_cache.fetch(url, saving_path)
 
 
 def update_url_data(url, name):
@@ -37,33 +82,47 @@ def update_url_data(url, name):
     Import the most recent dataset from URL and return it as pandas DataFrame.
     """
 
-    filepath = data_dir + "NOAA/"
-    now = datetime.datetime.now()
-    file = filepath + name + "-" + now.strftime("%m-%Y") + ".csv"
-
-    # Only download CSV if not present locally
-    if not os.path.exists(file):
-        save_csv_from_url(url, file)
-
-    # create and format DataFrame
-    df = pd.read_csv(file)
-    df_split = df[list(df)[0]].str.split(expand=True)
-    df_long = pd.melt(
-        df_split,
-        id_vars=[0],
-        value_vars=np.arange(1, 13),
-        var_name="month",
-        value_name=name,
-    )
-
-    # Create a datetime column
-    df_long["time"] = df_long[0].astype(
-        str) + "-" + df_long["month"].astype(str)
-    df_long["time"] = pd.to_datetime(df_long["time"], errors="coerce")
-
-    # Clean
-    df_clean = df_long.dropna()
-    df_sorted = df_clean.sort_values(by=["time"])
-    df_final = df_sorted.set_index("time")
-
-    return pd.DataFrame(df_final[name])
+    file = data_dir + "NOAA/" + name + ".csv"
+    save_csv_from_url(url, file)
+
+    return parse_psl_data(file, name)
+
+
+def parse_psl_data(filepath: str, name: str) -> pd.DataFrame:
+    """
+    Parse a NOAA PSL monthly data file: a header line with the first and
+    last years, one line per year with the year and twelve monthly values,
+    then the missing value and a description.
+
+    Args:
+        filepath (str): filepath of the PSL data file
+        name (str): index name
+
+    Returns:
+        pd.DataFrame: index values with a 'time' index, missing months dropped
+    """
+    with open(filepath) as f:
+        lines = f.read().splitlines()
+    first_year, last_year = (int(y) for y in lines[0].split()[:2])
+    n_years = last_year - first_year + 1
+
+    values = np.loadtxt(lines[1:n_years + 1], ndmin=2)
+    missing_value = float(lines[n_years + 1].split()[0])
+
+    months = (values[:, :1].astype(int) - 1970) * 12 + np.arange(12)
+    time = months.ravel().astype("datetime64[M]").astype("datetime64[ns]")
+    data = values[:, 1:].ravel()
+    data[np.isclose(data, missing_value)] = np.nan
+
+    df = pd.DataFrame({name: data}, index=pd.DatetimeIndex(time, name="time"))
+    return df.dropna()
+
+
+def _save_store(store_filepath: str, indices: dict, updated: dict):
+    """ Atomically writes the index series to the index store """
+    ds = pd.concat(indices, axis=1).rename_axis("time").to_xarray()
+    for name in indices:
+        ds[name].attrs.update(url=INDICE_URLS[name], updated=updated[name])
+    tmp_filepath = store_filepath + "." + str(os.getpid()) + ".tmp"
+    ds.to_netcdf(tmp_filepath)
+    os.replace(tmp_filepath, store_filepath)
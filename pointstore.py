@@ -0,0 +1,181 @@
+"""
+Point-optimised copies of the preprocessed gridded files.
+
+NetCDF files laid out by time make a single grid cell's record expensive to
+read: every chunk of the file is decoded to keep one value. A point store
+holds the same variables as uncompressed arrays in cell-major order
+(lat, lon, time), so that a cell's whole record is one contiguous slice of
+a memory-mapped file. The grid, times, variables and source file state are
+kept in a JSON sidecar, e.g.
+
+    CRU/interpolated_cru_1901-2019.points.bin
+    CRU/interpolated_cru_1901-2019.points.json
+
+Every variable on the lat/lon grid is stored in its source dtype, or as
+float32 for float64 variables when the store is built in compact mode (see
+load.compact), so that reads match nearest neighbour interpolation of the
+NetCDF file exactly. A compact store is only used in compact mode.
+
+The preprocessing functions write the stores of their outputs, and build()
+adds one to an existing file. The collect functions read points from a
+store when it is up to date with its NetCDF file.
+"""
+
+import os
+import json
+
+import numpy as np
+import xarray as xr
+
+import load.compact as compact
+
+
+def store_filepaths(filepath: str) -> tuple:
+    """ Returns the array and sidecar filepaths of the point store of a NetCDF file """
+    base = os.path.splitext(filepath)[0]
+    return base + '.points.bin', base + '.points.json'
+
+
+def build(filepath: str, lat_block: int = 8):
+    """
+    Write the point store of a NetCDF file, reading it a few latitude rows
+    at a time.
+
+    Args:
+        filepath (str): NetCDF filepath
+        lat_block (int, optional): number of latitude rows read at once.
+            Defaults to 8.
+    """
+    array_filepath, meta_filepath = store_filepaths(filepath)
+    tmp_filepath = array_filepath + '.' + str(os.getpid()) + '.tmp'
+    compact_store = compact.is_compact()
+
+    with xr.open_dataset(filepath) as ds:
+        names = [name for name, da in ds.data_vars.items()
+                 if {'lat', 'lon'} <= set(da.dims)
+                 and set(da.dims) <= {'time', 'lat', 'lon'}]
+        variables = {}
+        offset = 0
+        with open(tmp_filepath, 'wb'):
+            pass
+        for name in names:
+            dims = [d for d in ('lat', 'lon', 'time') if d in ds[name].dims]
+            da = ds[name].transpose(*dims)
+            dtype = da.dtype
+            if compact_store and dtype == np.float64:
+                dtype = np.dtype('float32')
+            values = np.memmap(tmp_filepath, dtype=dtype, mode='r+',
+                               offset=offset, shape=da.shape)
+            for start in range(0, da.shape[0], lat_block):
+                values[start:start + lat_block] = da.isel(
+                    lat=slice(start, start + lat_block)).values
+            values.flush()
+            del values
+            variables[name] = {'dims': dims, 'shape': list(da.shape),
+                               'dtype': dtype.str, 'offset': offset,
+                               'attrs': _json_attrs(da.attrs)}
+            offset += int(np.prod(da.shape)) * dtype.itemsize
+
+        meta = {'variables': variables,
+                'lat': ds.lat.values.tolist(),
+                'lon': ds.lon.values.tolist(),
+                'time': (np.datetime_as_string(
+                    ds.time.values.astype('datetime64[ns]')).tolist()
+                    if 'time' in ds.coords else None),
+                'attrs': _json_attrs(ds.attrs),
+                'compact': compact_store,
+                'source_mtime': os.path.getmtime(filepath),
+                'source_size': os.path.getsize(filepath)}
+
+    os.replace(tmp_filepath, array_filepath)
+    # the sidecar is written last, so a store is only used once complete
+    with open(meta_filepath + '.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(meta_filepath + '.tmp', meta_filepath)
+
+
+def is_current(filepath: str) -> bool:
+    """
+    Returns whether a NetCDF file has a point store built from its current
+    version, at the precision of the current mode.
+    """
+    meta = _read_meta(filepath)
+    if meta is None or 'variables' not in meta or not os.path.exists(filepath):
+        return False
+    if meta['compact'] and not compact.is_compact():
+        return False
+    return (meta['source_mtime'] == os.path.getmtime(filepath)
+            and meta['source_size'] == os.path.getsize(filepath))
+
+
+def point_series(filepath: str, lat: float, lon: float) -> xr.Dataset:
+    """
+    Read the record of the grid cell nearest to a point from the point
+    store of a NetCDF file. As with nearest neighbour interpolation, points
+    outside the grid return NaNs and integer variables are returned as
+    float64.
+
+    Args:
+        filepath (str): NetCDF filepath
+        lat (float): latitude in °N
+        lon (float): longitude in °E
+
+    Returns:
+        xr.Dataset: variables at the point, backed by the memory-mapped store
+    """
+    meta = _read_meta(filepath)
+    array_filepath, _ = store_filepaths(filepath)
+    i = _nearest_index(np.array(meta['lat']), lat)
+    j = _nearest_index(np.array(meta['lon']), lon)
+
+    coords = {}
+    if meta['time'] is not None:
+        coords['time'] = np.array(meta['time'], dtype='datetime64[ns]')
+    data_vars = {}
+    for name, variable in meta['variables'].items():
+        dtype = np.dtype(variable['dtype'])
+        shape = tuple(variable['shape'])
+        if i is None or j is None:
+            values = np.full(shape[2:], np.nan,
+                             dtype=dtype if dtype.kind == 'f' else 'float64')
+        else:
+            values = np.memmap(array_filepath, dtype=dtype, mode='r',
+                               offset=variable['offset'], shape=shape)[i, j]
+            if dtype.kind != 'f':
+                values = values.astype('float64')
+        data_vars[name] = xr.DataArray(values, dims=variable['dims'][2:],
+                                       attrs=variable['attrs'])
+
+    ds = xr.Dataset(data_vars, coords=coords, attrs=meta['attrs'])
+    return ds.assign_coords(lat=lat, lon=lon)
+
+
+def _read_meta(filepath: str) -> dict:
+    _, meta_filepath = store_filepaths(filepath)
+    try:
+        with open(meta_filepath) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _json_attrs(attrs: dict) -> dict:
+    """ Returns attributes with numpy values as JSON types """
+    json_attrs = {}
+    for key, value in attrs.items():
+        if isinstance(value, (np.ndarray, np.generic)):
+            value = value.tolist()
+        json_attrs[key] = value if isinstance(
+            value, (str, int, float, list, bool)) else str(value)
+    return json_attrs
+
+
+def _nearest_index(values: np.array, x: float) -> int:
+    """ Returns the index of the nearest value of a sorted grid, or None outside it """
+    if np.isnan(x) or x < values.min() or x > values.max():
+        return None
+    ascending = values[-1] >= values[0]
+    grid = values if ascending else values[::-1]
+    i = int(np.clip(np.searchsorted(grid, x), 1, len(grid) - 1))
+    i = i - 1 if x - grid[i - 1] <= grid[i] - x else i
+    return i if ascending else len(values) - 1 - i
@@ -0,0 +1,163 @@
+"""
+Monthly resampling kernel shared by the preprocessing functions.
+
+The month boundaries of a time axis are found once, and each month is
+reduced with a segment reduction (np.add.reduceat and the like) over the
+time axis of N-D arrays, instead of building a groupby object per file.
+Like resample('MS'), every month between the first and last time is
+returned, and the missing value policy is explicit:
+
+- skipna: NaNs are ignored (True) or make the month NaN (False)
+- min_count: months with fewer valid values are NaN. By default 0 for sums
+  (months without valid values sum to 0) and 1 otherwise, as with pandas
+  and xarray
+
+The number of valid values of each month is returned alongside.
+"""
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+REDUCTIONS = ('mean', 'sum', 'max', 'min')
+
+
+def month_bounds(times: np.array) -> tuple:
+    """
+    Returns the months present in a sorted time axis and the index of the
+    first time step of each.
+    """
+    months = np.asarray(times, dtype='datetime64[ns]').astype('datetime64[M]')
+    bounds = np.flatnonzero(np.r_[True, months[1:] != months[:-1]])
+    return months[bounds], bounds
+
+
+def monthly_reduce(values: np.array, times: np.array, how: str = 'mean', axis: int = 0, min_count: int = None, skipna: bool = True) -> tuple:
+    """
+    Reduce an array over calendar months along its time axis.
+
+    Args:
+        values (np.array): N-D array
+        times (np.array): datetime64 times along the axis
+        how (str, optional): 'mean', 'sum', 'max' or 'min'. Defaults to 'mean'.
+        axis (int, optional): time axis. Defaults to 0.
+        min_count (int, optional): minimum number of valid values for a
+            month not to be NaN. Defaults to 0 for sums and 1 otherwise.
+        skipna (bool, optional): whether to ignore NaNs. Defaults to True.
+
+    Returns:
+        tuple: datetime64 month starts, reduced values and counts of valid
+            values, with one step per month along the axis. Months without
+            data are NaN, or 0 for sums with min_count=0 (the default).
+    """
+    if how not in REDUCTIONS:
+        raise ValueError('Unknown reduction: ' + how)
+    if min_count is None:
+        min_count = 0 if how == 'sum' else 1
+    times = np.asarray(times, dtype='datetime64[ns]')
+    values = np.moveaxis(np.asarray(values), axis, 0)
+    out_dtype = values.dtype if values.dtype in (
+        np.float32, np.float64) else np.float64
+    if len(times) == 0:
+        empty = np.empty((0,) + values.shape[1:])
+        return (times, np.moveaxis(empty.astype(out_dtype), 0, axis),
+                np.moveaxis(empty.astype('int64'), 0, axis))
+
+    if np.any(times[1:] < times[:-1]):
+        order = np.argsort(times, kind='stable')
+        times, values = times[order], values[order]
+    values = values.astype('float64')
+
+    present, bounds = month_bounds(times)
+    valid = ~np.isnan(values)
+    counts = np.add.reduceat(valid.astype('int64'), bounds, axis=0)
+    if how in ('mean', 'sum'):
+        reduced = np.add.reduceat(np.where(valid, values, 0.), bounds, axis=0)
+        if how == 'mean':
+            reduced /= np.maximum(counts, 1)
+    elif how == 'max':
+        reduced = np.fmax.reduceat(values, bounds, axis=0)
+    else:
+        reduced = np.fmin.reduceat(values, bounds, axis=0)
+
+    # means, maxima and minima of months without valid values are undefined
+    required = min_count if how == 'sum' else max(min_count, 1)
+    missing = counts < required
+    if not skipna:
+        lengths = np.diff(np.r_[bounds, len(times)])
+        missing |= counts < lengths.reshape((-1,) + (1,) * (values.ndim - 1))
+    reduced[missing] = np.nan
+
+    # every month from the first to the last, as with resample('MS')
+    months = np.arange(present[0], present[-1] + 1)
+    fill_value = 0. if how == 'sum' and min_count <= 0 else np.nan
+    result = np.full((len(months),) + values.shape[1:], fill_value)
+    all_counts = np.zeros((len(months),) + values.shape[1:], dtype='int64')
+    month_index = (present - months[0]).astype(int)
+    result[month_index] = reduced
+    all_counts[month_index] = counts
+
+    return (months.astype('datetime64[ns]'),
+            np.moveaxis(result.astype(out_dtype), 0, axis),
+            np.moveaxis(all_counts, 0, axis))
+
+
+def monthly(obj: xr.DataArray or xr.Dataset, how: str = 'mean', dim: str = 'time', min_count: int = None, skipna: bool = True) -> xr.DataArray or xr.Dataset:
+    """
+    Monthly resampling of a DataArray, or of the variables of a Dataset
+    along a time dimension. Variables without the dimension are kept as they
+    are. Equivalent to obj.resample(time='MS').<how>(), except that sums of
+    months without any time steps are 0, as with pandas, where xarray
+    returns NaN.
+
+    Args:
+        obj (xr.DataArray or xr.Dataset): data with a datetime dimension
+        how (str, optional): 'mean', 'sum', 'max' or 'min'. Defaults to 'mean'.
+        dim (str, optional): time dimension. Defaults to 'time'.
+        min_count (int, optional): see monthly_reduce. Defaults to 0 for
+            sums and 1 otherwise.
+        skipna (bool, optional): see monthly_reduce. Defaults to True.
+
+    Returns:
+        xr.DataArray or xr.Dataset: monthly data, keeping attributes
+    """
+    times = obj[dim].values
+    if isinstance(obj, xr.Dataset):
+        data_vars = {name: monthly(da, how, dim, min_count, skipna)
+                     if dim in da.dims else da
+                     for name, da in obj.data_vars.items()}
+        ds = xr.Dataset(data_vars, attrs=obj.attrs)
+        return ds.assign_coords({name: coord for name, coord in obj.coords.items()
+                                 if dim not in coord.dims})
+
+    months, values, _ = monthly_reduce(obj.values, times, how,
+                                       axis=obj.get_axis_num(dim),
+                                       min_count=min_count, skipna=skipna)
+    coords = {name: coord for name, coord in obj.coords.items()
+              if dim not in coord.dims}
+    coords[dim] = months
+    return xr.DataArray(values, dims=obj.dims, coords=coords, name=obj.name,
+                        attrs=obj.attrs)
+
+
+def monthly_frame(df: pd.DataFrame or pd.Series, how: str = 'mean', min_count: int = None, skipna: bool = True) -> pd.DataFrame or pd.Series:
+    """
+    Monthly resampling of a DataFrame or Series with a DatetimeIndex.
+    Equivalent to df.resample('MS').<how>().
+
+    Args:
+        df (pd.DataFrame or pd.Series): numeric data indexed by time
+        how (str, optional): 'mean', 'sum', 'max' or 'min'. Defaults to 'mean'.
+        min_count (int, optional): see monthly_reduce. Defaults to 0 for
+            sums and 1 otherwise.
+        skipna (bool, optional): see monthly_reduce. Defaults to True.
+
+    Returns:
+        pd.DataFrame or pd.Series: monthly data
+    """
+    months, values, _ = monthly_reduce(df.values.astype(float), df.index.values,
+                                       how, min_count=min_count, skipna=skipna)
+    index = pd.DatetimeIndex(months, name=df.index.name)
+    if isinstance(df, pd.Series):
+        return pd.Series(values, index=index, name=df.name)
+    return pd.DataFrame(values, index=index, columns=df.columns)
@@ -1,6 +1,12 @@
 # Tests
 
-from load import aphrodite, era5, cordex
+import os
+import glob
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from load import aggregate, aphrodite, cmip5, era5, cordex, catalogue, colocate, compact, cru, cube, dispatch, download, eof, feature_store, gmted2010, gpm, http_cache, instrument, location_sel, memo, multifile, noaa_indices, pointstore, resample, time_encoding, value
 import xarray as xr
 import numpy as np
 import pandas as pd
@@ -91,3 +97,872 @@ def test_collect_is_datetime(collect_function):
     dataset_df.set_index('time', inplace=True)
     assert all(dataset_df.index.is_month_start ==
                True), "time is not month start"
+
+
+@pytest.mark.parametrize("calendar", ['standard', 'noleap', '360_day'])
+def test_fractional_year_round_trip(calendar):
+    """Check fractional years convert back to the same dates."""
+    years = time_encoding.daily_fractional_years(1950, 2050, calendar)
+    assert len(years) == time_encoding.days_in_year(
+        np.arange(1950, 2050), calendar).sum()
+    dates = time_encoding.from_fractional_year(years, calendar)
+    assert np.allclose(time_encoding.to_fractional_year(dates), years)
+
+
+@pytest.mark.parametrize("calendar", ['standard', 'noleap', '360_day'])
+@pytest.mark.parametrize("start_year", [1500, 2290])
+def test_fractional_year_outside_ns_range(calendar, start_year):
+    """Check dates before 1678 and after 2261 do not wrap around."""
+    import cftime
+    years = time_encoding.daily_fractional_years(start_year, start_year + 2,
+                                                 calendar)
+    if calendar == 'standard':
+        days = np.arange(len(years)) + cftime.date2num(
+            cftime.datetime(start_year, 1, 1, calendar='proleptic_gregorian'),
+            'days since 0001-01-01', calendar='proleptic_gregorian')
+        dates = cftime.num2date(days, 'days since 0001-01-01',
+                                calendar='proleptic_gregorian')
+        with pytest.raises(ValueError):
+            time_encoding.from_fractional_year(years, calendar)
+        with pytest.raises(ValueError):
+            time_encoding.to_month_start(dates)
+    else:
+        dates = time_encoding.from_fractional_year(years, calendar)
+    assert np.allclose(time_encoding.to_fractional_year(dates), years)
+
+
+def test_fractional_year_missing_values():
+    """Check NaT, NaN and None convert to missing values."""
+    times = np.array(['2000-07-01', 'NaT'], dtype='datetime64[ns]')
+    years = time_encoding.to_fractional_year(times)
+    assert np.isclose(years[0], 2000 + 182 / 366) and np.isnan(years[1])
+    dates = time_encoding.from_fractional_year(years)
+    assert abs(dates[0] - times[0]) < np.timedelta64(1, 'ms')
+    assert np.isnat(dates[1])
+    assert np.isnat(time_encoding.to_month_start(times)[1])
+    import cftime
+    cf_times = np.array([cftime.datetime(2000, 1, 16, calendar='360_day'), None])
+    assert np.isnan(time_encoding.to_fractional_year(cf_times)[1])
+    assert np.isnat(time_encoding.to_month_start(cf_times)[1])
+
+
+def test_interval_tree_overlap():
+    """Check interval tree queries match a brute force search."""
+    rng = np.random.default_rng(0)
+    starts = rng.integers(1950, 2100, 200)
+    intervals = [(s, s + rng.integers(0, 10), i) for i, s in enumerate(starts)]
+    tree = catalogue.IntervalTree(intervals)
+    for start, end in [(1900, 1949), (1960, 1960), (1990, 2005), (2099, 2200)]:
+        expected = {i for s, e, i in intervals if s <= end and e >= start}
+        assert set(tree.overlap(start, end)) == expected
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    """Local stand-in for a data server, supporting Range and conditional requests."""
+    content = bytes(range(256)) * 4096
+    etag = '"v1"'
+    requests = []
+    range_start = None  # serve ranges from this byte instead, if set
+
+    def do_HEAD(self):
+        self.do_GET(body=False)
+
+    def do_GET(self, body=True):
+        self.requests.append(self.headers.get('Range'))
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        start = 0
+        if self.headers.get('Range') is not None:
+            start = int(self.headers['Range'].split('=')[1].split('-')[0])
+            if self.range_start is not None:
+                start = self.range_start
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes ' + str(start) + '-' +
+                             str(len(self.content) - 1) + '/' +
+                             str(len(self.content)))
+        else:
+            self.send_response(200)
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Length', str(len(self.content) - start))
+        self.end_headers()
+        if body:
+            self.wfile.write(self.content[start:])
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def http_server():
+    """Serve RangeRequestHandler on a local port."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), RangeRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    RangeRequestHandler.requests = []
+    yield 'http://127.0.0.1:' + str(server.server_port)
+    server.shutdown()
+
+
+def test_download_resumes_partial_file(http_server, tmp_path):
+    """Check partial downloads are resumed and complete files skipped."""
+    content = RangeRequestHandler.content
+    (tmp_path / 'a.HDF5.part').write_bytes(content[:1000])
+    urls = [http_server + '/a.HDF5', http_server + '/b.HDF5']
+
+    filepaths = download.download_files(urls, str(tmp_path), max_workers=2)
+    for filepath in filepaths:
+        with open(filepath, 'rb') as f:
+            assert f.read() == content
+    assert set(RangeRequestHandler.requests) == {'bytes=1000-', None}
+
+    download.download_files(urls, str(tmp_path))
+    assert len(RangeRequestHandler.requests) == 2, "complete files downloaded again"
+
+
+def test_download_restarts_mismatched_parts(http_server, tmp_path, monkeypatch):
+    """Check part files are not spliced with other ranges or versions."""
+    content = RangeRequestHandler.content
+    filepath = str(tmp_path / 'a.HDF5')
+
+    # a range that does not start at the end of the part file
+    monkeypatch.setattr(RangeRequestHandler, 'range_start', 0)
+    (tmp_path / 'a.HDF5.part').write_bytes(content[:1000])
+    download.download_file(http_server + '/a.HDF5', filepath)
+    with open(filepath, 'rb') as f:
+        assert f.read() == content
+    assert RangeRequestHandler.requests == ['bytes=1000-', None]
+
+    # a part file of the previous version of a changed file
+    monkeypatch.setattr(RangeRequestHandler, 'etag', '"v2"')
+    (tmp_path / 'a.HDF5.part').write_bytes(b'old' * 1000)
+    download.download_file(http_server + '/a.HDF5', filepath, revalidate=True)
+    with open(filepath, 'rb') as f:
+        assert f.read() == content
+    assert not os.path.exists(filepath + '.part')
+
+
+def test_parse_psl_data(tmp_path):
+    """Check NOAA PSL files parse to monthly values with missing months dropped."""
+    filepath = tmp_path / 'nina34.data'
+    filepath.write_text(
+        '  2021  2022\n'
+        '2021  -1.00  -0.90  -0.80  -0.70  -0.60  -0.50  '
+        '-0.40  -0.30  -0.20  -0.10   0.00   0.10\n'
+        '2022   0.20   0.30 -99.99 -99.99 -99.99 -99.99 '
+        '-99.99 -99.99 -99.99 -99.99 -99.99 -99.99\n'
+        '  -99.99\n'
+        '  Nino Anom 3.4 Index using ersstv5\n')
+    df = noaa_indices.parse_psl_data(str(filepath), 'N34')
+    assert list(df) == ['N34']
+    assert len(df) == 14
+    assert df.index[0] == pd.Timestamp('2021-01-01')
+    assert df.index[-1] == pd.Timestamp('2022-02-01')
+    assert df['N34'].dtype == np.float64
+
+
+def test_http_cache_revalidates(http_server, tmp_path):
+    """Check unchanged files are revalidated without a transfer."""
+    filepath = str(tmp_path / 'nina34.data')
+    assert http_cache.fetch(http_server + '/nina34.data', filepath)
+    assert http_cache.read_validators(filepath)['etag'] == '"v1"'
+    assert not http_cache.fetch(http_server + '/nina34.data', filepath)
+    with open(filepath, 'rb') as f:
+        assert f.read() == RangeRequestHandler.content
+
+
+def test_terrain_attributes_plane():
+    """Check slope and aspect of a plane rising northwards, across tiles."""
+    lat = np.arange(29, 34, 0.0625)
+    lon = np.arange(75, 83, 0.0625)
+    north = np.deg2rad(lat - 29) * gmted2010.EARTH_RADIUS
+    elevation = xr.DataArray(np.tile(0.05 * north[:, np.newaxis], len(lon)),
+                             dims=('nlat', 'nlon'), coords={'nlat': lat, 'nlon': lon})
+    terrain_ds = gmted2010.terrain_attributes(elevation, tile_size=25).compute()
+    interior = terrain_ds.isel(nlat=slice(1, -1), nlon=slice(1, -1))
+    assert np.allclose(interior.slope, 0.05)
+    assert np.allclose(interior.aspect, 180)
+    assert np.allclose(interior.curvature, 0, atol=1e-9)
+    assert terrain_ds.slope.isel(nlat=0).isnull().all()
+
+
+def test_align_datasets():
+    """Check datasets are cut to common times and put on the first grid."""
+    time = pd.date_range('2000-01-01', periods=24, freq='MS')
+    fine_ds = xr.Dataset({'tp': (('time', 'lat', 'lon'), np.zeros((24, 8, 8)))},
+                         coords={'time': time, 'lat': np.arange(30, 32, 0.25),
+                                 'lon': np.arange(75, 77, 0.25)})
+    coarse_ds = xr.Dataset({'tp': (('time', 'lat', 'lon'), np.ones((12, 4, 4)))},
+                           coords={'time': time[6:18].strftime('%Y-%m-%d'),
+                                   'lat': np.arange(30, 32, 0.5),
+                                   'lon': np.arange(75, 77, 0.5)})
+    aligned = dispatch.align_datasets({'fine': fine_ds, 'coarse': coarse_ds})
+    for ds in aligned.values():
+        assert (ds.time.values == time[6:18].values).all()
+        assert ds.tp.shape == (12, 8, 8)
+    assert (aligned['coarse'].tp.isel(lat=slice(0, 7), lon=slice(0, 7)) == 1).all()
+    assert dispatch.collect([], 'indus', '2000', '2001') == {}
+
+
+def test_instrument_stages(tmp_path):
+    """Check events are only recorded when enabled, and export as a trace."""
+    instrument.disable()
+    instrument.clear()
+    with instrument.stage('open', filepath='a.nc'):
+        pass
+    assert instrument.events() == []
+
+    instrument.enable()
+    try:
+        with instrument.stage('mask', location='uib'):
+            with instrument.stage('open', filepath='a.nc'):
+                np.ones(1000).sum()
+            with instrument.stage('load'):
+                values = np.ones(50 * 1024**2 // 8)
+    finally:
+        instrument.disable()
+    events = instrument.events()
+    assert [e['name'] for e in events] == ['open', 'load', 'mask']
+    # the change in resident memory is per stage, the peak per process
+    assert events[1]['rss_change'] > 40 * 1024**2 > events[0]['rss_change']
+    assert events[2]['process_peak_rss'] >= events[1]['process_peak_rss']
+    del values
+    assert events[2]['seconds'] >= events[0]['seconds']
+    assert events[2]['args'] == {'location': 'uib'}
+
+    instrument.to_chrome_trace(str(tmp_path / 'trace.json'))
+    with open(tmp_path / 'trace.json') as f:
+        trace = json.load(f)
+    assert [e['ph'] for e in trace['traceEvents']] == ['X', 'X', 'X']
+    instrument.clear()
+
+
+def test_cube_matches_collect(tmp_path, monkeypatch):
+    """Check basin series read from the cube match those of collect_CRU."""
+    data_dir = str(tmp_path) + '/'
+    for module in [cru, cube, location_sel]:
+        monkeypatch.setattr(module, 'data_dir', data_dir)
+    for folder in ['CRU', 'Masks']:
+        (tmp_path / folder).mkdir()
+    time = pd.date_range('1990-01-01', periods=36, freq='MS')
+    lat, lon = cube.CUBE_LAT, cube.CUBE_LON
+    tp = np.random.default_rng(0).gamma(0.5, 4, (36, len(lat), len(lon)))
+    xr.Dataset({'tp': (('time', 'lat', 'lon'), tp)},
+               coords={'time': time, 'lat': lat, 'lon': lon}
+               ).to_netcdf(tmp_path / 'CRU/interpolated_cru_1901-2019.nc')
+    overlap = ((lat[:, np.newaxis] > 31) & (lon[np.newaxis, :] < 80)) * 1.
+    xr.Dataset({'overlap': (('latitude', 'longitude'), overlap)},
+               coords={'latitude': lat, 'longitude': lon}
+               ).to_netcdf(tmp_path / 'Masks/ERA5_Upper_Indus_mask.nc')
+
+    cube.build_cube('1990', '1992', sources=['cru'])
+    cube_ds = cru.collect_CRU('uib', '1991', '1992', from_cube=True)
+    file_ds = cru.collect_CRU('uib', '1991', '1992')
+    assert cube_ds.tp.dims == ('time', 'lat', 'lon')
+    assert np.allclose(cube_ds.tp, file_ds.tp.astype('float32'))
+    point_ds = cru.collect_CRU((31.6, 77.4), '1990', '1992', from_cube=True)
+    assert np.allclose(point_ds.tp, tp[:, 26, 30].astype('float32'))
+
+
+def test_point_store_matches_interp(tmp_path):
+    """Check point store reads equal nearest neighbour interpolation exactly."""
+    filepath = str(tmp_path / 'wrf.nc')
+    time = pd.date_range('1990-01-01', periods=30, freq='MS')
+    lat, lon = np.arange(25, 35, 0.25), np.arange(70, 85, 0.25)
+    rng = np.random.default_rng(0)
+    tp = rng.gamma(0.5, 4, (30, len(lon), len(lat)))
+    ds = xr.Dataset({'tp': (('time', 'lon', 'lat'), tp, {'units': 'mm/day'}),
+                     't2m': (('time', 'lat', 'lon'),
+                             rng.random((30, len(lat), len(lon))).astype('float32')),
+                     'count': (('time', 'lat', 'lon'),
+                               rng.integers(0, 30, (30, len(lat), len(lon))).astype('int16')),
+                     'z': (('lat', 'lon'), rng.random((len(lat), len(lon))))},
+                    coords={'time': time, 'lat': lat, 'lon': lon},
+                    attrs={'title': 'WRF'})
+    ds.to_netcdf(filepath)
+    assert not pointstore.is_current(filepath)
+
+    pointstore.build(filepath, lat_block=3)
+    assert pointstore.is_current(filepath)
+    file_ds = xr.open_dataset(filepath)
+    for point in [(31.61, 77.38), (25, 84.75), (40, 77)]:
+        point_ds = pointstore.point_series(filepath, *point)
+        interp_ds = file_ds.interp(lat=point[0], lon=point[1], method='nearest')
+        xr.testing.assert_identical(point_ds.transpose(*interp_ds.dims),
+                                    interp_ds[list(point_ds.data_vars)])
+
+    # a compact store is rebuilt before being used at full precision
+    compact.set_compact(True)
+    try:
+        pointstore.build(filepath)
+        assert pointstore.point_series(filepath, 30, 75).tp.dtype == np.float32
+    finally:
+        compact.set_compact(False)
+    assert not pointstore.is_current(filepath)
+
+
+def test_compact_mode(tmp_path):
+    """Check compact mode halves dtypes and packs stored fields as int16."""
+    time = pd.date_range('2000-01-01', periods=12, freq='MS')
+    tp = np.random.default_rng(0).gamma(0.5, 4, (12, 4, 5))
+    tp[0, 0, 0] = np.nan
+    ds = xr.Dataset({'tp': (('time', 'lat', 'lon'), tp)},
+                    coords={'time': time, 'lat': np.arange(30, 31, 0.25),
+                            'lon': np.linspace(70, 71, 5) + 0.1})
+    assert compact.compact_dataset(ds) is ds
+    assert compact.netcdf_encoding(ds) is None
+
+    compact.set_compact(True)
+    try:
+        compact_ds = compact.compact_dataset(ds)
+        encoding = compact.netcdf_encoding(ds)
+    finally:
+        compact.set_compact(False)
+    assert compact_ds.tp.dtype == np.float32
+    assert compact_ds.lat.dtype == np.float32
+    assert compact_ds.lon.dtype == np.float64
+
+    ds.to_netcdf(tmp_path / 'packed.nc', encoding=encoding)
+    with xr.open_dataset(tmp_path / 'packed.nc') as packed_ds:
+        assert packed_ds.tp.encoding['dtype'] == np.int16
+        assert packed_ds.tp.dtype == np.float32
+        scale_factor = packed_ds.tp.encoding['scale_factor']
+        assert np.allclose(packed_ds.tp, tp, atol=scale_factor, equal_nan=True)
+
+
+def test_memo_invalidates_and_evicts(tmp_path, monkeypatch):
+    """Check cached results are reused, refreshed when the source changes and evicted."""
+    data_dir = str(tmp_path) + '/'
+    for module in [cru, memo, location_sel]:
+        monkeypatch.setattr(module, 'data_dir', data_dir)
+    (tmp_path / 'CRU').mkdir()
+    filepath = tmp_path / 'CRU/interpolated_cru_1901-2019.nc'
+    time = pd.date_range('1990-01-01', periods=24, freq='MS')
+    xr.Dataset({'tp': (('time', 'lat', 'lon'), np.ones((24, 4, 4)))},
+               coords={'time': time, 'lat': np.arange(30, 31, 0.25),
+                       'lon': np.arange(75, 76, 0.25)}).to_netcdf(filepath)
+
+    def cached_files():
+        return sorted((tmp_path / 'Memo').glob('*.nc'))
+
+    memo.enable()
+    try:
+        first_ds = cru.collect_CRU('hma', '1990', '1990')
+        assert len(cached_files()) == 1
+        second_ds = cru.collect_CRU('hma', '1990', '1990')
+        assert second_ds.identical(first_ds)
+        assert len(cached_files()) == 1
+
+        os.utime(filepath, ns=(0, 10**18))
+        cru.collect_CRU('hma', '1990', '1990')
+        assert len(cached_files()) == 2
+
+        memo.set_max_size(cached_files()[0].stat().st_size)
+        cru.collect_CRU((30.5, 75.5), '1990', '1991')
+        assert len(cached_files()) == 1
+    finally:
+        memo.disable()
+        memo.set_max_size(2 * 1024**3)
+
+
+def test_colocate_stations():
+    """Check station values are gathered from each grid into one long table."""
+    time = pd.date_range('2000-01-01', periods=12, freq='MS')
+    fine_lat, fine_lon = np.arange(30, 32, 0.25), np.arange(75, 77, 0.25)
+    fine_tp = np.random.default_rng(0).random((12, 8, 8))
+    fine_ds = xr.Dataset({'tp': (('time', 'lat', 'lon'), fine_tp)},
+                         coords={'time': time, 'lat': fine_lat, 'lon': fine_lon})
+    coarse_tp = np.random.default_rng(1).random((6, 4, 2))
+    coarse_ds = xr.Dataset({'tp': (('time', 'lon', 'lat'), coarse_tp)},
+                           coords={'time': time[6:].strftime('%Y-%m-%d'),
+                                   'lat': [32, 30], 'lon': np.arange(75, 77, 0.5)})
+    stations = pd.DataFrame({'lat': [31.6, 30.1, 40], 'lon': [75.9, 76.6, 76],
+                             'z': [1000, 2000, 3000]},
+                            index=pd.Index(['A', 'B', 'C'], name='station'))
+
+    df = colocate.colocate(stations, {'fine': fine_ds, 'coarse': coarse_ds})
+    assert df.shape == (36, 5)
+    assert np.allclose(df.loc['A', 'fine'], fine_tp[:, 6, 4])
+    assert np.allclose(df.loc['B', 'fine'], fine_tp[:, 0, 6])
+    assert df.loc['A', 'coarse'].iloc[:6].isnull().all()
+    assert np.allclose(df.loc['A', 'coarse'].iloc[6:], coarse_tp[:, 2, 0])
+    assert df.loc['C', ['fine', 'coarse']].isnull().all().all()
+    assert (df.loc['B', 'z'] == 2000).all()
+
+
+def test_feature_store_groups(tmp_path, monkeypatch):
+    """Check feature groups are built once, versioned and joined on read."""
+    monkeypatch.setattr(feature_store, 'data_dir', str(tmp_path) + '/')
+    monkeypatch.setattr(memo, 'data_dir', str(tmp_path) + '/')
+    monkeypatch.setattr(era5, 'data_dir', str(tmp_path) + '/')
+    monkeypatch.setattr(feature_store, 'FEATURE_GROUPS', {})
+    time = pd.date_range('2000-01-01', periods=4, freq='MS')
+    grid = pd.MultiIndex.from_product([time, [30., 31.], [75., 76.]],
+                                      names=['time', 'latitude', 'longitude'])
+    calls = []
+
+    def fields(basin):
+        calls.append('fields')
+        return pd.DataFrame({'tp': np.arange(16.)}, index=grid).reset_index()
+
+    def index(basin):
+        calls.append('index')
+        return pd.DataFrame({'time': time[1:] + pd.Timedelta(days=14),
+                             'N34': [1., 2., 3.]})
+
+    feature_store.register_feature_group('fields', fields, ['time', 'lat', 'lon'], ['tp'])
+    feature_store.register_feature_group('index', index, ['time'], ['N34'])
+
+    # only the groups holding the requested columns are built
+    ds = feature_store.load_features('indus', columns=['N34'])
+    assert list(ds.data_vars) == ['N34']
+    assert calls == ['index']
+    with pytest.raises(KeyError):
+        feature_store.load_features('indus', columns=['N34', 'NAO'])
+
+    df = feature_store.feature_table('indus')
+    assert list(df.columns) == ['time', 'lat', 'lon', 'tp', 'N34']
+    assert len(df) == 12
+    assert (df.groupby('time')['N34'].first().values == [1., 2., 3.]).all()
+    assert calls == ['index', 'fields']
+
+    feature_store.register_feature_group('index', index, ['time'], ['N34'], version=2)
+    feature_store.load_features('indus')
+    assert calls == ['index', 'fields', 'index']
+    assert sorted(glob.glob(str(tmp_path) + '/ERA5/features/indus/*')) == [
+        str(tmp_path) + '/ERA5/features/indus/' + f
+        for f in ['fields_v1.nc', 'index_v2.nc']]
+    # memoised collect_ERA5 results depend on the stored groups
+    assert sorted(era5._collect_sources({'location': 'uib'})) == [
+        str(tmp_path) + '/ERA5/features/indus/' + f
+        for f in ['fields_v1.nc', 'index_v2.nc']]
+
+
+def test_eofs_match_full_svd(tmp_path, monkeypatch):
+    """Check the chunked EOFs match an in-memory SVD of the monthly anomalies."""
+    monkeypatch.setattr(eof, 'data_dir', str(tmp_path) + '/')
+    os.makedirs(str(tmp_path) + '/ERA5')
+    time = pd.date_range('2000-01-01', '2002-12-31 18:00',
+                         freq=pd.Timedelta(hours=6))
+    lat, lon = np.arange(90, -91, -30.), np.arange(0, 360, 45.)
+    rng = np.random.default_rng(0)
+    months = time.month.values - 1
+    modes = rng.standard_normal((len(time), 2, 1, 1)) * [[[[50]], [[20]]]]
+    z = (rng.random((12, 7, 8))[months] * 100
+         + (modes * rng.random((1, 2, 7, 8))).sum(axis=1)
+         + rng.standard_normal((len(time), 7, 8)) * 0.1)
+    filepath = str(tmp_path) + '/hourly.nc'
+    xr.Dataset({'z': (('time', 'latitude', 'longitude'), z)},
+               coords={'time': time, 'latitude': lat,
+                       'longitude': lon}).to_netcdf(filepath)
+
+    eof_filepaths = eof.build_eofs('500', filepath=filepath,
+                                   max_block_bytes=10 * 7 * 8 * 8)
+    assert [os.path.basename(f) for f in eof_filepaths] == [
+        'global_500_EOF1.nc', 'global_500_EOF2.nc']
+
+    monthly = xr.open_dataset(filepath).z.resample(time='MS').mean()
+    anomalies = monthly.groupby('time.month') - \
+        monthly.groupby('time.month').mean()
+    weights = np.sqrt(np.abs(np.cos(np.deg2rad(lat))))[:, None]
+    weights[[0, -1]] = 0
+    u, s, vt = np.linalg.svd((anomalies.values * weights).reshape(36, -1),
+                             full_matrices=False)
+    for n, f in enumerate(eof_filepaths):
+        ds = xr.open_dataset(f)
+        assert ds.EOF.dims == ('time', 'latitude', 'longitude')
+        expected = np.outer(u[:, n] * s[n], vt[n]).reshape(36, 7, 8)[:, 1:-1]
+        expected = expected / weights[1:-1]
+        actual = ds.EOF.values[:, 1:-1]
+        assert np.allclose(actual, expected, rtol=1e-3, atol=1e-3)
+        assert ds.EOF[:, [0, -1]].isnull().all()
+
+    # the SVD reads row blocks within the byte budget
+    matrix = (anomalies.values * weights).reshape(36, -1)
+    rows = []
+
+    def blocks(start, end):
+        rows.append(len(matrix[start:end]))
+        return matrix[start:end]
+
+    u_b, s_b, vt_b = eof.randomized_svd(blocks, matrix.shape, 2,
+                                        max_block_bytes=10 * 56 * 8)
+    assert max(rows) == 10
+    assert np.allclose(s_b, s[:2])
+    assert np.allclose(np.abs(vt_b), np.abs(vt[:2]), atol=1e-6)
+
+
+def test_aggregate_hourly(tmp_path, monkeypatch):
+    """Check streamed daily and monthly statistics match xarray resampling."""
+    time = pd.date_range('2000-01-30', '2000-03-02 23:00',
+                         freq=pd.Timedelta(hours=1))
+    z = np.random.default_rng(0).random((len(time), 3, 4))
+    z[:30, 0, 0] = np.nan
+    z[z < 0.01] = np.nan
+    filepath = str(tmp_path) + '/hourly.nc'
+    ds = xr.Dataset({'z': (('time', 'latitude', 'longitude'), z)},
+                    coords={'time': time, 'latitude': [40., 35., 30.],
+                            'longitude': [70., 75., 80., 85.]})
+    ds.to_netcdf(filepath)
+
+    # each block is read once for both frequencies
+    reads = []
+    isel = xr.DataArray.isel
+
+    def counted_isel(self, *args, **kwargs):
+        if 'time' in kwargs:
+            reads.append(kwargs['time'])
+        return isel(self, *args, **kwargs)
+
+    monkeypatch.setattr(xr.DataArray, 'isel', counted_isel)
+    out_filepaths = aggregate.aggregate_hourly(filepath,
+                                               max_block_bytes=100 * 12 * 8)
+    monkeypatch.undo()
+    assert [(r.start, r.stop) for r in reads] == [
+        (start, start + 100) for start in range(0, len(time), 100)]
+    assert out_filepaths['D'] == str(tmp_path) + '/hourly_daily.nc'
+    for freq, out_filepath in out_filepaths.items():
+        out = xr.open_dataset(out_filepath)
+        assert out.z_mean.dims == ('time', 'latitude', 'longitude')
+        assert out.z_mean.dtype == np.float32
+        resampled = ds.z.resample(time=freq)
+        assert (out.time.values == resampled.mean().time.values).all()
+        assert np.allclose(out.z_mean, resampled.mean(), equal_nan=True)
+        assert np.allclose(out.z_max, resampled.max(), equal_nan=True)
+        assert (out.z_count.values == resampled.count().values).all()
+    assert np.isnan(xr.open_dataset(out_filepaths['D']).z_mean[0, 0, 0])
+
+
+def test_monthly_resample_kernel():
+    """Check the monthly kernel matches resample('MS') and its NaN policy."""
+    time = pd.date_range('2000-01-15', '2000-06-10', freq='D')
+    time = time[(time.month != 3)]  # a month without data
+    values = np.random.default_rng(0).random((3, len(time), 2)).astype('float32')
+    values[0, :20, 0] = np.nan
+    da = xr.DataArray(values, dims=('lat', 'time', 'lon'),
+                      coords={'time': time, 'lat': [1., 2., 3.]}, attrs={'units': 'mm'})
+
+    monthly_da = resample.monthly(da)
+    expected = da.resample(time='MS').mean()
+    assert monthly_da.dims == da.dims and monthly_da.dtype == np.float32
+    assert monthly_da.attrs == {'units': 'mm'}
+    assert (monthly_da.time.values == expected.time.values).all()
+    assert np.allclose(monthly_da, expected, equal_nan=True)
+    assert np.allclose(resample.monthly(da.to_dataset(name='tp'), how='max').tp,
+                       da.resample(time='MS').max(), equal_nan=True)
+
+    months, sums, counts = resample.monthly_reduce(values, time, how='sum',
+                                                   axis=1, min_count=0)
+    assert len(months) == 6 and (sums[:, 2] == 0).all()
+    assert counts[0, 0, 0] == 0 and counts[0, 1, 0] == 26 and counts[1, 1, 0] == 29
+    _, means, _ = resample.monthly_reduce(values, time, axis=1, min_count=27)
+    assert np.isnan(means[0, :2, 0]).all() and not np.isnan(means[0, 3, 0])
+    _, means, _ = resample.monthly_reduce(values, time, axis=1, skipna=False)
+    assert np.isnan(means[0, 1, 0]) and not np.isnan(means[0, 1, 1])
+
+    df = da.isel(lat=0).to_pandas().sample(frac=1, random_state=0)
+    assert np.allclose(resample.monthly_frame(df),
+                       df.sort_index().resample('MS').mean(), equal_nan=True)
+
+    # sums of months without valid values are 0, as with resample
+    assert np.allclose(resample.monthly_frame(df, how='sum'),
+                       df.sort_index().resample('MS').sum())
+    monthly_sums = resample.monthly(da, how='sum')
+    expected = da.resample(time='MS').sum()
+    assert np.allclose(monthly_sums, expected.fillna(0))
+    assert (monthly_sums.sel(time='2000-03') == 0).all()
+
+
+def test_value_store_partitions(tmp_path, monkeypatch):
+    """Check the VALUE store index and that only overlapping partitions are read."""
+    monkeypatch.setattr(value, 'data_dir', str(tmp_path) + '/')
+    os.makedirs(str(tmp_path) + '/VALUE_ECA_86_v2')
+    time = pd.date_range('1998-01-01', '2001-12-01', freq='MS')
+    df = pd.concat([pd.DataFrame({'station_id': station_id, 'time': time,
+                                  'tp': np.arange(len(time), dtype=float),
+                                  'name': name, 'lon': 1., 'lat': 2., 'z': 3.})
+                    for station_id, name in [(1, 'Aaa'), (2, 'Bbb')]],
+                   ignore_index=True)
+    df.to_csv(value._csv_filepath(True))
+    value.build_store(True)
+
+    index_df = pd.read_csv(value._store_dir(True) + 'index.csv')
+    assert list(index_df.columns) == value.INDEX_COLUMNS
+    assert sorted(index_df['file']) == ['1_1990.csv', '1_2000.csv',
+                                        '2_1990.csv', '2_2000.csv']
+
+    # partitions outside the request are never opened
+    for filename in ['1_2000.csv', '2_1990.csv', '2_2000.csv']:
+        os.remove(value._store_dir(True) + filename)
+    station_df = value.all_gauge_data('1998', '1999', stations=['Aaa'])
+    assert len(station_df) == 24 and (station_df['station_id'] == 1).all()
+    assert list(station_df.columns) == list(value.STORE_DTYPES)
+
+    empty_df = value.all_gauge_data('1950', '1960')
+    assert len(empty_df) == 0
+    assert empty_df.dtypes.astype(str).to_dict() == value.STORE_DTYPES
+
+    # partitions of an earlier build are removed
+    open(value._store_dir(True) + '3_1980.csv', 'w').close()
+    value.build_store(True)
+    assert sorted(os.listdir(value._store_dir(True))) == [
+        '1_1990.csv', '1_2000.csv', '2_1990.csv', '2_2000.csv', 'index.csv']
+    assert sorted(os.listdir(str(tmp_path) + '/VALUE_ECA_86_v2')) == [
+        'value_rsamp', 'value_rsamp.csv']
+    assert 'VALUE dataset' in value.__doc__
+
+
+def test_value_monthly_matches_station_resample():
+    """Check monthly VALUE data match a resample of each station's valid days."""
+    time = pd.date_range('2000-01-01', '2000-12-31', freq='D', name='time')
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(rng.random((len(time), 4)), index=time,
+                      columns=['12', '3', '7', '5'])
+    df.loc['2000-04-01':'2000-06-30', '12'] = np.nan  # months without data
+    df.loc[:'2000-02-10', '3'] = np.nan  # a later start
+    df.loc['2000-10-20':, '3'] = np.nan  # an earlier end
+    df['7'] = np.nan  # a station without data
+
+    monthly_df = value._monthly_stations(df)
+
+    # previous per-station path, stacking valid days only
+    df1 = df.stack().dropna().reset_index()
+    df1 = df1.rename({"level_1": "station_id", 0: "tp"}, axis=1)
+    df1['station_id'] = df1['station_id'].astype(int)
+    expected = df1.groupby('station_id').resample('MS', on='time')['tp'].mean()
+    expected = expected.reset_index()
+    assert monthly_df.isnull()['tp'].sum() == 3
+    pd.testing.assert_frame_equal(monthly_df, expected, check_dtype=False)
+
+
+def _cordex_filename(gcm, experiment, rcm, start, end, freq='mon'):
+    return ('pr_WAS-44_' + gcm + '_' + experiment + '_r1i1p1_' + rcm + '_v1_' +
+            freq + '_' + start + '-' + end + '.nc')
+
+
+def test_cordex_select_files(tmp_path):
+    """Check CORDEX files are selected for one model combination, by start."""
+    filenames = [_cordex_filename('ICHEC-EC-EARTH', 'historical', 'SMHI-RCA4', s, e)
+                 for s, e in [('196101', '197012'), ('195101', '196012'),
+                              ('197101', '198012')]]
+    filenames += [_cordex_filename('MPI-M-MPI-ESM-LR', 'historical', 'SMHI-RCA4',
+                                   '195101', '196012'),
+                  _cordex_filename('MPI-M-MPI-ESM-LR', 'historical', 'MPI-CSC-REMO2009',
+                                   '195101', '196012'),
+                  'README.txt']
+    for f in filenames:
+        open(str(tmp_path / f), 'w').close()
+    path = str(tmp_path) + '/'
+
+    with pytest.warns(UserWarning, match='README.txt'):
+        files = cordex.select_files(path, 'historical', 'EC-EARTH', 'RCA4', 1955, 1965)
+    assert [os.path.basename(f) for f in files] == filenames[1::-1]
+    files = cordex.select_files(path, 'historical', 'MPI-M-MPI-ESM-LR',
+                                'SMHI-RCA4', 1950, 2000)
+    assert [os.path.basename(f) for f in files] == [filenames[3]]
+    assert cordex.select_files(path, 'rcp85', 'EC-EARTH', 'RCA4', 1950, 2000) == []
+    with pytest.raises(ValueError):
+        cordex.select_files(path, 'historical', 'MPI', '', 1950, 2000)
+
+
+def test_cmip_parse_filename():
+    """Check CMIP5 and CMIP6 filenames are parsed and fixed fields skipped."""
+    fields = cmip5.parse_filename('pr_Amon_HadCM3_historical_r1i1p1_195912-198411.nc')
+    assert fields == {'variable': 'pr', 'table': 'Amon', 'model': 'HadCM3',
+                      'experiment': 'historical', 'member': 'r1i1p1',
+                      'grid': None, 'minyear': 1959, 'maxyear': 1984}
+    fields = cmip5.parse_filename(
+        'pr_day_MIROC6_ssp585_r1i1p1f1_gn_20150101-20241231.nc')
+    assert fields['grid'] == 'gn' and fields['maxyear'] == 2024
+    assert cmip5.parse_filename('orog_fx_HadCM3_historical_r0i0p0.nc') is None
+    assert cmip5.parse_filename('README.txt') is None
+
+
+def test_cmip_subset_extent():
+    """Check subsetting a 0-360° grid keeps a one-cell margin in -180-180°."""
+    ds = xr.Dataset({'pr': (('lat', 'lon'), np.arange(10 * 36.).reshape(10, 36))},
+                    coords={'lat': np.arange(-45, 55, 10.),
+                            'lon': np.arange(0, 360, 10.)})
+    subset_ds = cmip5.subset_extent(ds, 20, 30, -15, 15)
+    assert list(subset_ds.lat.values) == [15., 25., 35.]
+    assert list(subset_ds.lon.values) == [-20., -10., 0., 10., 20.]
+    assert subset_ds.pr.sel(lat=25, lon=-10) == ds.pr.sel(lat=25, lon=350)
+
+
+def test_cmip_select_run(tmp_path):
+    """Check CMIP files on different grids are never concatenated."""
+    time = pd.date_range('2015-01-01', periods=24, freq='MS')
+    for grid, period, times in [('gn', '201501-201512', time[:12]),
+                                ('gn', '201601-201612', time[12:]),
+                                ('gr', '201501-201612', time)]:
+        filename = 'pr_Amon_MIROC6_ssp585_r1i1p1f1_' + grid + '_' + period + '.nc'
+        xr.Dataset({'pr': (('time', 'lat', 'lon'), np.ones((len(times), 3, 4)) / 86400)},
+                   coords={'time': times + pd.Timedelta(days=14),
+                           'lat': [30., 32., 34.], 'lon': [70., 72., 74., 76.]}
+                   ).to_netcdf(str(tmp_path / filename))
+    path = str(tmp_path) + '/'
+
+    with pytest.raises(ValueError):
+        cmip5.select_run(path, 'pr', 'Amon', 'MIROC6', 'ssp585', 'r1i1p1f1')
+    with pytest.raises(OSError):
+        cmip5.select_run(path, 'pr', 'Amon', 'MIROC6', 'ssp245', 'r1i1p1f1')
+    ds = cmip5.collect_CMIP((32.4, 72.4), '2015', '2016', 'MIROC6', 'ssp585',
+                            member='r1i1p1f1', grid='gn', path=path)
+    assert (ds.time.values == time.values).all()
+    assert np.allclose(ds.tp, 1)
+
+
+def test_open_files_lazy_and_sliced(tmp_path):
+    """Check files are concatenated lazily, at month starts and within the years."""
+    import cftime
+    filepaths = []
+    for year in [2000, 2001, 2002]:
+        time = [cftime.datetime(year, m, 16, calendar='360_day') for m in range(1, 13)]
+        ds = xr.Dataset({'pr': (('time', 'lat'), np.full((12, 2), float(year)))},
+                        coords={'time': time, 'lat': [30., 31.]})
+        filepath = str(tmp_path / ('pr_' + str(year) + '.nc'))
+        ds.to_netcdf(filepath)
+        filepaths.append(filepath)
+
+    ds = multifile.open_files(filepaths, '2001', '2002',
+                              preprocess=lambda ds: ds.isel(lat=[0]))
+    assert ds.pr.chunks is not None
+    assert ds.pr.shape == (24, 1)
+    assert (ds.time.values == pd.date_range('2001-01-01', periods=24, freq='MS').values).all()
+    assert (ds.pr.values[:, 0] == np.repeat([2001., 2002.], 12)).all()
+
+
+def test_cordex_ensemble(tmp_path, monkeypatch):
+    """Check regular and rotated-pole members are regridded and combined."""
+    monkeypatch.setattr(cordex, 'data_dir', str(tmp_path) + '/')
+    path = tmp_path / 'CORDEX/WAS/mon/historical'
+    os.makedirs(path)
+    time = pd.date_range('2000-01-16', periods=24, freq=pd.DateOffset(months=1))
+    regular_ds = xr.Dataset({'pr': (('time', 'lat', 'lon'), np.full((24, 3, 3), 1 / 86400))},
+                            coords={'time': time, 'lat': [29.5, 30., 30.5],
+                                    'lon': [69.5, 70., 70.5]})
+    regular_ds.to_netcdf(str(path / _cordex_filename(
+        'ICHEC-EC-EARTH', 'historical', 'SMHI-RCA4', '200001', '200112')))
+    rlat, rlon = np.meshgrid(np.arange(4), np.arange(4), indexing='ij')
+    rotated_ds = xr.Dataset({'pr': (('time', 'rlat', 'rlon'), np.full((24, 4, 4), 3 / 86400))},
+                            coords={'time': time,
+                                    'lat': (('rlat', 'rlon'), 29.5 + 0.4 * rlat + 0.1 * rlon),
+                                    'lon': (('rlat', 'rlon'), 69.5 + 0.4 * rlon - 0.1 * rlat)})
+    rotated_ds.to_netcdf(str(path / _cordex_filename(
+        'MPI-M-MPI-ESM-LR', 'historical', 'MPI-CSC-REMO2009', '200001', '200112')))
+
+    with pytest.warns(UserWarning, match='No CORDEX files'):
+        ensemble_ds = cordex.collect_CORDEX_ensemble(
+            'WAS', '2000', '2001', ['historical'], ['SMHI-RCA4', 'MPI-CSC-REMO2009'],
+            ['ICHEC-EC-EARTH', 'MPI-M-MPI-ESM-LR'],
+            lat=np.array([30., 30.5]), lon=np.array([70., 70.5, 75.]))
+    assert ensemble_ds.tp.dims == ('model', 'time', 'lat', 'lon')
+    assert sorted(ensemble_ds.model.values) == [
+        'ICHEC-EC-EARTH SMHI-RCA4 historical',
+        'MPI-M-MPI-ESM-LR MPI-CSC-REMO2009 historical']
+    assert ensemble_ds.tp.isel(lon=2).isnull().all()
+
+    stats_ds = cordex.ensemble_stats(ensemble_ds).isel(lon=slice(0, 2)).compute()
+    assert np.allclose(stats_ds.tp_mean, 2)
+    assert np.allclose(stats_ds.tp_spread, 1)
+    assert np.allclose(stats_ds.tp_percentile.sel(percentile=50), 2)
+    assert np.allclose(stats_ds.tp_percentile.sel(percentile=10), 1.2)
+
+    # max_distance also applies to regular grids
+    gap_ds = regular_ds.assign_coords(lon=[69.5, 70., 72.])
+    regridded = cordex.regrid(gap_ds, np.array([30.]), np.array([70., 71., 72.]))
+    assert regridded.pr.isel(time=0, lat=0).isnull().values.tolist() == [
+        False, True, False]
+
+    with pytest.warns(UserWarning), pytest.raises(OSError, match='NOT-A-GCM'):
+        cordex.collect_CORDEX_ensemble('WAS', '2000', '2001', ['historical'],
+                                       ['SMHI-RCA4'], ['NOT-A-GCM'])
+
+
+def _trmm_file(path, month, value):
+    import h5py
+    filename = ('3A-MO.TRMM.PR.3PRTMI.' + month.strftime('%Y%m%d') +
+                '-S000000-E235959.' + month.strftime('%m') + '.V07A.HDF5')
+    tp = np.zeros((1, 1440, 536), dtype='f4')
+    tp[0, 900:1080, 300:480] = value
+    with h5py.File(str(path / filename), 'w') as f:
+        f.create_dataset('Grids/G2/estimSurfPrecipTotRateUn', data=tp)
+    return str(path / filename)
+
+
+def test_gpm_hyperslab_and_append(tmp_path, monkeypatch):
+    """Check TRMM hyperslabs, file months and incremental appends to the store."""
+    monkeypatch.setattr(gpm, 'data_dir', str(tmp_path) + '/')
+    path = tmp_path / 'GPM/PRTMI_1997-2015_TRMM3B43'
+    os.makedirs(path)
+    months = pd.date_range('1998-01-01', periods=3, freq='MS')
+    filepaths = [_trmm_file(path, m, i + 1.) for i, m in enumerate(months)]
+
+    assert gpm.file_month(filepaths[1]) == np.datetime64('1998-02-01', 'ns')
+    with pytest.raises(ValueError):
+        gpm.file_month('3A-MO.TRMM.PR.nodate.HDF5')
+    hyperslab = gpm.read_hyperslab((filepaths[0], slice(899, 902), slice(299, 301)))
+    assert hyperslab.shape == (2, 3)
+    assert (hyperslab == [[0, 0, 0], [0, 1, 1]]).all()
+
+    os.remove(filepaths[2])
+    gpm.to_netcdf(max_workers=1, chunk_size=1)
+    out_filepath = str(tmp_path) + '/GPM/gpm_prtmi_1997-2015.nc'
+    assert xr.open_dataset(out_filepath).time.size == 2
+    _trmm_file(path, months[2], 3.)
+    gpm.to_netcdf(max_workers=1, chunk_size=1)
+
+    ds = xr.open_dataset(out_filepath)
+    assert (ds.time.values == months.values).all()
+    assert ds.tp.dtype == np.float64
+    tp = ds.tp.sel(lat=slice(10, 36), lon=slice(45, 85)).max(['lat', 'lon'])
+    assert np.allclose(tp, [24., 48., 72.])
+
+    # a store from the other mode is rebuilt rather than appended to
+    compact.set_compact(True)
+    try:
+        gpm.to_netcdf(max_workers=1, chunk_size=1)
+    finally:
+        compact.set_compact(False)
+    ds = xr.open_dataset(out_filepath)
+    assert ds.tp.dtype == np.float32 and ds.time.size == 3
+
+
+def test_dem_pyramid_lookup(tmp_path, monkeypatch):
+    """Check pyramid cell statistics match the DEM cells they cover."""
+    monkeypatch.setattr(gmted2010, 'PYRAMID_FILEPATH', str(tmp_path / 'pyramid.nc'))
+    monkeypatch.setattr(gmted2010, '_pyramid_levels', {})
+    lat = np.arange(29.53125, 31, 0.0625)
+    lon = np.arange(74.53125, 76, 0.0625)[::-1]
+    elevation = np.random.default_rng(0).random((len(lat), len(lon))) * 5000
+    dem_filepath = str(tmp_path / 'dem.nc')
+    xr.Dataset({'elevation': (('latitude', 'longitude'), elevation)},
+               coords={'latitude': lat, 'longitude': lon}).to_netcdf(dem_filepath)
+    gmted2010.build_dem_pyramid(dem_filepath, resolutions=(0.0625, 0.25, 0.5))
+    assert sorted(gmted2010._available_resolutions()) == [0.0625, 0.25, 0.5]
+
+    points_lat, points_lon = np.array([30.1, 30.6]), np.array([75.3, 74.9])
+    for res in [0.25, 0.5]:
+        ds = gmted2010.dem_lookup(points_lat, points_lon, resolution=res)
+        for i in range(2):
+            centre_lat = np.round(points_lat[i] / res) * res
+            centre_lon = np.round(points_lon[i] / res) * res
+            cells = elevation[np.abs(lat - centre_lat) < res / 2][
+                :, np.abs(lon - centre_lon) < res / 2]
+            assert cells.size == (res / 0.0625) ** 2
+            assert np.isclose(ds.elevation_mean[i], cells.mean())
+            assert np.isclose(ds.elevation_min[i], cells.min())
+            assert np.isclose(ds.elevation_max[i], cells.max())
+            assert np.isclose(ds.elevation_std[i], cells.std())
+            assert float(ds.lat[i]) == centre_lat and float(ds.lon[i]) == centre_lon
+
+    # points more than half a cell outside the pyramid have no elevation
+    ds = gmted2010.dem_lookup([30.1, 40.], [75.3, 75.3], resolution=0.25)
+    assert not np.isnan(ds.elevation_mean[0]) and np.isnan(ds.elevation_mean[1])
+
+    # integer and float resolutions name the same level
+    gmted2010.build_dem_pyramid(dem_filepath, resolutions=(1.0,))
+    assert gmted2010.pyramid_level(1).attrs['resolution'] == 1.0
+    with pytest.raises(ValueError):
+        gmted2010._first_edge(np.arange(0.01, 1, 0.0625), 0.0625, 0.25)
@@ -0,0 +1,222 @@
+"""
+Conversion between time axes and fractional years.
+
+Handles numpy datetime64 axes and cftime axes in the 360-day, noleap,
+all_leap and (proleptic) gregorian calendars. All conversions are
+vectorised so century-long daily axes are converted in O(n).
+
+Fractional years are computed for any date, e.g. CMIP runs to 2300 or
+paleo runs, but datetime64[ns] values only span 1678-2261: conversions
+returning them raise a ValueError outside that range. Missing values (NaT,
+NaN or None) are kept as missing values.
+"""
+
+import numpy as np
+import xarray as xr
+
+FIXED_CALENDARS = {'360_day': 360, 'noleap': 365, '365_day': 365,
+                   'all_leap': 366, '366_day': 366}
+GREGORIAN_CALENDARS = ['standard', 'gregorian', 'proleptic_gregorian']
+# whole years representable as datetime64[ns]
+NS_YEARS = (1678, 2261)
+
+
+def days_in_year(years: np.array, calendar: str = 'standard') -> np.array:
+    """
+    Return the number of days in each year for a given calendar.
+
+    Args:
+        years (np.array): years
+        calendar (str, optional): CF calendar name. Defaults to 'standard'.
+
+    Returns:
+        np.array: number of days in each year
+    """
+    years = np.asarray(years)
+    if calendar in FIXED_CALENDARS:
+        return np.full(years.shape, FIXED_CALENDARS[calendar], dtype=int)
+    _check_calendar(calendar)
+    leap = (years % 4 == 0) & ((years % 100 != 0) | (years % 400 == 0))
+    return np.where(leap, 366, 365)
+
+
+def to_fractional_year(times: np.array, calendar: str = None) -> np.array:
+    """
+    Convert datetime64 or cftime values to fractional years, e.g. 1st July
+    2001 -> 2001.496.
+
+    Args:
+        times (np.array): datetime64 or cftime values
+        calendar (str, optional): CF calendar name, inferred from cftime
+            values if not given. Defaults to None.
+
+    Returns:
+        np.array: fractional years
+    """
+    times = np.asarray(times)
+    if times.dtype.kind != 'M':
+        calendar, days = _cftime_to_days(times, calendar)
+        if calendar in FIXED_CALENDARS:
+            length = FIXED_CALENDARS[calendar]
+            return 1 + days // length + (days % length) / length
+        times = _days_to_datetime64(days)
+
+    # in the unit of the values (seconds for cftime) so that no date overflows
+    years = times.astype('datetime64[Y]')
+    year_start = years.astype(times.dtype)
+    year_length = (years + 1).astype(times.dtype) - year_start
+    fraction = (times - year_start) / year_length
+    return np.where(np.isnat(times), np.nan,
+                    years.astype('int64') + 1970 + fraction)
+
+
+def from_fractional_year(years: np.array, calendar: str = 'standard') -> np.array:
+    """
+    Convert fractional years back to datetime64 (gregorian calendars) or
+    cftime (other calendars) values.
+
+    Args:
+        years (np.array): fractional years
+        calendar (str, optional): CF calendar name. Defaults to 'standard'.
+
+    Returns:
+        np.array: datetime64[ns] or cftime values
+    """
+    years = np.asarray(years, dtype=float)
+    missing = np.isnan(years)
+    years = np.where(missing, 1970, years)
+    whole_years = np.floor(years)
+    fraction = years - whole_years
+
+    if calendar in FIXED_CALENDARS:
+        import cftime
+        length = FIXED_CALENDARS[calendar]
+        days = (whole_years - 1) * length + fraction * length
+        dates = cftime.num2date(days, 'days since 0001-01-01', calendar=calendar)
+        return np.where(missing, None, dates)
+
+    _check_calendar(calendar)
+    _check_ns_years(whole_years)
+    year_start = (whole_years.astype('int64') - 1970).astype('datetime64[Y]')
+    start_ns = year_start.astype('datetime64[ns]')
+    year_length = ((year_start + 1).astype('datetime64[ns]') - start_ns).astype('int64')
+    offset = np.round(fraction * year_length).astype('int64')
+    dates = start_ns + offset.astype('timedelta64[ns]')
+    return np.where(missing, np.datetime64('NaT', 'ns'), dates)
+
+
+def to_month_start(times: np.array, calendar: str = None) -> np.array:
+    """
+    Convert datetime64 or cftime values to datetime64 values at the start of
+    their month, e.g. for monthly data in a 360-day calendar.
+
+    Args:
+        times (np.array): datetime64 or cftime values
+        calendar (str, optional): CF calendar name, inferred from cftime
+            values if not given. Defaults to None.
+
+    Returns:
+        np.array: datetime64[ns] month starts
+    """
+    times = np.asarray(times)
+    if times.dtype.kind == 'M':
+        months = times.astype('datetime64[M]')
+        _check_ns_years(months.astype('datetime64[Y]').astype('int64') + 1970,
+                        missing=np.isnat(months))
+        return months.astype('datetime64[ns]')
+
+    calendar, days = _cftime_to_days(times, calendar)
+    if calendar not in FIXED_CALENDARS:
+        return to_month_start(_days_to_datetime64(days))
+
+    length = FIXED_CALENDARS[calendar]
+    missing = np.isnan(days)
+    days = np.where(missing, 0, days)
+    years = 1 + days // length
+    day_of_year = days % length
+    if length == 360:
+        months = day_of_year // 30
+    else:
+        month_lengths = [31, 28 + length - 365, 31, 30, 31, 30,
+                         31, 31, 30, 31, 30, 31]
+        month_starts = np.cumsum([0] + month_lengths[:-1])
+        months = np.searchsorted(month_starts, day_of_year, side='right') - 1
+    _check_ns_years(years, missing=missing)
+    month_index = (years.astype('int64') - 1970) * 12 + months.astype('int64')
+    month_starts = month_index.astype('datetime64[M]').astype('datetime64[ns]')
+    return np.where(missing, np.datetime64('NaT', 'ns'), month_starts)
+
+
+def daily_fractional_years(start_year: int, end_year: int, calendar: str = 'standard') -> np.array:
+    """
+    Return fractional years at daily resolution between two years.
+
+    Args:
+        start_year (int): first year of the array
+        end_year (int): year to end array (exclusive)
+        calendar (str, optional): CF calendar name. Defaults to 'standard'.
+
+    Returns:
+        np.array: fractional years at daily resolution
+    """
+    years = np.arange(start_year, end_year)
+    n_days = days_in_year(years, calendar)
+    first_day = np.cumsum(n_days) - n_days
+    day_of_year = np.arange(n_days.sum()) - np.repeat(first_day, n_days)
+    return np.repeat(years, n_days) + day_of_year / np.repeat(n_days, n_days)
+
+
+def standardised_time(dataset: xr.DataArray) -> np.array:
+    """
+    Return array of standardised times to plot.
+
+    Args:
+        dataset (xr.DataArray): data with a datetime64 or cftime 'time' coordinate
+
+    Returns:
+        np.array: standardised time values in fractional years
+    """
+    return to_fractional_year(dataset.time.values)
+
+
+def _cftime_to_days(times: np.array, calendar: str = None):
+    """ Returns calendar and days since 0001-01-01 (NaN if missing) for cftime values """
+    import cftime
+    flat = times.ravel()
+    valid = np.array([t is not None for t in flat], dtype=bool)
+    if calendar is None:
+        calendar = flat[valid][0].calendar
+    if calendar not in FIXED_CALENDARS:
+        _check_calendar(calendar)
+        # the proleptic calendar keeps day counts continuous with datetime64
+        calendar = 'proleptic_gregorian'
+    days = np.full(flat.shape, np.nan)
+    if valid.any():
+        days[valid] = cftime.date2num(list(flat[valid]), 'days since 0001-01-01',
+                                      calendar=calendar)
+    return calendar, days.reshape(times.shape)
+
+
+def _days_to_datetime64(days: np.array) -> np.array:
+    """ Returns datetime64[s] values (NaT if missing) for days since 0001-01-01 """
+    missing = np.isnan(days)
+    seconds = np.round(np.where(missing, 0, days) * 86400).astype('int64')
+    times = seconds.astype('timedelta64[s]') + np.datetime64('0001-01-01', 's')
+    return np.where(missing, np.datetime64('NaT', 's'), times)
+
+
+def _check_ns_years(years: np.array, missing: np.array = None):
+    """ Raises an error for years that datetime64[ns] values cannot represent """
+    years = np.asarray(years)
+    if missing is not None:
+        years = years[~missing]
+    if np.any((years < NS_YEARS[0]) | (years > NS_YEARS[1])):
+        raise ValueError('dates outside ' + str(NS_YEARS[0]) + '-' +
+                         str(NS_YEARS[1]) + ' cannot be represented as '
+                         'datetime64[ns], use a cftime calendar')
+
+
+def _check_calendar(calendar: str):
+    """ Raises an error for unsupported calendars """
+    if calendar not in GREGORIAN_CALENDARS:
+        raise ValueError("unsupported calendar: " + str(calendar))
@@ -1,15 +1,24 @@
+"""
+VALUE dataset
+
+"""
+
 import os
+import shutil
 import datetime
 import numpy as np
 import xarray as xr
 import pandas as pd
 
+from load.time_encoding import daily_fractional_years
+from load.resample import monthly_frame
 from load import data_dir
 
-"""
-VALUE dataset
-
-"""
+INDEX_COLUMNS = ['station_id', 'name', 'start', 'end', 'file']
+# columns of the data returned by all_gauge_data
+STORE_DTYPES = {'time': 'datetime64[ns]', 'station_id': 'int64',
+                'tp': 'float64', 'name': 'object', 'lon': 'float64',
+                'lat': 'float64', 'z': 'float64'}
 
 
 def formatting_data(monthly=True):
@@ -28,15 +37,13 @@ def formatting_data(monthly=True):
     df = df.drop(columns=['YYYYMMDD'])
     df.set_index('time', inplace=True)
 
-    # Reformat columns
-    df1 = df.stack().reset_index()
-    df1 = df1.rename({"level_1": "station_id", 0: "tp"}, axis=1)
-    df1['station_id'] = df1['station_id'].astype(int)
-    
-    # Resample
+    # Resample and reformat columns
     if monthly == True:
-        df1 = df1.groupby('station_id').resample('MS', on='time', fill_method='ffill').mean()
-        df1 = df1.drop(columns=['station_id']).reset_index()
+        df1 = _monthly_stations(df)
+    else:
+        df1 = df.stack().reset_index()
+        df1 = df1.rename({"level_1": "station_id", 0: "tp"}, axis=1)
+        df1['station_id'] = df1['station_id'].astype(int)
 
     # Import station data and combine
     df4 = pd.read_csv(data_dir + 'VALUE_ECA_86_v2/stations.txt',
@@ -48,39 +55,125 @@ def formatting_data(monthly=True):
                      'altitude': 'z', }, axis=1)
     df7 = df7.drop(['source'], axis=1)
 
-    if monthly == True:
-        df7.to_csv(
-            data_dir + 'VALUE_ECA_86_v2/value_rsamp.csv')
-    if monthly == False:
-        df7.to_csv(
-            data_dir + 'VALUE_ECA_86_v2/value_daily.csv')
+    df7.to_csv(_csv_filepath(monthly))
+    build_store(monthly)
 
 
-def all_gauge_data(minyear:str, maxyear:str, threshold=None, monthly=True) -> pd.DataFrame:
+def _monthly_stations(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Monthly means of a daily table with a column per station, as a long
+    table sorted by station and time. As with a resample of each station's
+    valid values, every month from a station's first to last valid day is
+    kept, with NaN for months without valid values.
+    """
+    valid = df.notna().values
+    has_data = valid.any(axis=0)
+    days = df.index.values
+    first = days[valid.argmax(axis=0)].astype('datetime64[M]')
+    last = days[len(days) - 1 - valid[::-1].argmax(axis=0)].astype('datetime64[M]')
+
+    monthly_df = monthly_frame(df)
+    months = monthly_df.index.values
+    month_starts = months.astype('datetime64[M]')[:, None]
+    in_span = (month_starts >= first) & (month_starts <= last) & has_data
+
+    # station-major order
+    station_ids = df.columns.astype(int).values
+    df1 = pd.DataFrame({'station_id': np.repeat(station_ids, len(months)),
+                        'time': np.tile(months, len(station_ids)),
+                        'tp': monthly_df.values.T.ravel()})
+    df1 = df1[in_span.T.ravel()]
+    df1 = df1.sort_values(['station_id', 'time'], kind='stable')
+    return df1.reset_index(drop=True)
+
+
+def build_store(monthly=True):
+    """
+    Partition the formatted VALUE data by station and decade and write an
+    index of the partitions, so that station and date filters can be applied
+    before any data is parsed. The store is written to a temporary
+    directory that then replaces the previous store, so that no partitions
+    of an earlier build are left.
+
+    Args:
+        monthly (bool, optional): whether to partition monthly or daily data. Defaults to True.
+    """
+    store_dir = _store_dir(monthly)
+    tmp_dir = store_dir.rstrip('/') + '.' + str(os.getpid()) + '.tmp/'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    df = pd.read_csv(_csv_filepath(monthly), parse_dates=['time'])
+    df = df.drop(['Unnamed: 0'], axis=1)
+    decades = df['time'].dt.year // 10 * 10
+
+    index_rows = []
+    for (station_id, decade), part_df in df.groupby([df['station_id'], decades]):
+        part_df = part_df.sort_values('time')
+        filename = str(station_id) + '_' + str(decade) + '.csv'
+        part_df.to_csv(tmp_dir + filename, index=False)
+        index_rows.append({'station_id': station_id,
+                           'name': part_df['name'].iloc[0],
+                           'start': part_df['time'].iloc[0],
+                           'end': part_df['time'].iloc[-1],
+                           'file': filename})
+
+    pd.DataFrame(index_rows, columns=INDEX_COLUMNS).to_csv(
+        tmp_dir + 'index.csv', index=False)
+
+    old_dir = store_dir.rstrip('/') + '.' + str(os.getpid()) + '.old'
+    if os.path.exists(store_dir):
+        os.replace(store_dir, old_dir)
+    os.replace(tmp_dir, store_dir)
+    if os.path.exists(old_dir):
+        shutil.rmtree(old_dir)
+
+
+def all_gauge_data(minyear: str, maxyear: str, threshold=None, monthly=True, stations=None) -> pd.DataFrame:
     """    
     Download data between specified dates for all active stations between two dates.
     Can specify threshold for the the total number of active days during period:
             e.g. for 10 year period -> 4018 - 365 = 3653
 
+    Only the station/decade partitions overlapping the request are read. The
+    partitioned store is (re)built from the formatted CSV when it is missing
+    or out of date.
+
     Args:
         minyear (str): start year
         maxyear (str): end year
         threshold (_type_, optional): threshold value. Defaults to None.
         monthly (bool, optional): whether to return monthly or daily data. Defaults to True.
+        stations (list, optional): station names (capitalised). Defaults to None (all stations).
 
     Returns:
         pd.DataFrame: VALUE data
     """
-    if monthly == True:
-        filepath = data_dir + 'VALUE_ECA_86_v2/value_rsamp.csv'
-    if monthly == False:
-        filepath = data_dir + 'VALUE_ECA_86_v2/value_daily.csv'
-    df = pd.read_csv(filepath)
-    df = df.drop(['Unnamed: 0'], axis=1)
-    df['time'] = pd.to_datetime(df['time'])
-    df.set_index('time', inplace=True)
-    df_masked = df[minyear:maxyear]
-    return df_masked.reset_index()
+    store_dir = _store_dir(monthly)
+    index_filepath = store_dir + 'index.csv'
+    if (not os.path.exists(index_filepath) or
+            os.path.getmtime(_csv_filepath(monthly)) > os.path.getmtime(index_filepath)):
+        build_store(monthly)
+    index_df = pd.read_csv(index_filepath, parse_dates=['start', 'end'])
+
+    # Same bounds as partial string indexing, i.e. maxyear is inclusive
+    start = pd.Period(str(minyear)).start_time
+    end = pd.Period(str(maxyear)).end_time
+    mask = (index_df['end'] >= start) & (index_df['start'] <= end)
+    if stations is not None:
+        mask &= index_df['name'].isin(stations)
+    files = index_df.loc[mask, 'file']
+
+    if len(files) == 0:
+        return pd.DataFrame({column: pd.Series(dtype=dtype)
+                             for column, dtype in STORE_DTYPES.items()})
+
+    df = pd.concat([pd.read_csv(store_dir + f, parse_dates=['time'])
+                    for f in files], ignore_index=True)
+    df_masked = df[(df['time'] >= start) & (df['time'] <= end)]
+    df_masked = df_masked[['time'] + [c for c in df_masked if c != 'time']]
+    return df_masked.reset_index(drop=True)
 
 
 def gauge_download(station, minyear, maxyear):
@@ -92,12 +185,24 @@ def gauge_download(station, minyear, maxyear):
     Returns
        df (pd.DataFrame): precipitation gauge values
     """
-    df = all_gauge_data(minyear, maxyear)
-    station_df = df[df['name'] == station]
-
+    station_df = all_gauge_data(minyear, maxyear, stations=[station])
     return station_df
 
 
+def _csv_filepath(monthly: bool) -> str:
+    """ Returns the filepath of the formatted VALUE CSV """
+    if monthly == True:
+        return data_dir + 'VALUE_ECA_86_v2/value_rsamp.csv'
+    return data_dir + 'VALUE_ECA_86_v2/value_daily.csv'
+
+
+def _store_dir(monthly: bool) -> str:
+    """ Returns the directory of the partitioned VALUE store """
+    if monthly == True:
+        return data_dir + 'VALUE_ECA_86_v2/value_rsamp/'
+    return data_dir + 'VALUE_ECA_86_v2/value_daily/'
+
+
 def year_into_days(start_year: float, end_year: float) -> np.array:
     """
     Divide years into days
@@ -109,12 +214,4 @@ def year_into_days(start_year: float, end_year: float) -> np.array:
     Returns:
         np.array: array in years with daily resolution 
     """
-    final_arr = np.array([])
-    year_arr = np.arange(start_year, end_year)
-    for y in year_arr:
-        if y % 4 < 0.001:
-            year_in_days_arr = np.arange(y, y+1, 1/366)
-        else:
-            year_in_days_arr = np.arange(y, y+1, 1/365)
-        final_arr = np.append(final_arr, year_in_days_arr)
-    return final_arr
+    return daily_fractional_years(start_year, end_year)